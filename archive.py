@@ -0,0 +1,174 @@
+# archive.py
+# Холодный архив сообщений групп. Старые сообщения (retention.py) уходят из messages в
+# сжатые файлы только для дописывания: один файл на группу и период (месяц по умолчанию),
+#   <ARCHIVE_DIR>/<group_id>/<период>.jsonl.gz
+# каждый пакет архивации — отдельный gzip-член с JSON-строками сообщений в том же виде, что
+# и в истории (serialization.row_to_dict), так что файл читается и обычным zcat.
+#
+# Границы сегмента (id, время, подтверждённый размер файла) хранятся в archive_segments и
+# меняются в той же транзакции, что и удаление сообщений из messages. Читается только
+# подтверждённая часть файла, а недописанный хвост после сбоя обрезается перед следующей
+# записью. История (main._get_messages_page) подгружает сегменты, только когда листают
+# дальше горячей части; разобранные сегменты держатся в памяти (LRU).
+import gzip
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from database import engine
+from models import ArchiveSegment
+from serialization import dumps, loads, row_to_dict
+
+_database_dir = os.path.dirname(os.path.abspath(engine.url.database or "chat.db"))
+ARCHIVE_DIR = os.environ.get("CHAT_ARCHIVE_DIR") or os.path.join(_database_dir, "archive")
+# Период сегмента как формат strftime по времени сообщения; "%Y-%m-%d" — по дням
+ARCHIVE_BUCKET = os.environ.get("CHAT_ARCHIVE_BUCKET", "%Y-%m")
+# Сколько памяти занимают разобранные сегменты (оценка по несжатому размеру)
+ARCHIVE_CACHE_BYTES = int(os.environ.get("CHAT_ARCHIVE_CACHE_BYTES", str(16 * 1024 * 1024)))
+
+
+def segment_path(group_id: int, bucket: str) -> str:
+    return os.path.join(ARCHIVE_DIR, str(group_id), f"{bucket}.jsonl.gz")
+
+
+def _append(path: str, committed: int, payload: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as file:
+        # Всё после подтверждённого размера — от неудавшейся записи, её сообщения ещё в messages
+        file.truncate(committed)
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def archive_messages(db: Session, group_id: int, rows) -> int:
+    """Append message rows to their group's segments; the caller deletes them and commits."""
+    # rows — строки serialization.message_select() по возрастанию времени
+    buckets: Dict[str, list] = {}
+    for row in rows:
+        buckets.setdefault(row.timestamp.strftime(ARCHIVE_BUCKET), []).append(row)
+    for bucket, bucket_rows in buckets.items():
+        payload = gzip.compress(b"".join(dumps(row_to_dict(row)) + b"\n" for row in bucket_rows), mtime=0)
+        segment = db.get(ArchiveSegment, (group_id, bucket))
+        if segment is None:
+            segment = ArchiveSegment(group_id=group_id, bucket=bucket, first_id=bucket_rows[0].id,
+                                     last_id=bucket_rows[0].id, last_timestamp=bucket_rows[0].timestamp,
+                                     message_count=0, size=0)
+            db.add(segment)
+        # Файл дописывается до коммита: при сбое после записи сегмент просто не видит новый хвост
+        _append(segment_path(group_id, bucket), segment.size, payload)
+        segment.size += len(payload)
+        segment.message_count += len(bucket_rows)
+        segment.first_id = min(segment.first_id, min(row.id for row in bucket_rows))
+        segment.last_id = max(segment.last_id, max(row.id for row in bucket_rows))
+        segment.last_timestamp = max(segment.last_timestamp, bucket_rows[-1].timestamp)
+    return sum(len(bucket_rows) for bucket_rows in buckets.values())
+
+
+def drop_segments(db: Session, group_id: int, before=None) -> List[str]:
+    # Сегменты группы (только целиком старше before, если задан). Возвращает пути файлов:
+    # удалять их вызывающий должен после коммита
+    query = db.query(ArchiveSegment).filter(ArchiveSegment.group_id == group_id)
+    if before is not None:
+        query = query.filter(ArchiveSegment.last_timestamp < before)
+    segments = query.all()
+    for segment in segments:
+        db.delete(segment)
+    return [segment_path(segment.group_id, segment.bucket) for segment in segments]
+
+
+def remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    for directory in {os.path.dirname(path) for path in paths}:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+
+class SegmentCache:
+    """Decoded archive segments keyed by (group, bucket), least recently used dropped first."""
+
+    def __init__(self, max_bytes: int = ARCHIVE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        # (group_id, bucket) -> ((первый id, подтверждённый размер), ids, сообщения, оценка памяти)
+        self.segments: "OrderedDict[Tuple[int, str], tuple]" = OrderedDict()
+        self.total_bytes = 0
+        # Читают потоки БД для чтения
+        self.lock = threading.Lock()
+
+    def load(self, group_id: int, bucket: str, first_id: int, size: int) -> Tuple[List[int], List[dict]]:
+        key = (group_id, bucket)
+        version = (first_id, size)
+        with self.lock:
+            entry = self.segments.get(key)
+            # Сегмент дописали (или это уже другая группа с тем же id) — разбираем заново
+            if entry is not None and entry[0] == version:
+                self.segments.move_to_end(key)
+                return entry[1], entry[2]
+        try:
+            with open(segment_path(group_id, bucket), "rb") as file:
+                data = file.read(size)
+        except FileNotFoundError:
+            # Сегмент удалили по сроку хранения, пока шло чтение
+            return [], []
+        raw = gzip.decompress(data)
+        by_id = {}
+        for line in raw.splitlines():
+            message = loads(line)
+            by_id[message["id"]] = message
+        ids = sorted(by_id)
+        messages = [by_id[message_id] for message_id in ids]
+        with self.lock:
+            previous = self.segments.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[3]
+            self.segments[key] = (version, ids, messages, len(raw))
+            self.total_bytes += len(raw)
+            while self.total_bytes > self.max_bytes and len(self.segments) > 1:
+                _, evicted = self.segments.popitem(last=False)
+                self.total_bytes -= evicted[3]
+        return ids, messages
+
+    def stats(self) -> dict:
+        return {"segments": len(self.segments), "bytes": self.total_bytes}
+
+
+segment_cache = SegmentCache()
+
+
+def archived_page(db: Session, group_id: int, before_id: Optional[int], after_id: Optional[int],
+                  limit: int) -> Tuple[List[dict], bool]:
+    """Archived messages strictly between after_id and before_id, ascending, and whether more exist.
+
+    Without after_id these are the newest `limit` of them (scrolling back), otherwise the oldest.
+    """
+    query = select(ArchiveSegment.bucket, ArchiveSegment.first_id, ArchiveSegment.size).where(ArchiveSegment.group_id == group_id)
+    if before_id is not None:
+        query = query.where(ArchiveSegment.first_id < before_id)
+    if after_id is not None:
+        query = query.where(ArchiveSegment.last_id > after_id)
+    backward = after_id is None
+    query = query.order_by(ArchiveSegment.first_id.desc() if backward else ArchiveSegment.first_id)
+    found: List[dict] = []
+    for bucket, first_id, size in db.execute(query).all():
+        if len(found) > limit:
+            break
+        ids, messages = segment_cache.load(group_id, bucket, first_id, size)
+        start = 0 if after_id is None else bisect_right(ids, after_id)
+        end = len(ids) if before_id is None else bisect_left(ids, before_id)
+        found.extend(reversed(messages[start:end]) if backward else messages[start:end])
+    # Периоды соседних сегментов могут перекрываться по id на стыке
+    found.sort(key=lambda message: message["id"], reverse=backward)
+    has_more = len(found) > limit
+    found = found[:limit]
+    if backward:
+        found.reverse()
+    return found, has_more
@@ -1,15 +1,19 @@
 # auth.py
+import os
 import jwt
 from datetime import datetime, timedelta
 from fastapi import HTTPException, Depends
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
-from models import User
-from database import SessionLocal
+from database import get_read_db
+from membership_cache import membership
 
 SECRET_KEY = "your_secret_key"  # выберите надежный ключ!
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# CHAT_WS_REQUIRE_AUTH=0 — совместимость со старыми клиентами /ws/{group_id} без токена:
+# author_id в кадре, но за соединением закрепляется первый автор
+WS_REQUIRE_AUTH = os.environ.get("CHAT_WS_REQUIRE_AUTH", "1") == "1"
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
@@ -35,16 +39,25 @@ def verify_token(token: str):
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Неверный токен")
 
-def get_db():
-    db = SessionLocal()
+# Для WebSocket: (user_id, момент истечения в unix-времени); бросает HTTPException как verify_token
+def decode_token(token: str):
     try:
-        yield db
-    finally:
-        db.close()
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        return int(payload["sub"]), float(payload["exp"])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Время жизни токена истекло")
+    except (jwt.PyJWTError, KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=401, detail="Неверный токен")
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
     user_id = verify_token(token)
-    user = db.query(User).filter(User.id == user_id).first()
+    try:
+        user = membership.user(db, int(user_id))
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Неверный токен")
+    # Возвращаем соединение в пул чтения: иначе запрос держит его, пока ждёт свободный поток
+    # для тела маршрута, а все потоки могут ждать соединение — взаимная блокировка до pool_timeout
+    db.rollback()
     if not user:
         raise HTTPException(status_code=401, detail="Пользователь не найден")
     return user
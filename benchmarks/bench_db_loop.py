@@ -0,0 +1,109 @@
+# Задержка event loop и пропускная способность при 500 одновременных отправителях.
+# "inline" — старое поведение (коммит SQLite прямо в event loop),
+# "executor" — сохранение через database.run_db,
+# "write_behind" — пакетная запись через MessageWriter (ack после коммита).
+#
+#   python -m benchmarks.bench_db_loop --senders 500 --messages 20
+import argparse
+import asyncio
+import datetime
+import os
+import tempfile
+import time
+
+from benchmarks.common import report, summarize_ms
+
+GROUP_ID = 1
+
+
+def prepare_database(senders: int):
+    from database import SessionLocal
+    from models import Group, GroupUser, User
+
+    db = SessionLocal()
+    db.add(Group(id=GROUP_ID, name="bench"))
+    for user_id in range(1, senders + 1):
+        db.add(User(id=user_id, username=f"user{user_id}", password="x"))
+        db.add(GroupUser(group_id=GROUP_ID, user_id=user_id))
+    db.commit()
+    db.close()
+
+
+def legacy_author(db, group_id: int, author_id: int):
+    # Старые запросы на каждый кадр: членство + автор
+    from models import GroupUser, User
+
+    if not db.query(GroupUser).filter(GroupUser.group_id == group_id, GroupUser.user_id == author_id).first():
+        return None
+    return db.query(User).filter(User.id == author_id).first()
+
+
+async def probe_lag(lags: list, stop: asyncio.Event, interval: float = 0.01):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - started - interval)
+
+
+async def run(mode: str, senders: int, messages: int):
+    import main
+    from database import _with_session
+    from message_writer import MessageWriter, insert_message
+
+    if mode == "write_behind":
+        main.message_writer = MessageWriter()
+        await main.message_writer.start()
+
+    async def sender(author_id: int):
+        for seq in range(messages):
+            if mode == "inline":
+                author = _with_session(legacy_author, (GROUP_ID, author_id))
+                row = {"content": f"message {seq}", "author_id": author.id, "group_id": GROUP_ID,
+                       "timestamp": datetime.datetime.now(), "edited": 0}
+                _with_session(insert_message, (row,))
+            else:
+                if author_id not in await main.group_members(GROUP_ID):
+                    raise RuntimeError("sender is not a member")
+                author = await main.cached_user(author_id)
+                await main.store_message(author, f"message {seq}", group_id=GROUP_ID)
+            # Отдаём управление, как при ожидании следующего кадра из сокета
+            await asyncio.sleep(0)
+
+    lags = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_lag(lags, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(author_id) for author_id in range(1, senders + 1)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    if main.message_writer is not None:
+        await main.message_writer.close()
+        main.message_writer = None
+    return {
+        "messages": senders * messages,
+        "wall_s": round(elapsed, 3),
+        "messages_per_s": round(senders * messages / elapsed, 1),
+        "loop_lag": summarize_ms(lags),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--senders", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=20, help="messages per sender")
+    parser.add_argument("--mode", choices=["inline", "executor", "write_behind", "all"], default="all")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    os.environ["CHAT_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    prepare_database(args.senders)
+
+    modes = ["inline", "executor", "write_behind"] if args.mode == "all" else [args.mode]
+    results = {mode: asyncio.run(run(mode, args.senders, args.messages)) for mode in modes}
+    report("db_event_loop", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# p99 задержка доставки в группе из 1000 участников, 1% из которых — медленные клиенты.
+# Сравнивает старую последовательную рассылку (send_json по очереди) с очередями
+# на каждое соединение из ConnectionManager.
+#
+#   python -m benchmarks.bench_fanout --members 1000 --slow-ratio 0.01 --messages 200
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import report, summarize_ms
+from websocket_manager import ConnectionManager
+
+GROUP_ID = 1
+
+
+class FakeWebSocket:
+    def __init__(self, send_delay: float, latencies: list):
+        self.send_delay = send_delay
+        self.latencies = latencies
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, data: str):
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        sent_at = json.loads(data)["data"]["sent_at"]
+        self.latencies.append(time.perf_counter() - sent_at)
+
+    async def send_json(self, data):
+        await self.send_text(json.dumps(data))
+
+
+def make_sockets(members: int, slow_ratio: float, slow_delay: float):
+    fast, slow = [], []
+    slow_every = int(1 / slow_ratio) if slow_ratio else 0
+    sockets = []
+    for i in range(members):
+        if slow_every and i % slow_every == 0:
+            sockets.append(FakeWebSocket(slow_delay, slow))
+        else:
+            sockets.append(FakeWebSocket(0, fast))
+    return sockets, fast, slow
+
+
+def message(seq: int):
+    return {"type": "new_message", "data": {"id": seq, "content": "x" * 64, "sent_at": time.perf_counter()}}
+
+
+async def run_sequential(sockets, messages: int, interval: float):
+    # Старое поведение broadcast_to_group: await send_json на каждом сокете по очереди
+    for seq in range(messages):
+        msg = message(seq)
+        for ws in sockets:
+            try:
+                await ws.send_json(msg)
+            except Exception:
+                pass
+        await asyncio.sleep(interval)
+
+
+async def run_queued(sockets, messages: int, interval: float, backlog: int, policy: str):
+    manager = ConnectionManager(max_backlog=backlog, overflow_policy=policy)
+    for ws in sockets:
+        await manager.connect(ws, GROUP_ID)
+    for seq in range(messages):
+        await manager.broadcast_to_group(message(seq), GROUP_ID)
+        await asyncio.sleep(interval)
+    # Даём писателям дочистить очереди
+    deadline = time.perf_counter() + 5
+    while time.perf_counter() < deadline and any(not c.queue.empty() for c in manager.all_connections.values()):
+        await asyncio.sleep(0.01)
+    connected = len(manager.all_connections)
+    for connection in list(manager.all_connections.values()):
+        manager.remove(connection)
+    return connected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--slow-ratio", type=float, default=0.01)
+    parser.add_argument("--slow-delay", type=float, default=0.05, help="seconds per send for slow clients")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.005, help="seconds between broadcasts")
+    parser.add_argument("--backlog", type=int, default=64)
+    parser.add_argument("--policy", choices=["evict", "drop"], default="evict")
+    parser.add_argument("--skip-sequential", action="store_true")
+    args = parser.parse_args()
+
+    results = {}
+    if not args.skip_sequential:
+        sockets, fast, slow = make_sockets(args.members, args.slow_ratio, args.slow_delay)
+        started = time.perf_counter()
+        asyncio.run(run_sequential(sockets, args.messages, args.interval))
+        results["sequential"] = {
+            "wall_s": round(time.perf_counter() - started, 3),
+            "fast_clients": summarize_ms(fast),
+            "slow_clients": summarize_ms(slow),
+        }
+
+    sockets, fast, slow = make_sockets(args.members, args.slow_ratio, args.slow_delay)
+    started = time.perf_counter()
+    connected = asyncio.run(run_queued(sockets, args.messages, args.interval, args.backlog, args.policy))
+    results["queued"] = {
+        "wall_s": round(time.perf_counter() - started, 3),
+        "policy": args.policy,
+        "still_connected": connected,
+        "fast_clients": summarize_ms(fast),
+        "slow_clients": summarize_ms(slow),
+    }
+    report("fanout", results)
+
+
+if __name__ == "__main__":
+    main()
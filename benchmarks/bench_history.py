@@ -0,0 +1,103 @@
+# Задержка первой страницы GET /messages для группы с 1M сообщений.
+# "keyset" — текущая постраничная выборка, "full" — старая загрузка всей истории (.all()).
+#
+#   python -m benchmarks.bench_history --messages 1000000 --runs 50
+#   python -m benchmarks.bench_history --messages 100000 --full
+import argparse
+import datetime
+import os
+import sqlite3
+import tempfile
+import time
+
+from benchmarks.common import report, summarize_ms
+
+GROUP_ID = 1
+USERS = 100
+BATCH = 50_000
+
+
+def fill_database(path: str, messages: int):
+    # Заполняем напрямую через sqlite3 — на порядок быстрее, чем через ORM
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO groups (id, name) VALUES (?, ?)", (GROUP_ID, "bench"))
+    conn.executemany(
+        "INSERT INTO users (id, username, password) VALUES (?, ?, 'x')",
+        [(user_id, f"user{user_id}") for user_id in range(1, USERS + 1)],
+    )
+    start = datetime.datetime(2024, 1, 1)
+    for offset in range(0, messages, BATCH):
+        rows = [
+            (f"message {i}", (start + datetime.timedelta(seconds=i)).isoformat(sep=" "), 0, i % USERS + 1, GROUP_ID)
+            for i in range(offset, min(offset + BATCH, messages))
+        ]
+        conn.executemany(
+            "INSERT INTO messages (content, timestamp, edited, author_id, group_id) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.commit()
+    conn.close()
+
+
+def measure(fn, runs: int):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return summarize_ms(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--full", action="store_true", help="also time loading the whole history")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    path = os.path.join(workdir, "bench.db")
+    os.environ["CHAT_DATABASE_URL"] = f"sqlite:///{path}"
+
+    from database import _with_session
+    from main import _get_messages_page, _page, recent_messages
+    from schemas import MessageOut, MessagePage
+
+    started = time.perf_counter()
+    fill_database(path, args.messages)
+    results = {"messages": args.messages, "fill_s": round(time.perf_counter() - started, 1)}
+
+    def first_page():
+        page = _page(*_with_session(_get_messages_page, (GROUP_ID, None, None, args.limit)))
+        return MessagePage.model_validate(page).model_dump_json()
+
+    def deep_page():
+        page = _page(*_with_session(_get_messages_page, (GROUP_ID, args.messages // 2, None, args.limit)))
+        return MessagePage.model_validate(page).model_dump_json()
+
+    def cached_first_page():
+        page = _page(*recent_messages.get_page(GROUP_ID, None, args.limit))
+        return MessagePage.model_validate(page).model_dump_json()
+
+    results["keyset_first_page"] = measure(first_page, args.runs)
+    results["keyset_middle_page"] = measure(deep_page, args.runs)
+
+    recent_messages.begin_fill(GROUP_ID)
+    messages, has_more = _with_session(_get_messages_page, (GROUP_ID, None, None, recent_messages.per_group))
+    recent_messages.fill(GROUP_ID, messages, complete=not has_more)
+    results["cached_first_page"] = measure(cached_first_page, args.runs)
+
+    if args.full:
+        from sqlalchemy.orm import joinedload
+        from models import Message
+
+        def full_history(db):
+            messages = db.query(Message).filter(Message.group_id == GROUP_ID).options(joinedload(Message.author)).all()
+            return [MessageOut.model_validate(m).model_dump_json() for m in messages]
+
+        results["full_history"] = measure(lambda: _with_session(full_history, ()), 1)
+    report("history_first_page", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# Стоимость присутствия и индикаторов набора при 10k подключённых пользователях:
+# ConnectionManager с поддельными сокетами, PresenceTracker с обычным тиком. Пользователи
+# набирают текст (кадр typing на каждое нажатие), часть переподключается. Сравнивает число
+# кадров, ушедших в сокеты, с рассылкой "по кадру на нажатие" и замеряет CPU тиков.
+#
+#   python -m benchmarks.bench_presence --users 10000 --group-size 50 --seconds 10
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.common import report, summarize_ms
+from presence import PresenceTracker
+from websocket_manager import ConnectionManager
+
+
+class CountingWebSocket:
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, data: str):
+        if data.startswith('{"type":"presence"'):
+            self.stats["frames"] += 1
+            self.stats["bytes"] += len(data)
+
+
+def timed(samples: list, fn):
+    def wrapper(*args):
+        started = time.process_time()
+        try:
+            return fn(*args)
+        finally:
+            samples.append(time.process_time() - started)
+    return wrapper
+
+
+async def run(args) -> dict:
+    stats = {"frames": 0, "bytes": 0}
+    manager = ConnectionManager(max_backlog=10000)
+    tracker = PresenceTracker(manager, tick=args.tick)
+    collect, receive, sweep = [], [], []
+    tracker._collect = timed(collect, tracker._collect)
+    tracker._receive = timed(receive, tracker._receive)
+    tracker._sweep = timed(sweep, tracker._sweep)
+    broker_messages = [0]
+    publish = manager.broker.publish
+
+    async def counting_publish(channel, payload):
+        broker_messages[0] += 1
+        await publish(channel, payload)
+
+    manager.broker.publish = counting_publish
+    await tracker.start()
+
+    # Каждый пользователь — в groups_per_user группах по group_size участников
+    groups = args.users * args.groups_per_user // args.group_size
+    rng = random.Random(1)
+    user_groups = {user_id: rng.sample(range(groups), args.groups_per_user) for user_id in range(args.users)}
+
+    async def connect(user_id):
+        connection = await manager.connect(CountingWebSocket(stats), user_id=user_id, multiplexed=True)
+        for group_id in user_groups[user_id]:
+            manager.subscribe(connection, group_id)
+        return connection
+
+    connections = {user_id: await connect(user_id) for user_id in range(args.users)}
+    # Дожидаемся, пока разойдётся начальное присутствие, и считаем с чистого листа
+    await asyncio.sleep(args.tick * 2)
+    stats.update(frames=0, bytes=0)
+    broker_messages[0] = 0
+    for samples in (collect, receive, sweep):
+        samples.clear()
+
+    keystrokes = naive_frames = reconnects = 0
+    step = 0.01
+    # Набирающие сейчас; каждый набирает в среднем typing_seconds, потом его сменяет другой
+    typists = rng.sample(range(args.users), args.typists)
+    started_wall, started_cpu = time.perf_counter(), time.process_time()
+    while time.perf_counter() - started_wall < args.seconds:
+        # Нажатия с темпом keystroke_rate в секунду, каждое — кадр typing от клиента
+        for index, user_id in enumerate(typists):
+            if rng.random() < step / args.typing_seconds:
+                typists[index] = rng.randrange(args.users)
+            if rng.random() < args.keystroke_rate * step:
+                group_id = user_groups[user_id][0]
+                tracker.set_typing(user_id, group_id, True)
+                keystrokes += 1
+                naive_frames += len(manager.group_connections.get(group_id, {}))
+        expected = args.users * args.churn_rate * step
+        for _ in range(int(expected) + (rng.random() < expected - int(expected))):
+            user_id = rng.randrange(args.users)
+            manager.remove(connections[user_id])
+            connections[user_id] = await connect(user_id)
+            reconnects += 1
+        await asyncio.sleep(step)
+    wall = time.perf_counter() - started_wall
+    cpu = time.process_time() - started_cpu
+    results = {
+        "params": vars(args),
+        "groups": groups,
+        "keystrokes": keystrokes,
+        "reconnects": reconnects,
+        "naive_frames_per_s": round(naive_frames / wall, 1),
+        "presence_frames_per_s": round(stats["frames"] / wall, 1),
+        "presence_kb_per_s": round(stats["bytes"] / wall / 1024, 1),
+        "broker_messages_per_s": round(broker_messages[0] / wall, 1),
+        "collect": summarize_ms(collect),
+        "receive_and_fanout": summarize_ms(receive),
+        "sweep": summarize_ms(sweep),
+        # Включает генерацию нагрузки и запись в поддельные сокеты
+        "process_cpu_percent": round(cpu / wall * 100, 1),
+    }
+    await tracker.close()
+    for connection in list(manager.all_connections.values()):
+        manager.remove(connection)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--group-size", type=int, default=50)
+    parser.add_argument("--groups-per-user", type=int, default=5)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--tick", type=float, default=1.0)
+    parser.add_argument("--typists", type=int, default=500, help="users typing at any moment")
+    parser.add_argument("--keystroke-rate", type=float, default=5.0, help="keystrokes per second per typist")
+    parser.add_argument("--typing-seconds", type=float, default=10.0, help="average typing session length")
+    parser.add_argument("--churn-rate", type=float, default=0.001, help="reconnects per user per second")
+    args = parser.parse_args()
+    report("presence", asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Задержка GET /messages/search на корпусе из нескольких миллионов сообщений.
+# Словарь с распределением Ципфа: есть и редкие, и очень частые слова.
+# "backfill_s" — время python -m search rebuild; "like" — старый вариант через LIKE (--like).
+#
+#   python -m benchmarks.bench_search --messages 2000000 --runs 20
+#   python -m benchmarks.bench_search --messages 200000 --like
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from benchmarks.common import report, summarize_ms
+
+USER_ID = 1
+GROUPS = 200
+USER_GROUPS = 20
+VOCABULARY = 20_000
+WORDS_PER_MESSAGE = (3, 15)
+BATCH = 50_000
+# Номер миграции, создающей messages_fts (migrations.MIGRATIONS)
+SEARCH_MIGRATION = 5
+
+
+def make_vocabulary(rng: random.Random):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    words = sorted(words)
+    weights = [1 / rank for rank in range(1, VOCABULARY + 1)]
+    return words, weights
+
+
+def fill_database(path: str, messages: int, rng: random.Random, words, weights):
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO groups (id, name) VALUES (?, ?)", [(g, f"group{g}") for g in range(1, GROUPS + 1)])
+    conn.execute("INSERT INTO users (id, username, password) VALUES (?, 'bench', 'x')", (USER_ID,))
+    conn.executemany(
+        "INSERT INTO group_users (group_id, user_id) VALUES (?, ?)",
+        [(g, USER_ID) for g in range(1, USER_GROUPS + 1)],
+    )
+    start = datetime.datetime(2024, 1, 1)
+    for offset in range(0, messages, BATCH):
+        rows = []
+        for i in range(offset, min(offset + BATCH, messages)):
+            content = " ".join(rng.choices(words, weights, k=rng.randint(*WORDS_PER_MESSAGE)))
+            rows.append((content, (start + datetime.timedelta(seconds=i)).isoformat(sep=" "), 0, USER_ID,
+                         rng.randint(1, GROUPS)))
+        conn.executemany(
+            "INSERT INTO messages (content, timestamp, edited, author_id, group_id) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.commit()
+    conn.close()
+
+
+def measure(fn, runs: int):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return summarize_ms(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--like", action="store_true", help="also time the LIKE scan baseline")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    path = os.path.join(workdir, "bench.db")
+    os.environ["CHAT_DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ["CHAT_AUTO_MIGRATE"] = "0"
+
+    from database import _with_session, engine
+    from migrations import migrate
+    from search import AUTO_REBUILD_ROWS, match_query, rebuild
+
+    # Схема без FTS-таблицы: она появится уже после заполнения
+    migrate(engine, target=SEARCH_MIGRATION - 1)
+
+    rng = random.Random(args.seed)
+    words, weights = make_vocabulary(rng)
+    started = time.perf_counter()
+    fill_database(path, args.messages, rng, words, weights)
+    results = {"messages": args.messages, "fill_s": round(time.perf_counter() - started, 1)}
+
+    started = time.perf_counter()
+    migrate(engine, target=SEARCH_MIGRATION)
+    if args.messages > AUTO_REBUILD_ROWS:
+        with engine.begin() as connection:
+            rebuild(connection)
+    results["backfill_s"] = round(time.perf_counter() - started, 1)
+
+    from main import _search_messages
+
+    # Частое (топ-10), среднее и редкое слово, фраза из двух слов и префикс
+    queries = {
+        "common": words[5],
+        "medium": words[500],
+        "rare": words[15_000],
+        "two_words": f"{words[20]} {words[300]}",
+        "prefix": words[100][:3],
+    }
+    for name, q in queries.items():
+        query = match_query(q)
+        for order in ("rank", "recent"):
+            results[f"{name}_{order}"] = measure(
+                lambda: _with_session(_search_messages, (USER_ID, query, None, 0, args.limit, order)), args.runs
+            )
+        results[f"{name}_rank_one_group"] = measure(
+            lambda: _with_session(_search_messages, (USER_ID, query, 1, 0, args.limit, "rank")), args.runs
+        )
+
+    if args.like:
+        conn = sqlite3.connect(path)
+
+        def like_scan():
+            conn.execute(
+                "SELECT id FROM messages WHERE content LIKE ? AND group_id IN "
+                "(SELECT group_id FROM group_users WHERE user_id = ?) ORDER BY id DESC LIMIT ?",
+                (f"%{queries['rare']}%", USER_ID, args.limit),
+            ).fetchall()
+
+        results["like_rare"] = measure(like_scan, max(1, args.runs // 10))
+    report("message_search", results)
+
+
+if __name__ == "__main__":
+    main()
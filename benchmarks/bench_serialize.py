@@ -0,0 +1,95 @@
+# Сериализация страницы истории из 10k сообщений: строк в секунду на запрос + сериализацию.
+# "orm_pydantic" — прежний путь (ORM-объекты с joinedload автора, dict по атрибутам, проверка
+# и дамп через MessagePage, json.dumps), "core" — serialization.py (core-запрос, dict из
+# строки, один dumps). Кодировщик core-пути — orjson, если установлен (см. поле encoder).
+#
+#   python -m benchmarks.bench_serialize --messages 10000 --runs 20
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.bench_history import GROUP_ID, fill_database
+from benchmarks.common import report, summarize_ms
+
+
+def measure(fn, runs: int, rows: int) -> dict:
+    # fn возвращает (секунды на запрос, секунды на сериализацию)
+    query, encode, total = [], [], []
+    for _ in range(runs):
+        query_s, encode_s = fn()
+        query.append(query_s)
+        encode.append(encode_s)
+        total.append(query_s + encode_s)
+    best = min(total)
+    return {
+        "rows_per_s": round(rows / best),
+        "query": summarize_ms(query),
+        "serialize": summarize_ms(encode),
+        "total": summarize_ms(total),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    path = os.path.join(workdir, "bench.db")
+    os.environ["CHAT_DATABASE_URL"] = f"sqlite:///{path}"
+
+    from sqlalchemy.orm import joinedload
+    from database import _with_session, engine
+    from migrations import migrate
+    from models import Message
+    from schemas import MessagePage
+    import serialization
+    from serialization import dumps, message_select, rows_to_dicts
+
+    migrate(engine)
+    fill_database(path, args.messages)
+
+    def orm_pydantic(db):
+        started = time.perf_counter()
+        messages = (
+            db.query(Message).filter(Message.group_id == GROUP_ID)
+            .options(joinedload(Message.author)).order_by(Message.id.desc()).limit(args.messages).all()
+        )
+        fetched = time.perf_counter()
+        page = {"messages": [{
+            "id": m.id, "content": m.content, "author_id": m.author_id,
+            "author": {"id": m.author.id, "username": m.author.username, "avatar": m.author.avatar},
+            "group_id": m.group_id, "recipient_id": m.recipient_id,
+            "timestamp": m.timestamp.isoformat(), "edited": m.edited or 0,
+        } for m in messages], "next_cursor": None, "has_more": False}
+        body = json.dumps(MessagePage.model_validate(page).model_dump(mode="json")).encode()
+        assert body
+        return fetched - started, time.perf_counter() - fetched
+
+    def core(db):
+        started = time.perf_counter()
+        rows = db.execute(
+            message_select().where(Message.group_id == GROUP_ID).order_by(Message.id.desc()).limit(args.messages)
+        ).all()
+        fetched = time.perf_counter()
+        body = dumps({"messages": rows_to_dicts(rows), "next_cursor": None, "has_more": False})
+        assert body
+        return fetched - started, time.perf_counter() - fetched
+
+    results = {
+        "messages": args.messages,
+        "encoder": "orjson" if serialization.orjson is not None else "json",
+    }
+    for name, fn in (("orm_pydantic", orm_pydantic), ("core", core)):
+        # Первый прогон прогревает кэш страниц SQLite и компиляцию запроса
+        _with_session(fn, ())
+        results[name] = measure(lambda: _with_session(fn, ()), args.runs, args.messages)
+    results["speedup"] = round(results["core"]["rows_per_s"] / results["orm_pydantic"]["rows_per_s"], 2)
+    report("serialize_page", results)
+
+
+if __name__ == "__main__":
+    main()
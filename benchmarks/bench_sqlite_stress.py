@@ -0,0 +1,144 @@
+# Нагрузочная проверка SQLite: несколько процессов (как воркеры uvicorn), в каждом
+# потоки-писатели (insert_message) и потоки-читатели (страница истории) с заданным темпом.
+# Завершается с кодом 1, если были ошибки "database is locked" или не набран темп записи.
+#
+#   python -m benchmarks.bench_sqlite_stress --processes 4 --rate 100 --seconds 10
+#   python -m benchmarks.bench_sqlite_stress --profile legacy
+import argparse
+import datetime
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import report, summarize_ms
+
+GROUPS = 20
+USERS = 50
+
+
+def prepare_database():
+    # Схема со всеми миграциями: триггеры полнотекстового индекса — часть стоимости каждой вставки
+    from database import SessionLocal
+    from chat_list import create_summary
+    from models import Group, GroupUser, User
+
+    db = SessionLocal()
+    for user_id in range(1, USERS + 1):
+        db.add(User(id=user_id, username=f"user{user_id}", password="x"))
+    for group_id in range(1, GROUPS + 1):
+        db.add(Group(id=group_id, name=f"group{group_id}"))
+        for user_id in range(1, USERS + 1):
+            db.add(GroupUser(group_id=group_id, user_id=user_id))
+        create_summary(db, group_id, member_count=USERS)
+    db.commit()
+    db.close()
+
+
+def paced(rate: float, deadline: float, op, timings: list, errors: list):
+    # Операции с постоянным темпом; отставание не копим, чтобы не мерить очередь бенчмарка
+    interval = 1 / rate
+    next_at = time.perf_counter()
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            return
+        if now < next_at:
+            time.sleep(next_at - now)
+        next_at = max(next_at + interval, time.perf_counter() - interval)
+        started = time.perf_counter()
+        try:
+            op()
+        except Exception as e:
+            errors.append(str(e).splitlines()[0])
+        else:
+            timings.append(time.perf_counter() - started)
+
+
+def worker(index: int, args, results):
+    from sqlalchemy import text
+    from database import ReadSessionLocal, _with_session
+    from message_writer import insert_message
+
+    def write():
+        row = {"content": f"stress {index}", "author_id": index % USERS + 1, "group_id": index % GROUPS + 1,
+               "recipient_id": None, "timestamp": datetime.datetime.now(), "edited": 0}
+        _with_session(insert_message, (row,))
+
+    def read_page(db):
+        return db.execute(text(
+            "SELECT m.id, m.content, u.username FROM messages m JOIN users u ON u.id = m.author_id "
+            "WHERE m.group_id = :group_id ORDER BY m.id DESC LIMIT 50"
+        ), {"group_id": index % GROUPS + 1}).all()
+
+    def read():
+        _with_session(read_page, (), ReadSessionLocal)
+
+    deadline = time.perf_counter() + args.seconds
+    writes, reads, errors = [], [], []
+    threads = [
+        threading.Thread(target=paced, args=(args.rate / args.processes / args.writers, deadline, write, writes, errors))
+        for _ in range(args.writers)
+    ] + [
+        threading.Thread(target=paced, args=(args.read_rate / args.processes / args.readers, deadline, read, reads, errors))
+        for _ in range(args.readers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((writes, reads, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2, help="writer threads per process")
+    parser.add_argument("--readers", type=int, default=4, help="reader threads per process")
+    parser.add_argument("--rate", type=float, default=100, help="target inserts per second, all processes")
+    parser.add_argument("--read-rate", type=float, default=400, help="target history reads per second")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--profile", choices=["tuned", "legacy"], default="tuned")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    os.environ["CHAT_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["CHAT_SQLITE_PROFILE"] = args.profile
+    prepare_database()
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(i, args, results)) for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    writes, reads, errors = [], [], []
+    for _ in processes:
+        w, r, e = results.get()
+        writes += w
+        reads += r
+        errors += e
+    for process in processes:
+        process.join()
+
+    locked = sum("database is locked" in error for error in errors)
+    writes_per_s = len(writes) / args.seconds
+    results = {
+        "profile": args.profile,
+        "target_writes_per_s": args.rate,
+        "writes_per_s": round(writes_per_s, 1),
+        "reads_per_s": round(len(reads) / args.seconds, 1),
+        "write_latency": summarize_ms(writes),
+        "read_latency": summarize_ms(reads),
+        "errors": len(errors),
+        "locked_errors": locked,
+        "first_errors": sorted(set(errors))[:3],
+    }
+    report("sqlite_stress", results)
+    if errors or writes_per_s < 0.95 * args.rate:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
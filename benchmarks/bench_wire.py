@@ -0,0 +1,103 @@
+# Размер кадра и CPU сервера на рассылку для JSON и компактной кодировки (wire_format).
+# CPU считается по process_time: сериализация, перекодирование и работа писателей очередей.
+#
+#   python -m benchmarks.bench_wire --members 1000 --messages 500
+import argparse
+import asyncio
+import datetime
+import os
+import tempfile
+import time
+
+from benchmarks.common import report
+
+GROUP_ID = 1
+
+
+class NullWebSocket:
+    def __init__(self):
+        self.bytes = 0
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, data: str):
+        self.bytes += len(data.encode())
+
+
+def sample_frames(content_length: int):
+    from main import message_to_dict
+    from membership_cache import CachedUser
+    from models import Message
+
+    author = CachedUser(id=42, username="alexander", avatar="/images/avatars/42.png")
+    msg = Message(id=1234567, content="п" * content_length, author_id=author.id, group_id=GROUP_ID,
+                  recipient_id=None, timestamp=datetime.datetime.now(), edited=0)
+    data = message_to_dict(msg, author)
+    return {
+        "new_message": {"type": "new_message", "data": data},
+        "updated_message": {"type": "updated_message", "data": dict(data, edited=1)},
+        "deleted_message": {"type": "deleted_message", "data": {"id": data["id"], "group_id": GROUP_ID}},
+        "group_update": {"type": "group_update", "data": {"group_id": GROUP_ID, "name": "Команда", "action": "created"}},
+    }
+
+
+def frame_sizes(frames: dict):
+    from websocket_manager import encode_message
+    from wire_format import compact_from_json
+
+    sizes = {}
+    for kind, frame in frames.items():
+        payload = encode_message(frame)
+        json_bytes = len(payload.encode())
+        compact_bytes = len(compact_from_json(payload).encode())
+        sizes[kind] = {"json": json_bytes, "compact": compact_bytes,
+                       "saved_pct": round(100 * (1 - compact_bytes / json_bytes), 1)}
+    return sizes
+
+
+async def broadcast_cpu(frame: dict, members: int, messages: int, encoding: str):
+    from websocket_manager import ConnectionManager
+
+    manager = ConnectionManager(max_backlog=messages + 1)
+    sockets = [NullWebSocket() for _ in range(members)]
+    for ws in sockets:
+        await manager.connect(ws, GROUP_ID, encoding=encoding)
+    started = time.process_time()
+    for _ in range(messages):
+        await manager.broadcast_to_group(frame, GROUP_ID)
+        # Даём писателям отправить кадр, как между сообщениями в живом чате
+        await asyncio.sleep(0)
+    while any(not c.queue.empty() for c in manager.all_connections.values()):
+        await asyncio.sleep(0)
+    elapsed = time.process_time() - started
+    for connection in list(manager.all_connections.values()):
+        manager.remove(connection)
+    return {
+        "cpu_ms_per_broadcast": round(elapsed / messages * 1000, 3),
+        "bytes_per_broadcast": sum(ws.bytes for ws in sockets) // messages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--content", type=int, default=40, help="message length in characters")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    os.environ["CHAT_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    frames = sample_frames(args.content)
+    results = {"frame_bytes": frame_sizes(frames), "members": args.members}
+    for encoding in ("json", "compact"):
+        results[encoding] = asyncio.run(broadcast_cpu(frames["new_message"], args.members, args.messages, encoding))
+    report("wire_format", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# Проверка согласованности производных данных после изменений: прогоняет сценарии через
+# настоящее приложение (TestClient) на временной базе и сверяет счётчики, сводки и историю
+# с тем, что должен видеть клиент. Завершается с кодом 1, если какой-то сценарий не сошёлся.
+#
+#   python -m benchmarks.check_consistency
+import datetime
+import os
+import sys
+import tempfile
+from typing import Callable, List
+
+from benchmarks.common import report
+
+CHECKS: List[Callable] = []
+
+
+def check(fn: Callable) -> Callable:
+    CHECKS.append(fn)
+    return fn
+
+
+class Scenario:
+    """Users with tokens on one TestClient; each check creates its own groups."""
+
+    def __init__(self, client, prefix: str):
+        self.client = client
+        self.prefix = prefix
+        self.headers = {}
+        self.ids = {}
+
+    def user(self, name: str) -> dict:
+        username = f"{self.prefix}_{name}"
+        response = self.client.post("/users", json={"username": username, "password": "p"})
+        self.ids[name] = response.json()["id"]
+        token = self.client.post("/login", json={"username": username, "password": "p"}).json()["access_token"]
+        self.headers[name] = {"Authorization": f"Bearer {token}"}
+        return self.headers[name]
+
+    def group(self, owner: str, name: str, members=()) -> int:
+        group_id = self.client.post("/groups", json={"name": f"{self.prefix}_{name}"},
+                                    headers=self.headers[owner]).json()["id"]
+        for member in members:
+            self.client.post(f"/groups/{group_id}/add_user?user_id={self.ids[member]}", headers=self.headers[owner])
+        return group_id
+
+    def post(self, author: str, group_id: int, content: str) -> int:
+        return self.client.post("/messages", json={"content": content, "group_id": group_id},
+                                headers=self.headers[author]).json()["id"]
+
+    def chat(self, user: str, group_id: int) -> dict:
+        chats = self.client.get("/chats", headers=self.headers[user]).json()
+        return next(chat for chat in chats if chat["id"] == group_id)
+
+
+@check
+def unread_after_delete(client):
+    s = Scenario(client, "unread_delete")
+    s.user("a")
+    s.user("b")
+    group_id = s.group("a", "g", members=("b",))
+    ids = [s.post("a", group_id, f"m{i}") for i in range(3)]
+    client.delete(f"/messages/{ids[1]}", headers=s.headers["a"])
+    unread = s.chat("b", group_id)["unread_count"]
+    assert unread == 2, f"b has {unread} unread after 1 of 3 messages was deleted"
+    assert s.chat("a", group_id)["unread_count"] == 0, "the author's own messages count as unread"
+
+
+@check
+def unread_counters(client):
+    s = Scenario(client, "unread_counters")
+    s.user("a")
+    s.user("b")
+    group_id = s.group("a", "g")
+    s.post("a", group_id, "before b joined")
+    client.post(f"/groups/{group_id}/add_user?user_id={s.ids['b']}", headers=s.headers["a"])
+    assert s.chat("b", group_id)["unread_count"] == 0, "history before joining counts as unread"
+
+    ids = [s.post("a", group_id, f"m{i}") for i in range(4)]
+    s.post("b", group_id, "reply")
+    assert s.chat("b", group_id)["unread_count"] == 4
+    assert s.chat("a", group_id)["unread_count"] == 1
+
+    read = client.post(f"/chats/{group_id}/read?message_id={ids[1]}", headers=s.headers["b"]).json()
+    assert read["unread_count"] == 2, f"read up to the 2nd of 4 messages leaves {read['unread_count']} unread"
+    assert s.chat("b", group_id)["unread_count"] == 2
+
+    # Уже прочитанное удаление не меняет, непрочитанное — уменьшает
+    client.delete(f"/messages/{ids[0]}", headers=s.headers["a"])
+    assert s.chat("b", group_id)["unread_count"] == 2, "deleting a read message changed unread"
+    client.delete(f"/messages/{ids[3]}", headers=s.headers["a"])
+    assert s.chat("b", group_id)["unread_count"] == 1, "deleting an unread message did not lower unread"
+    assert s.chat("a", group_id)["unread_count"] == 1
+
+    client.post(f"/chats/{group_id}/read", headers=s.headers["b"])
+    assert s.chat("b", group_id)["unread_count"] == 0
+
+
+@check
+def unread_after_delete_before_joining(client):
+    s = Scenario(client, "unread_joined")
+    s.user("a")
+    s.user("b")
+    group_id = s.group("a", "g")
+    ids = [s.post("a", group_id, f"m{i}") for i in range(3)]
+    client.post(f"/groups/{group_id}/add_user?user_id={s.ids['b']}", headers=s.headers["a"])
+    # Сообщение из истории до вступления b удаляется — непрочитанное b не меняется
+    client.delete(f"/messages/{ids[0]}", headers=s.headers["a"])
+    s.post("a", group_id, "after b joined")
+    unread = s.chat("b", group_id)["unread_count"]
+    assert unread == 1, f"b has {unread} unread after 1 new message"
+
+
+@check
+def post_after_archiving_group(client):
+    import main as app
+    from retention import RetentionPolicy, compact_group
+
+    s = Scenario(client, "archive_all")
+    s.user("a")
+    group_id = s.group("a", "g")
+    archived = [s.post("a", group_id, f"old{i}") for i in range(3)]
+    # Вся история группы уходит в архив, как это сделал бы фон retention через два дня
+    later = datetime.datetime.now() + datetime.timedelta(days=2)
+    client.portal.call(app.run_db, compact_group, group_id, RetentionPolicy(archive_after_days=1), later)
+    client.portal.call(app.forget_recent, group_id)
+
+    new_id = s.post("a", group_id, "new")
+    assert new_id > max(archived), f"new message got id {new_id}, archived ids are {archived}"
+    history = client.get(f"/messages?group_id={group_id}", headers=s.headers["a"]).json()["messages"]
+    assert [m["id"] for m in history] == archived + [new_id], f"history is {[m['id'] for m in history]}"
+    last = s.chat("a", group_id)["last_message"]
+    assert last["id"] == new_id and last["preview"] == "new", f"chat list shows {last}"
+
+
+@check
+def group_id_after_purge(client):
+    import main as app
+    from retention import purge_deleted_groups
+
+    s = Scenario(client, "group_reuse")
+    s.user("a")
+    deleted = s.group("a", "old")
+    s.post("a", deleted, "history of the deleted group")
+    client.delete(f"/groups/{deleted}", headers=s.headers["a"])
+    client.portal.call(app.run_db, purge_deleted_groups)
+
+    created = s.group("a", "new")
+    assert created != deleted, f"new group reused id {deleted} of a deleted group"
+    history = client.get(f"/messages?group_id={created}", headers=s.headers["a"]).json()["messages"]
+    assert history == [], f"new group shows {len(history)} messages"
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="chat-consistency-")
+    os.environ["CHAT_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'consistency.db')}"
+    os.environ["CHAT_ARCHIVE_DIR"] = os.path.join(workdir, "archive")
+    os.environ["CHAT_MEDIA_DIR"] = os.path.join(workdir, "media")
+    os.environ.setdefault("CHAT_RATE_USER", "0")
+    os.environ.setdefault("CHAT_PRESENCE", "0")
+
+    from fastapi.testclient import TestClient
+    import main as app_module
+
+    results, failed = {}, False
+    with TestClient(app_module.app) as client:
+        for fn in CHECKS:
+            try:
+                fn(client)
+                results[fn.__name__] = "ok"
+            except AssertionError as e:
+                results[fn.__name__] = f"FAILED: {e}"
+                failed = True
+    report("consistency", results)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# Проверка планов горячих запросов: выполняет настоящие функции приложения (участники,
+# история, личные сообщения, список чатов, поиск, запись сообщений, докачка событий,
+# прочтение, архив и очистка удалённых групп), перехватывает их SQL и прогоняет через EXPLAIN QUERY PLAN на схеме после всех
+# миграций. Завершается с кодом 1, если какой-то запрос читает таблицу целиком (SCAN)
+# вместо поиска по индексу.
+#
+#   python -m benchmarks.check_query_plans
+#   python -m benchmarks.check_query_plans --verbose
+import argparse
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+from contextlib import contextmanager
+
+from benchmarks.common import report
+
+USERS = 3
+MESSAGES = 20
+
+captured = []
+current_label = [None]
+
+
+@contextmanager
+def label(name: str):
+    current_label[0] = name
+    try:
+        yield
+    finally:
+        current_label[0] = None
+
+
+def capture(conn, cursor, statement, parameters, context, executemany):
+    if current_label[0] is None:
+        return
+    if statement.lstrip().split(None, 1)[0].upper() not in ("SELECT", "UPDATE", "DELETE"):
+        return
+    if executemany:
+        parameters = parameters[0]
+    captured.append((current_label[0], statement, parameters))
+
+
+def run_hot_paths():
+    from database import ReadSessionLocal, SessionLocal
+    from chat_list import apply_reads, message_deleted, read_watermarks, user_chats
+    from main import (_add_user_to_group, _create_group, _create_private_chat, _delete_group, _get_direct_page,
+                      _get_messages_page, _search_messages)
+    from membership_cache import membership
+    from message_log import events_since
+    from message_writer import insert_message, insert_messages
+    from models import User
+    from retention import RetentionPolicy, compact_group, purge_deleted_groups
+    from schemas import GroupCreate, PrivateChatCreate
+    from search import match_query, search_message_ids
+
+    db = SessionLocal()
+    for user_id in range(1, USERS + 1):
+        db.add(User(id=user_id, username=f"user{user_id}", password="x"))
+    db.commit()
+    group_id = _create_group(db, GroupCreate(name="plans"), 1).id
+
+    future = datetime.datetime.now() + datetime.timedelta(days=2)
+
+    def row(i):
+        return {"content": f"plan check message {i}", "author_id": 1, "group_id": group_id,
+                "recipient_id": None, "timestamp": datetime.datetime.now(), "edited": 0}
+
+    with label("add member"):
+        _add_user_to_group(db, group_id, 2)
+    with label("insert message"):
+        last_id, _ = insert_message(db, row(0))
+    with label("insert message batch"):
+        insert_messages(db, [dict(row(i), id=last_id + i) for i in range(1, MESSAGES)])
+        last_id += MESSAGES - 1
+    with label("delete last message"):
+        message_deleted(db, group_id, last_id, 1)
+        db.commit()
+    with label("direct message"):
+        insert_message(db, dict(row(0), group_id=None, recipient_id=3))
+    with label("open private chat"):
+        _create_private_chat(db, PrivateChatCreate(user_id=1, recipient_id=3))
+        _create_private_chat(db, PrivateChatCreate(user_id=3, recipient_id=1))
+    with label("mark read"):
+        apply_reads(db, {(group_id, 2): last_id - 5, (group_id, 1): None})
+    db.close()
+
+    db = ReadSessionLocal()
+    query = match_query("plan mess")
+    with label("group members"):
+        membership.load_members(db, group_id)
+    with label("user"):
+        membership.load_user(db, 1)
+    with label("history latest page"):
+        _get_messages_page(db, group_id, None, None, 50)
+    with label("history before cursor"):
+        _get_messages_page(db, group_id, last_id, None, 50)
+    with label("history after cursor"):
+        _get_messages_page(db, group_id, None, last_id - 5, 50)
+    with label("direct history"):
+        _get_direct_page(db, 3, 1, None, 50)
+        _get_direct_page(db, 1, 3, last_id + 10, 50)
+    with label("chat list"):
+        user_chats(db, 2)
+    with label("search all groups"):
+        search_message_ids(db, 2, query, None, 0, 20, "rank")
+        _search_messages(db, 2, query, None, 0, 20, "recent")
+    with label("search one group"):
+        search_message_ids(db, 2, query, group_id, 0, 20, "rank")
+    with label("read watermarks"):
+        read_watermarks(db, group_id)
+    with label("resume from seq"):
+        events_since(db, group_id, 5)
+    db.close()
+
+    # Отдельная группа, вся история которой уходит в архив, а потом группа удаляется
+    db = SessionLocal()
+    archived_id = _create_group(db, GroupCreate(name="archived"), 1).id
+    insert_messages(db, [dict(row(i), id=last_id + 100 + i, group_id=archived_id) for i in range(MESSAGES)])
+    with label("retention batch"):
+        compact_group(db, archived_id, RetentionPolicy(archive_after_days=1), future)
+    db.close()
+    db = ReadSessionLocal()
+    with label("archived history"):
+        _get_messages_page(db, archived_id, None, None, 10)
+        _get_messages_page(db, archived_id, None, last_id + 100, 10)
+    db.close()
+    db = SessionLocal()
+    _delete_group(db, archived_id, 1)
+    with label("purge deleted group"):
+        purge_deleted_groups(db)
+    db.close()
+
+
+def full_scans(plan):
+    # SCAN по виртуальной FTS-таблице — это обход её собственного индекса
+    return [detail for detail in plan
+            if detail.startswith("SCAN ") and "VIRTUAL TABLE" not in detail and detail != "SCAN CONSTANT ROW"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--verbose", action="store_true", help="print every plan, not only full scans")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-plans-")
+    path = os.path.join(workdir, "plans.db")
+    os.environ["CHAT_DATABASE_URL"] = f"sqlite:///{path}"
+
+    from sqlalchemy import event
+    from database import engine, read_engine
+
+    for target in {engine, read_engine}:
+        event.listen(target, "before_cursor_execute", capture)
+    run_hot_paths()
+
+    conn = sqlite3.connect(path)
+    checked, failures, plans = set(), [], {}
+    for name, statement, parameters in captured:
+        if statement in checked:
+            continue
+        checked.add(statement)
+        plan = [detail for _, _, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+        scans = full_scans(plan)
+        if scans:
+            failures.append({"query": name, "sql": " ".join(statement.split()), "scans": scans})
+        if args.verbose or scans:
+            plans.setdefault(name, []).append(plan)
+    report("query_plans", {"statements": len(checked), "full_scans": failures, "plans": plans})
+    if not captured or failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
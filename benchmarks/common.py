@@ -0,0 +1,27 @@
+# Общие утилиты для бенчмарков: запускать из корня репозитория, например
+#   python -m benchmarks.bench_fanout
+import json
+import math
+from typing import Dict, List
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def summarize_ms(values: List[float]) -> Dict[str, float]:
+    # values в секундах -> сводка в миллисекундах
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(max(values) * 1000, 3) if values else 0.0,
+    }
+
+
+def report(name: str, results: Dict):
+    print(json.dumps({"benchmark": name, "results": results}, indent=2, ensure_ascii=False))
@@ -0,0 +1,83 @@
+# Сравнение двух JSON-результатов (loadtest или любого бенчмарка с report(...)): печатает
+# изменения по всем числовым показателям и завершается с кодом 1 при регрессии больше порога.
+# Направление берётся из имени: *_ms, *_kb, *_per_message, errors.* — меньше лучше,
+# *_per_s, delivery_ratio — больше лучше, остальное выводится для справки, если изменилось.
+#
+#   python -m benchmarks.compare before.json after.json --threshold 10
+import argparse
+import json
+import sys
+
+
+def flatten(value, prefix: str = ""):
+    if isinstance(value, dict):
+        items = {}
+        for key, child in value.items():
+            items.update(flatten(child, f"{prefix}.{key}" if prefix else str(key)))
+        return items
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def direction(key: str) -> int:
+    # -1: меньше лучше, +1: больше лучше, 0: не сравниваем
+    leaf = key.rsplit(".", 1)[-1]
+    if key.startswith("params.") or leaf == "count":
+        return 0
+    if key.startswith("errors.") or leaf.endswith(("_ms", "_kb", "_per_message")):
+        return -1
+    if leaf.endswith("_per_s") or leaf == "delivery_ratio":
+        return 1
+    return 0
+
+
+def load(path: str) -> dict:
+    with open(path) as source:
+        data = json.load(source)
+    return flatten(data.get("results", data))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent")
+    parser.add_argument("--min-ms", type=float, default=0.5,
+                        help="ignore latency changes smaller than this, in milliseconds")
+    parser.add_argument("--min-count", type=int, default=20,
+                        help="ignore latency percentiles computed from fewer samples")
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    regressions = []
+    for key in sorted(set(baseline) & set(candidate)):
+        before, after = baseline[key], candidate[key]
+        sign = direction(key)
+        if not sign and before == after:
+            continue
+        # Перцентили по нескольким замерам — шум, а не регрессия
+        count_key = key.rsplit(".", 1)[0] + ".count"
+        if key.endswith("_ms") and min(baseline.get(count_key, args.min_count),
+                                       candidate.get(count_key, args.min_count)) < args.min_count:
+            sign = 0
+        change = (after - before) / abs(before) * 100 if before else (0.0 if after == before else float("inf"))
+        status = ""
+        if sign and after != before:
+            worse = (after - before) * sign < 0
+            noise = key.endswith("_ms") and abs(after - before) < args.min_ms
+            if worse and abs(change) > args.threshold and not noise:
+                status = "REGRESSION"
+                regressions.append(key)
+            elif not worse and abs(change) > args.threshold:
+                status = "improved"
+        print(f"{key:55s} {before:>12g} {after:>12g} {change:+8.1f}%  {status}")
+    for key in sorted(set(baseline) ^ set(candidate)):
+        print(f"{key:55s} only in {'baseline' if key in baseline else 'candidate'}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
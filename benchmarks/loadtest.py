@@ -0,0 +1,411 @@
+# Нагрузочный прогон всего сервера: тысячи пользователей логинятся, читают /chats и историю,
+# держат по сокету /ws, пишут сообщения, правят и удаляют свои. Сервер поднимается на
+# одноразовой SQLite-базе: в этом же процессе (uvicorn.Server в том же event loop) или
+# отдельным процессом uvicorn. Результат — JSON, который сравнивается между коммитами:
+#
+#   python -m benchmarks.loadtest --scenario chat --output before.json
+#   python -m benchmarks.loadtest --scenario chat --server uvicorn --output after.json
+#   python -m benchmarks.compare before.json after.json
+#
+# Память на соединение — прирост RSS сервера после открытия сокетов; в режиме inprocess
+# туда входят и клиентские сокеты, точная цифра — в режиме uvicorn.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+from benchmarks.common import report, summarize_ms
+
+# Частоты действий — на одного пользователя в секунду
+SCENARIOS = {
+    # Быстрая проверка, что харнесс и сервер живы
+    "smoke": dict(users=50, groups=5, group_size=10, seconds=10, history=20,
+                  message_rate=0.2, history_rate=0.05, chats_rate=0.05, read_rate=0.05,
+                  edit_rate=0.02, delete_rate=0.01),
+    # Много небольших групп, обычная переписка
+    "chat": dict(users=1000, groups=100, group_size=20, seconds=30, history=200,
+                 message_rate=0.05, history_rate=0.02, chats_rate=0.02, read_rate=0.02,
+                 edit_rate=0.005, delete_rate=0.002),
+    # Одна большая группа: стоимость рассылки
+    "fanout": dict(users=2000, groups=1, group_size=2000, seconds=30, history=200,
+                   message_rate=0.002, history_rate=0.001, chats_rate=0.001, read_rate=0.005,
+                   edit_rate=0.0, delete_rate=0.0),
+    # Открытие чатов и листание истории преобладают над записью
+    "readheavy": dict(users=1000, groups=100, group_size=20, seconds=30, history=1000,
+                      message_rate=0.01, history_rate=0.2, chats_rate=0.1, read_rate=0.05,
+                      edit_rate=0.001, delete_rate=0.0),
+}
+ACTIONS = ("message", "history", "chats", "read", "edit", "delete")
+# Одновременных логинов и подключений сокетов при разгоне
+RAMP_CONCURRENCY = 50
+# Сколько ждать доставки последних сообщений после окончания прогона, секунды
+DRAIN_SECONDS = 2.0
+PASSWORD = "loadtest"
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def raise_fd_limit():
+    # Тысячи сокетов с обеих сторон (в режиме inprocess — в одном процессе)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def group_members(params: dict):
+    # Участники групп пересекаются, если групп * размер > пользователей
+    users, groups, size = params["users"], params["groups"], params["group_size"]
+    stride = max(1, users // groups)
+    return {group_id: sorted({((group_id - 1) * stride + k) % users + 1 for k in range(size)})
+            for group_id in range(1, groups + 1)}
+
+
+def seed_database(params: dict, members: dict):
+    # Пользователи, группы и история пишутся напрямую, минуя HTTP: подготовка не входит в замер
+    import datetime
+    from sqlalchemy import insert
+    from database import SessionLocal, engine
+    from models import ChatSummary, Group, GroupUser, Message, User
+
+    db = SessionLocal()
+    db.execute(insert(User), [{"id": user_id, "username": f"load{user_id}", "password": PASSWORD}
+                              for user_id in range(1, params["users"] + 1)])
+    db.execute(insert(Group), [{"id": group_id, "name": f"load group {group_id}", "type": "group"}
+                               for group_id in members])
+    db.execute(insert(GroupUser), [{"group_id": group_id, "user_id": user_id}
+                                   for group_id, user_ids in members.items() for user_id in user_ids])
+    now = datetime.datetime.now()
+    rows = [{"content": f"history {i} in group {group_id}", "author_id": user_ids[i % len(user_ids)],
+             "group_id": group_id, "timestamp": now, "edited": 0}
+            for group_id, user_ids in members.items() for i in range(params["history"])]
+    if rows:
+        db.execute(insert(Message), rows)
+    db.execute(insert(ChatSummary), [{"group_id": group_id, "member_count": len(user_ids), "last_activity": now}
+                                     for group_id, user_ids in members.items()])
+    db.commit()
+    db.close()
+    engine.dispose()
+
+
+def parse_metrics(text: str) -> dict:
+    # Только суммарные счётчики, которые нужны отчёту
+    totals = defaultdict(float)
+    for line in text.splitlines():
+        match = re.match(r"^(chat_db_query_duration_seconds_count|chat_http_requests_total)(\{.*\})? (\S+)$", line)
+        if match:
+            totals[match.group(1)] += float(match.group(3))
+    return totals
+
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sent = 0
+        self.expected_deliveries = 0
+        self.deliveries = 0
+
+    def timed(self, op: str, started: float, ok: bool):
+        if ok:
+            self.latency[op].append(time.perf_counter() - started)
+        else:
+            self.errors[op] += 1
+
+
+class SimulatedUser:
+    def __init__(self, user_id: int, groups: list, params: dict, stats: Stats, rng: random.Random):
+        self.user_id = user_id
+        self.groups = groups
+        self.params = params
+        self.stats = stats
+        self.rng = rng
+        self.token = None
+        self.ws = None
+        self.reader = None
+        # Id своих сообщений (из эха рассылки) — для правки и удаления
+        self.own_messages = deque(maxlen=50)
+        self.seq = 0
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def login(self, http):
+        started = time.perf_counter()
+        response = await http.post("/login", json={"username": f"load{self.user_id}", "password": PASSWORD})
+        self.stats.timed("login", started, response.status_code == 200)
+        if response.status_code == 200:
+            self.token = response.json()["access_token"]
+
+    async def connect(self, base_ws: str):
+        from websockets.asyncio.client import connect
+
+        started = time.perf_counter()
+        try:
+            self.ws = await connect(f"{base_ws}/ws?token={self.token}", ping_interval=None, max_queue=None)
+            await self.ws.send(json.dumps({"type": "subscribe", "group_ids": self.groups}))
+            while json.loads(await self.ws.recv()).get("type") != "subscribed":
+                pass
+        except Exception:
+            self.stats.errors["ws_connect"] += 1
+            if self.ws is not None:
+                await self.ws.close()
+                self.ws = None
+            return
+        self.stats.latency["ws_connect"].append(time.perf_counter() - started)
+        self.reader = asyncio.create_task(self.read_frames())
+
+    async def read_frames(self):
+        try:
+            async for raw in self.ws:
+                frame = json.loads(raw)
+                if frame.get("type") != "new_message":
+                    continue
+                data = frame["data"]
+                marker = data["content"].rsplit(" ", 1)[-1]
+                if data["content"].startswith("lt "):
+                    self.stats.deliveries += 1
+                    self.stats.latency["delivery"].append(time.perf_counter() - float(marker))
+                if data["author_id"] == self.user_id:
+                    self.own_messages.append(data["id"])
+        except Exception:
+            pass
+
+    async def run(self, http, deadline: float):
+        weights = [self.params[f"{action}_rate"] for action in ACTIONS]
+        total_rate = sum(weights)
+        if total_rate <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.rng.expovariate(total_rate))
+            if time.perf_counter() >= deadline:
+                return
+            action = self.rng.choices(ACTIONS, weights)[0]
+            try:
+                await getattr(self, f"do_{action}")(http)
+            except Exception:
+                self.stats.errors[action] += 1
+
+    async def do_message(self, http):
+        if self.ws is None:
+            return
+        group_id = self.rng.choice(self.groups)
+        self.seq += 1
+        # Время отправки в конце текста: получатели считают по нему задержку доставки
+        content = f"lt {self.user_id}.{self.seq} {time.perf_counter()!r}"
+        await self.ws.send(json.dumps({"type": "message", "group_id": group_id, "content": content}))
+        self.stats.sent += 1
+        self.stats.expected_deliveries += self.params["group_members"][group_id]
+
+    async def do_history(self, http):
+        started = time.perf_counter()
+        response = await http.get("/messages", params={"group_id": self.rng.choice(self.groups)})
+        self.stats.timed("history", started, response.status_code == 200)
+
+    async def do_chats(self, http, op: str = "chats"):
+        started = time.perf_counter()
+        response = await http.get("/chats", headers=self.headers)
+        self.stats.timed(op, started, response.status_code == 200)
+
+    async def do_read(self, http):
+        started = time.perf_counter()
+        response = await http.post(f"/chats/{self.rng.choice(self.groups)}/read", headers=self.headers)
+        self.stats.timed("read", started, response.status_code == 200)
+
+    async def do_edit(self, http):
+        if not self.own_messages:
+            return
+        started = time.perf_counter()
+        message_id = self.rng.choice(self.own_messages)
+        response = await http.put(f"/messages/{message_id}", json={"content": f"edited {message_id}"},
+                                  headers=self.headers)
+        self.stats.timed("edit", started, response.status_code == 200)
+
+    async def do_delete(self, http):
+        if not self.own_messages:
+            return
+        started = time.perf_counter()
+        response = await http.delete(f"/messages/{self.own_messages.pop()}", headers=self.headers)
+        self.stats.timed("delete", started, response.status_code == 200)
+
+
+async def limited(semaphore: asyncio.Semaphore, stats: Stats, op: str, coroutine):
+    # Ошибка одного пользователя при разгоне — в отчёт, а не остановка всего прогона
+    async with semaphore:
+        try:
+            await coroutine
+        except Exception:
+            stats.errors[op] += 1
+
+
+async def start_server(mode: str, port: int, env: dict):
+    if mode == "uvicorn":
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"], env=env
+        )
+        return process, process.pid
+    import uvicorn
+    from main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    return (server, task), os.getpid()
+
+
+async def stop_server(mode: str, handle):
+    if mode == "uvicorn":
+        handle.terminate()
+        await asyncio.get_running_loop().run_in_executor(None, handle.wait)
+        return
+    server, task = handle
+    server.should_exit = True
+    await task
+
+
+async def wait_ready(http, timeout: float = 30):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            if (await http.get("/metrics")).status_code == 200:
+                return
+        except Exception:
+            pass
+        if time.perf_counter() > deadline:
+            raise RuntimeError("Server did not start")
+        await asyncio.sleep(0.1)
+
+
+async def run(args, params: dict) -> dict:
+    import httpx
+
+    members = group_members(params)
+    params["group_members"] = {group_id: len(user_ids) for group_id, user_ids in members.items()}
+    user_groups = defaultdict(list)
+    for group_id, user_ids in members.items():
+        for user_id in user_ids:
+            user_groups[user_id].append(group_id)
+
+    started = time.perf_counter()
+    seed_database(params, members)
+    seed_s = time.perf_counter() - started
+
+    port = free_port()
+    handle, server_pid = await start_server(args.server, port, dict(os.environ))
+    stats = Stats()
+    rng = random.Random(args.seed)
+    users = [SimulatedUser(user_id, user_groups[user_id], params, stats, random.Random(rng.random()))
+             for user_id in sorted(user_groups)]
+    limits = httpx.Limits(max_connections=RAMP_CONCURRENCY * 2, max_keepalive_connections=RAMP_CONCURRENCY * 2)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as http:
+            await wait_ready(http)
+            semaphore = asyncio.Semaphore(RAMP_CONCURRENCY)
+            await asyncio.gather(*(limited(semaphore, stats, "login", user.login(http)) for user in users))
+            # Открытие приложения всеми сразу — отдельно от /chats во время прогона
+            await asyncio.gather(*(limited(semaphore, stats, "chats_open", user.do_chats(http, "chats_open"))
+                                   for user in users))
+
+            rss_before = rss_kb(server_pid)
+            await asyncio.gather(*(limited(semaphore, stats, "ws_connect", user.connect(f"ws://127.0.0.1:{port}"))
+                                   for user in users))
+            connected = sum(user.ws is not None for user in users)
+            rss_after = rss_kb(server_pid)
+
+            metrics_before = parse_metrics((await http.get("/metrics")).text)
+            run_started = time.perf_counter()
+            await asyncio.gather(*(user.run(http, run_started + params["seconds"]) for user in users))
+            elapsed = time.perf_counter() - run_started
+            await asyncio.sleep(DRAIN_SECONDS)
+            metrics_after = parse_metrics((await http.get("/metrics")).text)
+
+            for user in users:
+                if user.ws is not None:
+                    await user.ws.close()
+                    user.reader.cancel()
+    finally:
+        await stop_server(args.server, handle)
+
+    db_ops = metrics_after["chat_db_query_duration_seconds_count"] - metrics_before["chat_db_query_duration_seconds_count"]
+    # Без двух опросов /metrics вокруг прогона
+    http_requests = metrics_after["chat_http_requests_total"] - metrics_before["chat_http_requests_total"] - 1
+    actions = sum(len(stats.latency.get(op, ())) + stats.errors.get(op, 0) for op in ACTIONS) + stats.sent
+    return {
+        "scenario": args.scenario,
+        "server": args.server,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "params": {key: value for key, value in params.items() if key != "group_members"},
+        "seed_s": round(seed_s, 2),
+        "connected": connected,
+        "throughput": {
+            "messages_per_s": round(stats.sent / elapsed, 1),
+            "deliveries_per_s": round(stats.deliveries / elapsed, 1),
+            "http_requests_per_s": round(http_requests / elapsed, 1),
+            "actions_per_s": round(actions / elapsed, 1),
+        },
+        "delivery_ratio": round(stats.deliveries / stats.expected_deliveries, 4) if stats.expected_deliveries else None,
+        "latency": {op: summarize_ms(values) for op, values in sorted(stats.latency.items())},
+        "errors": {op: stats.errors.get(op, 0) for op in ACTIONS + ("login", "chats_open", "ws_connect")},
+        "memory_per_connection_kb": round((rss_after - rss_before) / connected, 1) if connected else None,
+        "db_ops_per_message": round(db_ops / stats.sent, 2) if stats.sent else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="chat")
+    parser.add_argument("--server", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--users", type=int, help="override the scenario's user count")
+    parser.add_argument("--seconds", type=float, help="override the scenario's duration")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    params = dict(SCENARIOS[args.scenario])
+    if args.users:
+        params["users"] = args.users
+        params["group_size"] = min(params["group_size"], args.users)
+    if args.seconds:
+        params["seconds"] = args.seconds
+
+    workdir = tempfile.mkdtemp(prefix="chat-load-")
+    os.environ["CHAT_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    raise_fd_limit()
+    results = asyncio.run(run(args, params))
+    report("loadtest", results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"benchmark": "loadtest", "results": results}, output, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# broker.py
+# Шина между воркерами uvicorn: каждое опубликованное сообщение доставляется
+# обработчику в каждом процессе, а тот уже рассылает его своим локальным сокетам.
+import asyncio
+import fcntl
+import json
+import os
+import struct
+from typing import Callable, Dict, Optional
+
+# "memory" — один процесс, "unix" — несколько воркеров на одной машине
+BROKER_BACKEND = os.environ.get("CHAT_BROKER", "memory")
+BROKER_SOCKET_PATH = os.environ.get("CHAT_BROKER_PATH", "/tmp/chat-broker.sock")
+# Сколько байт может накопиться у отстающего воркера, прежде чем хаб его отключит
+MAX_PEER_BUFFER = 16 * 1024 * 1024
+RECONNECT_DELAY = 0.5
+
+_HEADER = struct.Struct("!I")
+
+Handler = Callable[[str, str], None]
+
+
+class Broker:
+    """Delivers every published (channel, payload) to the handler of every worker, publisher included."""
+
+    def __init__(self):
+        self.handler: Optional[Handler] = None
+
+    def set_handler(self, handler: Handler):
+        self.handler = handler
+
+    async def start(self):
+        pass
+
+    async def publish(self, channel: str, payload: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def _deliver(self, channel: str, payload: str):
+        try:
+            self.handler(channel, payload)
+        except Exception as e:
+            print(f"Broker handler error on {channel}: {e}")
+
+
+class InProcessBroker(Broker):
+    async def publish(self, channel: str, payload: str):
+        self._deliver(channel, payload)
+
+
+def _encode_frame(channel: str, payload: str) -> bytes:
+    body = json.dumps([channel, payload], ensure_ascii=False).encode()
+    return _HEADER.pack(len(body)) + body
+
+
+async def _read_frame(reader: asyncio.StreamReader):
+    header = await reader.readexactly(_HEADER.size)
+    (size,) = _HEADER.unpack(header)
+    channel, payload = json.loads(await reader.readexactly(size))
+    return channel, payload
+
+
+class UnixSocketBroker(Broker):
+    """Local multi-process bus over a Unix socket.
+
+    The worker holding the lock file becomes the hub and relays frames between
+    the others; the rest connect to it as peers. If the hub dies, the lock is
+    released and one of the peers takes its place. Messages published while a
+    worker has no hub are only delivered locally.
+    """
+
+    def __init__(self, path: str = BROKER_SOCKET_PATH):
+        super().__init__()
+        self.path = path
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.peers: Dict[asyncio.StreamWriter, None] = {}
+        self.upstream: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+        self.lock_file = None
+        self.closing = False
+
+    @property
+    def is_hub(self) -> bool:
+        return self.server is not None
+
+    async def start(self):
+        await self._join()
+
+    async def _join(self):
+        while not self.closing:
+            if self._acquire_hub_lock():
+                await self._become_hub()
+                return
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # Хаб ещё поднимается или только что упал
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            self.upstream = writer
+            self.task = asyncio.create_task(self._read_upstream(reader))
+            return
+
+    def _acquire_hub_lock(self) -> bool:
+        # Хабом становится тот, кто держит flock; ОС снимет его, если процесс умрёт
+        if self.lock_file is None:
+            self.lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    async def _become_hub(self):
+        try:
+            # Сокет-файл мог остаться от упавшего хаба
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.server = await asyncio.start_unix_server(self._serve_peer, self.path)
+        print(f"Broker hub listening on {self.path} (pid {os.getpid()})")
+
+    async def _read_upstream(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                channel, payload = await _read_frame(reader)
+                self._deliver(channel, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.upstream = None
+        if not self.closing:
+            print("Broker hub connection lost, rejoining")
+            await asyncio.sleep(RECONNECT_DELAY)
+            await self._join()
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.peers[writer] = None
+        try:
+            while True:
+                channel, payload = await _read_frame(reader)
+                self._deliver(channel, payload)
+                self._relay(_encode_frame(channel, payload), exclude=writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.peers.pop(writer, None)
+            writer.close()
+
+    def _relay(self, frame: bytes, exclude: Optional[asyncio.StreamWriter] = None):
+        for peer in list(self.peers):
+            if peer is exclude:
+                continue
+            if peer.transport.get_write_buffer_size() > MAX_PEER_BUFFER:
+                print("Broker peer is too far behind, disconnecting it")
+                self.peers.pop(peer, None)
+                peer.close()
+                continue
+            peer.write(frame)
+
+    async def publish(self, channel: str, payload: str):
+        # Своим сокетам доставляем сразу, остальным воркерам — через хаб
+        self._deliver(channel, payload)
+        frame = _encode_frame(channel, payload)
+        if self.is_hub:
+            self._relay(frame)
+        elif self.upstream is not None:
+            upstream = self.upstream
+            try:
+                upstream.write(frame)
+                await upstream.drain()
+            except ConnectionError as e:
+                # Хаб упал: запись уже в БД и своим сокетам доставлена, ошибку отправителю не отдаём.
+                # Закрытие будит _read_upstream — он переподключится или станет хабом сам
+                print(f"Broker hub unreachable, {channel} delivered locally only: {e}")
+                if self.upstream is upstream:
+                    self.upstream = None
+                upstream.close()
+
+    async def close(self):
+        self.closing = True
+        if self.task is not None:
+            self.task.cancel()
+        if self.upstream is not None:
+            self.upstream.close()
+        for peer in list(self.peers):
+            peer.close()
+        if self.server is not None:
+            self.server.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        if self.lock_file is not None:
+            self.lock_file.close()
+
+
+def create_broker() -> Broker:
+    if BROKER_BACKEND == "unix":
+        return UnixSocketBroker()
+    if BROKER_BACKEND == "memory":
+        return InProcessBroker()
+    raise ValueError(f"Unknown CHAT_BROKER backend: {BROKER_BACKEND}")
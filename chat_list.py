@@ -0,0 +1,224 @@
+# chat_list.py
+# Материализованный список чатов: сводка по группе (chat_summaries) обновляется в той же
+# транзакции, что и сообщения/состав группы, и отдаётся GET /chats одним запросом.
+# Непрочитанное участника — chat_summaries.message_count - group_users.read_count: новое
+# сообщение увеличивает счётчик группы, а строки участников трогает только у авторов.
+# Прочтение сдвигает водяной знак участника (group_users.last_read_id) и пересчитывает
+# непрочитанное от него (apply_reads, пакетами из read_receipts.py).
+import datetime
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import case, func, select, update
+from sqlalchemy.orm import Session
+from models import ChatSummary, Group, GroupUser, Message, User
+
+# Сколько символов последнего сообщения показываем в списке чатов
+PREVIEW_LENGTH = 100
+
+
+def _preview(content: str) -> str:
+    return content[:PREVIEW_LENGTH]
+
+
+def create_summary(db: Session, group_id: int, member_count: int):
+    db.add(ChatSummary(group_id=group_id, member_count=member_count, last_activity=datetime.datetime.now()))
+
+
+def add_members(db: Session, group_id: int, count: int = 1):
+    db.execute(
+        update(ChatSummary)
+        .where(ChatSummary.group_id == group_id)
+        .values(member_count=ChatSummary.member_count + count)
+    )
+
+
+def read_position(db: Session, group_id: int) -> Tuple[int, Optional[int]]:
+    # (read_count, last_read_id) нового участника: история до вступления прочитана — и для
+    # счётчика, и для водяного знака, по которому message_deleted решает, чьё непрочитанное уменьшать
+    summary = db.query(ChatSummary.message_count, ChatSummary.last_message_id).filter(
+        ChatSummary.group_id == group_id
+    ).first()
+    return (summary.message_count, summary.last_message_id) if summary else (0, None)
+
+
+def drop_summary(db: Session, group_id: int):
+    db.query(ChatSummary).filter(ChatSummary.group_id == group_id).delete()
+
+
+def record_messages(db: Session, rows: List[dict]):
+    # rows — уже вставленные сообщения (с id); коммитит вызывающий
+    by_group = {}
+    for row in rows:
+        if row.get("group_id") is not None:
+            by_group.setdefault(row["group_id"], []).append(row)
+    for group_id, group_rows in by_group.items():
+        last = max(group_rows, key=lambda row: row["id"])
+        newer = ChatSummary.last_message_id.is_(None) | (ChatSummary.last_message_id < last["id"])
+
+        def latest(value, column):
+            return case((newer, value), else_=column)
+
+        db.execute(
+            update(ChatSummary)
+            .where(ChatSummary.group_id == group_id)
+            .values(
+                message_count=ChatSummary.message_count + len(group_rows),
+                last_message_id=latest(last["id"], ChatSummary.last_message_id),
+                last_author_id=latest(last["author_id"], ChatSummary.last_author_id),
+                last_message_preview=latest(_preview(last["content"]), ChatSummary.last_message_preview),
+                last_activity=latest(last["timestamp"], ChatSummary.last_activity),
+            )
+        )
+        # Свои сообщения автор прочитал: обновляются строки авторов, а не всех участников
+        own = Counter(row["author_id"] for row in group_rows)
+        db.execute(
+            update(GroupUser)
+            .where(GroupUser.group_id == group_id, GroupUser.user_id.in_(own))
+            .values(read_count=GroupUser.read_count + case(own, value=GroupUser.user_id, else_=0))
+        )
+
+
+def message_edited(db: Session, message: Message):
+    db.execute(
+        update(ChatSummary)
+        .where(ChatSummary.group_id == message.group_id, ChatSummary.last_message_id == message.id)
+        .values(last_message_preview=_preview(message.content))
+    )
+
+
+def message_deleted(db: Session, group_id: int, message_id: int, author_id: int):
+    # Сообщение уходит из счётчика группы; у тех, для кого оно было прочитанным (автор или
+    # знак не ниже него), уходит и из read_count — их непрочитанное не меняется
+    db.execute(
+        update(ChatSummary)
+        .where(ChatSummary.group_id == group_id)
+        .values(message_count=ChatSummary.message_count - 1)
+    )
+    db.execute(
+        update(GroupUser)
+        .where(GroupUser.group_id == group_id)
+        .where((GroupUser.user_id == author_id) | (GroupUser.last_read_id >= message_id))
+        .values(read_count=GroupUser.read_count - 1)
+    )
+    # Удалили последнее сообщение — превью берём у предыдущего (время активности не откатываем)
+    summary = db.query(ChatSummary).filter(ChatSummary.group_id == group_id).first()
+    if summary is None or summary.last_message_id != message_id:
+        return
+    previous = (
+        db.query(Message.id, Message.author_id, Message.content)
+        .filter(Message.group_id == group_id, Message.id < message_id)
+        .order_by(Message.id.desc())
+        .first()
+    )
+    summary.last_message_id = previous.id if previous else None
+    summary.last_author_id = previous.author_id if previous else None
+    summary.last_message_preview = _preview(previous.content) if previous else None
+
+
+def apply_reads(db: Session, reads: Dict[Tuple[int, int], Optional[int]]) -> Dict[Tuple[int, int], tuple]:
+    """Move read watermarks forward and recount unread; one transaction for the whole batch."""
+    # reads — (group_id, user_id) -> id прочитанного сообщения (None — до последнего). Для
+    # участников возвращает (last_read_id, unread_count, advanced, changed): сдвинулся ли знак
+    # и изменилось ли что-нибудь у участника
+    results = {}
+    summaries = {}
+    for (group_id, user_id), message_id in reads.items():
+        if group_id not in summaries:
+            summary = db.query(ChatSummary.last_message_id, ChatSummary.message_count).filter(
+                ChatSummary.group_id == group_id
+            ).first()
+            summaries[group_id] = (summary.last_message_id or 0, summary.message_count) if summary else (0, 0)
+        latest, message_count = summaries[group_id]
+        member = db.query(GroupUser.last_read_id, GroupUser.read_count).filter(
+            GroupUser.group_id == group_id, GroupUser.user_id == user_id
+        ).first()
+        if member is None:
+            continue
+        # Знак только растёт: запоздавший запрос со старым id ничего не откатывает
+        target = latest if message_id is None else min(message_id, latest)
+        watermark = max(target, member.last_read_id or 0)
+        if watermark >= latest:
+            unread = 0
+        else:
+            # Сообщения после знака — диапазон по индексу (group_id, id), обычно короткий
+            unread = db.query(func.count(Message.id)).filter(
+                Message.group_id == group_id, Message.id > watermark, Message.author_id != user_id
+            ).scalar()
+        advanced = watermark != (member.last_read_id or 0)
+        changed = advanced or unread != max(0, message_count - member.read_count)
+        if advanced or member.read_count != message_count - unread:
+            db.execute(
+                update(GroupUser)
+                .where(GroupUser.group_id == group_id, GroupUser.user_id == user_id)
+                .values(last_read_id=watermark, read_count=message_count - unread)
+            )
+        results[(group_id, user_id)] = (watermark, unread, advanced, changed)
+    db.commit()
+    return results
+
+
+def read_watermarks(db: Session, group_id: int) -> Dict[int, int]:
+    # Кто из участников докуда прочитал группу (для кадра read_receipts при открытии чата)
+    return dict(db.query(GroupUser.user_id, GroupUser.last_read_id).filter(
+        GroupUser.group_id == group_id, GroupUser.last_read_id.isnot(None)
+    ))
+
+
+def user_chats(db: Session, user_id: int) -> List[dict]:
+    # Core-запрос: только нужные колонки, без ORM-объектов (ответ кодирует serialization)
+    rows = db.execute(
+        select(
+            Group.id, Group.name, Group.type, Group.background, GroupUser.read_count, GroupUser.last_read_id,
+            ChatSummary.member_count, ChatSummary.message_count, ChatSummary.last_message_id,
+            ChatSummary.last_message_preview, ChatSummary.last_activity, ChatSummary.last_seq, User.username,
+        )
+        .join(GroupUser, GroupUser.group_id == Group.id)
+        .outerjoin(ChatSummary, ChatSummary.group_id == Group.id)
+        .outerjoin(User, User.id == ChatSummary.last_author_id)
+        .where(GroupUser.user_id == user_id)
+        .order_by(ChatSummary.last_activity.desc().nullslast(), Group.id.desc())
+    ).all()
+    return [{
+        "id": row.id,
+        "name": row.name,
+        # Сохранённый тип важнее; для старых групп без типа — по числу участников
+        "type": row.type or ("group" if (row.member_count or 0) > 2 else "private"),
+        "background": row.background,
+        "member_count": row.member_count or 0,
+        "unread_count": max(0, (row.message_count or 0) - row.read_count),
+        "last_read_id": row.last_read_id,
+        "last_message": {
+            "id": row.last_message_id,
+            "preview": row.last_message_preview,
+            "author": row.username,
+        } if row.last_message_id is not None else None,
+        "last_activity": row.last_activity.isoformat() if row.last_activity else None,
+        # С этого номера клиент докачивает события группы при подписке (message_log)
+        "last_seq": row.last_seq or 0,
+    } for row in rows]
+
+
+def backfill(db: Session) -> int:
+    # Сводки для групп, созданных до появления chat_summaries (один раз при старте)
+    missing = db.query(Group.id).filter(~select(ChatSummary.group_id).where(ChatSummary.group_id == Group.id).exists())
+    group_ids = [group_id for (group_id,) in missing]
+    for group_id in group_ids:
+        member_count = db.query(func.count(GroupUser.id)).filter(GroupUser.group_id == group_id).scalar()
+        last = (
+            db.query(Message.id, Message.author_id, Message.content, Message.timestamp)
+            .filter(Message.group_id == group_id)
+            .order_by(Message.id.desc())
+            .first()
+        )
+        message_count = db.query(func.count(Message.id)).filter(Message.group_id == group_id).scalar()
+        db.add(ChatSummary(
+            group_id=group_id,
+            member_count=member_count,
+            message_count=message_count,
+            last_message_id=last.id if last else None,
+            last_author_id=last.author_id if last else None,
+            last_message_preview=_preview(last.content) if last else None,
+            last_activity=last.timestamp if last else None,
+        ))
+    db.commit()
+    return len(group_ids)
@@ -1,18 +1,94 @@
 # database.py
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
+import asyncio
+import contextvars
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
-from models import Base, Group
+from metrics import instrument_engine
+from migrations import migrate
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./chat.db"
+SQLALCHEMY_DATABASE_URL = os.environ.get("CHAT_DATABASE_URL", "sqlite:///./chat.db")
+# Профиль SQLite: "tuned" — PRAGMA ниже и раздельные пулы чтения/записи,
+# "legacy" — одно соединение-пул без настроек (как раньше, для сравнения в бенчмарках)
+SQLITE_PROFILE = os.environ.get("CHAT_SQLITE_PROFILE", "tuned")
+# WAL: читатели не блокируют писателя и не ждут его
+SQLITE_JOURNAL_MODE = os.environ.get("CHAT_SQLITE_JOURNAL_MODE", "WAL")
+# NORMAL в режиме WAL не теряет целостность, fsync только на checkpoint
+SQLITE_SYNCHRONOUS = os.environ.get("CHAT_SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.environ.get("CHAT_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Размер страничного кэша на соединение, КиБ
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("CHAT_SQLITE_CACHE_SIZE_KB", str(64 * 1024)))
+# Сколько ждать чужую блокировку (другие воркеры), прежде чем вернуть "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("CHAT_SQLITE_BUSY_TIMEOUT_MS", "10000"))
+# Освобождённые страницы возвращаются фоновой очисткой (retention.py) по частям. Действует
+# только для новой базы; существующую переводит python -m retention vacuum
+SQLITE_AUTO_VACUUM = os.environ.get("CHAT_SQLITE_AUTO_VACUUM", "INCREMENTAL")
+# Писатели всех воркеров ждут друг друга на flock, а не в busy handler SQLite,
+# который спит до 100 мс между попытками (отсюда всплески задержки коммитов)
+SQLITE_WRITE_LOCK = os.environ.get("CHAT_SQLITE_WRITE_LOCK", "1") == "1"
+# Соединений для чтения; писатель в процессе всегда один — SQLite всё равно пишет по одному
+DB_READ_POOL_SIZE = int(os.environ.get("CHAT_DB_READ_POOL_SIZE", "8"))
+# Потоки, в которых async-обработчики выполняют запросы к БД
+DB_EXECUTOR_WORKERS = 4
+DB_READ_EXECUTOR_WORKERS = DB_READ_POOL_SIZE
+# Применять миграции схемы при импорте; 0 — только через python -m migrations upgrade
+AUTO_MIGRATE = os.environ.get("CHAT_AUTO_MIGRATE", "1") == "1"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# Создаем таблицы
-Base.metadata.create_all(bind=engine)
+def _apply_pragmas(dbapi_connection, read_only: bool):
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        # До создания первой таблицы, иначе без VACUUM не применяется
+        cursor.execute(f"PRAGMA auto_vacuum = {SQLITE_AUTO_VACUUM}")
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    if read_only:
+        cursor.execute("PRAGMA query_only = 1")
+    cursor.close()
+
+
+def _create_engine(read_only: bool = False):
+    if SQLITE_PROFILE == "legacy" or not SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+        return create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+    pool_size = DB_READ_POOL_SIZE if read_only else 1
+    new_engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+        pool_size=pool_size, max_overflow=0, pool_timeout=60,
+    )
+
+    @event.listens_for(new_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        # Транзакциями управляем сами (см. on_begin), а не драйвер sqlite3
+        dbapi_connection.isolation_level = None
+        _apply_pragmas(dbapi_connection, read_only)
+
+    @event.listens_for(new_engine, "begin")
+    def on_begin(connection):
+        # Писатель сразу берёт блокировку записи: отложенная транзакция, начавшая с чтения,
+        # не может дождаться чужого писателя и падает с "database is locked" без busy_timeout
+        connection.exec_driver_sql("BEGIN" if read_only else "BEGIN IMMEDIATE")
+
+    return new_engine
+
+
+engine = _create_engine()
+read_engine = _create_engine(read_only=True) if SQLITE_PROFILE != "legacy" else engine
+instrument_engine(engine, "write")
+if read_engine is not engine:
+    instrument_engine(read_engine, "read")
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+read_executor = ThreadPoolExecutor(max_workers=DB_READ_EXECUTOR_WORKERS, thread_name_prefix="db-read")
 
 # Создание группы должно происходить в роутах, а не здесь
 def get_db():
@@ -21,3 +97,64 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Только чтение: отдельный пул, запросы не стоят в очереди за писателем
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+class _WriteLock:
+    """Cross-process writer queue: a thread lock plus flock on a file next to the database."""
+
+    def __init__(self, database: str):
+        self.path = database + ".write-lock"
+        self.thread_lock = threading.Lock()
+        self.file = None
+
+    @contextmanager
+    def hold(self):
+        with self.thread_lock:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+
+_database_file = engine.url.database if engine.url.get_backend_name() == "sqlite" else None
+write_lock = _WriteLock(_database_file) if (
+    SQLITE_WRITE_LOCK and SQLITE_PROFILE != "legacy" and _database_file and _database_file != ":memory:"
+) else None
+
+# Таблицы, индексы и прочие изменения схемы — версионированные миграции (migrations.py)
+if AUTO_MIGRATE:
+    migrate(engine, lock=write_lock)
+
+def _with_session(fn, args, session_factory=SessionLocal):
+    db = session_factory()
+    try:
+        if write_lock is not None and session_factory is SessionLocal:
+            with write_lock.hold():
+                return fn(db, *args)
+        return fn(db, *args)
+    finally:
+        db.close()
+
+# Для async-эндпоинтов: fn(db, *args) выполняется в потоке БД со своей сессией,
+# чтобы коммиты SQLite не блокировали event loop и все открытые сокеты
+# (контекст копируется, чтобы запросы учитывались в метриках HTTP-запроса)
+async def run_db(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, contextvars.copy_context().run, _with_session, fn, args)
+
+# То же для запросов без записи: свои потоки и соединения только для чтения
+async def run_read(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        read_executor, contextvars.copy_context().run, _with_session, fn, args, ReadSessionLocal
+    )
@@ -0,0 +1,89 @@
+# lifecycle.py
+# Перезапуск без лавины переподключений и холодных кэшей.
+#
+# Остановка: по SIGTERM/SIGINT, ещё до того как uvicorn сам закроет сокеты, каждый клиент
+# получает {"type": "reconnect", "data": {"after_ms": ...}} со своей случайной задержкой,
+# очереди сокетов досылаются (не дольше DRAIN_TIMEOUT), сокеты закрываются с кодом 1012,
+# новые не принимаются. Затем lifespan сбрасывает в БД отметки о прочтении и сообщения
+# write-behind. Клиент переподключается через after_ms и докачивает пропущенное подпиской
+# с "since" (message_log), а не всей историей через GET /messages.
+#
+# Старт: до приёма соединений в кэши загружаются самые активные группы (chat_summaries):
+# участники, их пользователи и последние сообщения. Время фаз — chat_startup_seconds.
+import os
+import random
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, List
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from metrics import startup_seconds
+from models import ChatSummary
+
+# Сколько ждать отправки очередей сокетов при остановке, секунды
+DRAIN_TIMEOUT = float(os.environ.get("CHAT_DRAIN_TIMEOUT", "5"))
+# Клиент переподключается через RECONNECT_AFTER_MS + случайные 0..RECONNECT_JITTER_MS
+RECONNECT_AFTER_MS = int(os.environ.get("CHAT_RECONNECT_AFTER_MS", "1000"))
+RECONNECT_JITTER_MS = int(os.environ.get("CHAT_RECONNECT_JITTER_MS", "9000"))
+# Сколько самых активных групп прогревать при старте; 0 — не прогревать
+PREWARM_GROUPS = int(os.environ.get("CHAT_PREWARM_GROUPS", "500"))
+
+
+def reconnect_frame(connection=None) -> dict:
+    # У каждого сокета своя задержка: клиенты возвращаются равномерно, а не в одну секунду
+    return {"type": "reconnect", "data": {"after_ms": RECONNECT_AFTER_MS + random.randint(0, RECONNECT_JITTER_MS)}}
+
+
+def drain_on_signal(drain: Callable[[], Awaitable], loop) -> bool:
+    """Run `drain` on SIGTERM/SIGINT before the server's own handler; a second signal skips it.
+
+    uvicorn closes every socket itself before the lifespan shutdown, too late for a farewell frame.
+    """
+    # Обработчики сигналов ставятся только из главного потока (не так в TestClient)
+    if threading.current_thread() is not threading.main_thread():
+        return False
+    signalled, tasks = [], []
+
+    def start(signum, previous):
+        async def drain_then_stop():
+            try:
+                await drain()
+            except Exception as e:
+                print(f"Drain failed: {e}")
+            finally:
+                previous(signum, None)
+        tasks.append(loop.create_task(drain_then_stop()))
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(signum)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            if signalled:
+                previous(signum, frame)
+                return
+            signalled.append(signum)
+            # Обработчик сигнала прерывает цикл событий где угодно — задачу заводим из самого цикла
+            loop.call_soon_threadsafe(start, signum, previous)
+        signal.signal(signum, handler)
+    return True
+
+
+@contextmanager
+def startup_phase(phase: str, timings: dict):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = time.perf_counter() - started
+        startup_seconds.set(timings[phase], phase)
+
+
+def hot_groups(db: Session, limit: int = PREWARM_GROUPS) -> List[int]:
+    # Группы с самой свежей активностью — к ним первыми и вернутся клиенты
+    return list(db.scalars(
+        select(ChatSummary.group_id).order_by(ChatSummary.last_activity.desc()).limit(limit)
+    ))
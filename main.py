@@ -1,25 +1,93 @@
-from fastapi import APIRouter, FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, FastAPI, Depends, Header, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session, joinedload
-from typing import Dict, List
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
+import asyncio
+import math
+import os
+from typing import List, Optional
 import datetime
 from uuid import uuid4  # если это отдельный модуль
-from database import SessionLocal, engine
-from models import Base, User, Group, GroupUser, Message
-from schemas import PrivateChatCreate, UserCreate, UserOut, GroupCreate, GroupOut, MessageCreate, MessageOut
-from auth import create_access_token, get_current_user
-from websocket_manager import ConnectionManager
+from database import SessionLocal, get_read_db, run_db, run_read
+from models import User, Group, GroupUser, Message
+from schemas import (AvatarUpdate, PrivateChatCreate, UserCreate, UserOut, GroupCreate, GroupOut, MediaOut, MessageCreate,
+                     MessageOut, MessagePage, MessageSearchPage)
+from auth import WS_REQUIRE_AUTH, create_access_token, decode_token, get_current_user
+from websocket_manager import SERVICE_RESTART_CLOSE_CODE, ConnectionManager
+from broker import BROKER_BACKEND, create_broker
+from message_writer import WRITE_BEHIND, MessageWriter, insert_message
+from message_cache import RecentMessageCache
+from membership_cache import CachedUser, membership
+from lifecycle import DRAIN_TIMEOUT, drain_on_signal, hot_groups, reconnect_frame, startup_phase
+from chat_list import (add_members, backfill, create_summary, drop_summary, message_deleted, message_edited,
+                       read_position, user_chats)
+from message_log import compact_periodically, drop_log, events_since, log_event
+from presence import PRESENCE_ENABLED, PresenceTracker
+from serialization import json_response, message_select, message_to_dict, messages_by_id, row_to_dict, rows_to_dicts
+from ratelimit import RATE_LIMIT_CLOSE_CODE, IngressLimiter, rate_limited
+from read_receipts import ReadReceipts
+from archive import archived_page, segment_cache
+from media import (MAX_UPLOAD_BYTES, MEDIA_ID, THUMBNAIL_SIZES, is_image, media_info, media_path, media_response,
+                   save_upload)
+from retention import enforce_periodically, forget_group, next_group_id, raise_id_floor
+from wire_format import DELETED_MESSAGE, UPDATED_MESSAGE, negotiate
+from search import (MAX_SEARCH_OFFSET, MAX_SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE, match_query,
+                    search_message_ids)
+from ws_session import WS_CLOSE_FORBIDDEN, WS_CLOSE_UNAUTHORIZED, SocketSession, reject
+from metrics import (METRICS_ENABLED, MetricsMiddleware, monitor_event_loop, render as render_metrics,
+                     warmed_entries, watch_connections, ws_frame_seconds)
 
 chat_router = APIRouter()
-# Создаем таблицы
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
-app.include_router(chat_router)
-# Расширяем WebSocket-менеджер поддержкой по user_id
-chat_group_subscriptions: Dict[int, List[WebSocket]] = {}
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global message_writer
+    timings = {}
+    with startup_phase("total", timings):
+        # Подключаемся к шине между воркерами до приёма соединений
+        with startup_phase("broker", timings):
+            await manager.start()
+            if PRESENCE_ENABLED:
+                await presence.start()
+        loop_monitor = asyncio.create_task(monitor_event_loop()) if METRICS_ENABLED else None
+        # Старые события журнала докачки (message_log) удаляются в фоне
+        log_compactor = asyncio.create_task(compact_periodically(run_db))
+        # Вычистка удалённых групп, архив и сроки хранения сообщений (retention)
+        retention = asyncio.create_task(enforce_periodically(run_db, run_read, on_compacted=forget_recent))
+        # Сводки списка чатов для групп, созданных до их появления
+        with startup_phase("backfill", timings):
+            await run_db(backfill)
+        # Кэши активных групп заполняются до того, как сервер начнёт принимать соединения
+        await warm_caches(timings)
+        if WRITE_BEHIND:
+            if BROKER_BACKEND != "memory":
+                raise RuntimeError("Write-behind assigns message ids in memory and needs a single worker")
+            message_writer = MessageWriter()
+            await message_writer.start()
+            read_receipts.writer = message_writer
+        read_receipts.start()
+    print("Startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()))
+    # SIGTERM/SIGINT сначала прощается с клиентами, потом останавливает сервер
+    drain_on_signal(drain_sockets, asyncio.get_running_loop())
+    yield
+    # Сокеты, не закрытые по сигналу (сервер без обработчиков сигналов в главном потоке)
+    await drain_sockets()
+    # Сбрасываем очереди отметок о прочтении и сообщений в БД до остановки
+    await read_receipts.close()
+    if message_writer is not None:
+        await message_writer.close()
+    await presence.close()
+    await manager.close()
+    log_compactor.cancel()
+    retention.cancel()
+    if loop_monitor is not None:
+        loop_monitor.cancel()
+
+app = FastAPI(lifespan=lifespan)
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -28,6 +96,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Задержки и число запросов к БД по маршрутам (GET /metrics)
+app.add_middleware(MetricsMiddleware)
 
 # Монтируем статические файлы
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -54,63 +124,380 @@ def get_db():
     finally:
         db.close()
 
-# Менеджер WebSocket-соединений
-manager = ConnectionManager()
+# Менеджер WebSocket-соединений (сокеты групп и подписки на обновления списка чатов)
+manager = ConnectionManager(broker=create_broker())
+# Последние сообщения горячих групп; обновляется из всех рассылок в группы
+recent_messages = RecentMessageCache()
+manager.group_listeners.append(recent_messages.apply_event)
+# Изменения состава групп сбрасывают кэш участников во всех воркерах
+manager.channel_handlers["members"] = lambda target, payload: membership.invalidate_group(int(target))
+# Группу удалили или её сообщения ушли в архив / удалены по сроку — кэш последних сообщений сбрасывается
+manager.channel_handlers["retention"] = lambda target, payload: recent_messages.drop_group(int(target))
+# Пользователь сменил аватар — кэш пользователей перечитает его во всех воркерах
+manager.channel_handlers["profile"] = lambda target, payload: membership.invalidate_user(int(target))
+watch_connections(manager)
+# Присутствие и набор текста: диффы по группам раз в тик (CHAT_PRESENCE=0 — выключено)
+presence = PresenceTracker(manager)
+# Отметки о прочтении: пакетная запись водяных знаков и рассылка открывшим группу
+read_receipts = ReadReceipts(manager)
+# Корзины токенов на сокет, пользователя и группу (CHAT_RATE_*)
+ingress = IngressLimiter()
+
+# Корзина кадров сокета живёт, пока он подключён (manager.disconnect -> remove -> слушатели)
+def forget_connection_bucket(connection):
+    if connection.websocket not in manager.all_connections:
+        ingress.forget_connection(connection.key)
+
+manager.connection_listeners.append(forget_connection_bucket)
+
+# Участники группы и пользователи из кэша; в БД идём только при промахе
+async def group_members(group_id: int):
+    members = membership.cached_members(group_id)
+    if members is None:
+        members = await run_read(membership.load_members, group_id)
+    return members
+
+async def cached_user(user_id: int):
+    user = membership.cached_user(user_id)
+    if user is None:
+        user = await run_read(membership.load_user, user_id)
+    return user
 
-# WebSocket эндпоинт
-@app.websocket("/ws/{group_id}")
-async def websocket_endpoint(websocket: WebSocket, group_id: int, db: Session = Depends(get_db)):
-    await manager.connect(websocket, group_id)
+async def invalidate_members(group_id: int):
+    await manager.publish(f"members:{group_id}")
+
+async def forget_recent(group_id: int):
+    await manager.publish(f"retention:{group_id}")
+
+# Прогрев при старте (lifecycle): участники и пользователи самых активных групп одним
+# проходом, затем их последние страницы истории — как после первого GET /messages
+async def warm_caches(timings: dict):
+    group_ids = await run_read(hot_groups)
+    with startup_phase("warm_members", timings):
+        users = await run_read(membership.preload, group_ids)
+    with startup_phase("warm_messages", timings):
+        for group_id in group_ids:
+            recent_messages.begin_fill(group_id)
+        pages = await run_read(_newest_pages, group_ids)
+        # Самые активные заполняются последними: при нехватке памяти кэш вытеснит менее активные
+        for group_id in reversed(group_ids):
+            messages, has_more = pages[group_id]
+            recent_messages.fill(group_id, messages, complete=not has_more)
+    warmed = {"groups": len(group_ids), "users": users, "messages": sum(len(page[0]) for page in pages.values())}
+    for cache, count in warmed.items():
+        warmed_entries.set(count, cache)
+    print(f"Warmed caches: {warmed['groups']} groups, {warmed['users']} users, {warmed['messages']} messages")
+
+def _newest_pages(db: Session, group_ids: List[int]) -> dict:
+    return {group_id: _get_messages_page(db, group_id, None, None, HISTORY_PAGE_SIZE) for group_id in group_ids}
+
+# Остановка (lifecycle): каждому сокету кадр reconnect со своей задержкой, досылка очередей, закрытие
+async def drain_sockets():
+    closed = await manager.drain(reconnect_frame, DRAIN_TIMEOUT)
+    if closed:
+        print(f"Drained {closed} sockets")
+
+# Фоновый пакетный писатель сообщений (CHAT_WRITE_BEHIND=1), создаётся в lifespan
+message_writer: MessageWriter = None
+
+# Сохраняет сообщение сразу или через пакетный писатель и возвращает кадр new_message
+# для рассылки: сообщение и номер его события в группе
+async def store_message(author: CachedUser, content: str, group_id: int = None, recipient_id: int = None) -> dict:
+    row = {
+        "content": content,
+        "author_id": author.id,
+        "group_id": group_id,
+        "recipient_id": recipient_id,
+        "timestamp": datetime.datetime.now(),
+        "edited": 0
+    }
+    if message_writer is not None:
+        row["id"], seq = await message_writer.submit(row)
+    else:
+        row["id"], seq = await run_db(insert_message, row)
+    data = row_to_dict((row["id"], content, author.id, author.username, author.avatar, group_id, recipient_id,
+                        row["timestamp"], 0))
+    return {"type": "new_message", "seq": seq, "data": data}
+
+# Рассылка кадра о сообщении: в группу или, если это личное сообщение без группы, сразу
+# сокетам автора и получателя по индексу пользователь -> сокеты, минуя механику групп
+async def publish_message(frame: dict):
+    data = frame["data"]
+    if data.get("group_id"):
+        await manager.broadcast_to_group(frame, data["group_id"])
+    elif data.get("recipient_id"):
+        await manager.send_to_users(frame, {data["author_id"], data["recipient_id"]})
+
+# Проверка токена при подключении. Возвращает (ok, session): session=None — старый
+# клиент без токена (author_id в каждом кадре), ok=False — соединение уже отклонено
+async def authenticate_socket(websocket: WebSocket, token: Optional[str]):
+    if manager.draining:
+        # Воркер останавливается (lifecycle): клиент переподключится со случайной задержкой
+        await reject(websocket, SERVICE_RESTART_CLOSE_CODE, "Server restarting")
+        return False, None
+    if token is None:
+        if WS_REQUIRE_AUTH:
+            await reject(websocket, WS_CLOSE_UNAUTHORIZED, "Token required")
+            return False, None
+        return True, None
+    try:
+        user_id, expires_at = decode_token(token)
+    except HTTPException as e:
+        await reject(websocket, WS_CLOSE_UNAUTHORIZED, e.detail)
+        return False, None
+    user = await cached_user(user_id)
+    if user is None:
+        await reject(websocket, WS_CLOSE_UNAUTHORIZED, "User not found")
+        return False, None
+    return True, SocketSession(websocket, manager, user, expires_at)
+
+async def subscribe_socket(connection, user_id: int, group_ids: list):
+    members = [await group_members(group_id) for group_id in group_ids]
+    allowed = [group_id for group_id, ids in zip(group_ids, members) if user_id in ids]
+    subscribed = [group_id for group_id in allowed if manager.subscribe(connection, group_id)]
+    if subscribed:
+        await manager.send_personal({"type": "subscribed", "data": {"group_ids": subscribed}}, connection.websocket)
+    if presence.running:
+        for group_id, ids in zip(group_ids, members):
+            if group_id in subscribed:
+                await manager.send_personal(presence.snapshot(group_id, ids), connection.websocket)
+    if len(allowed) < len(group_ids):
+        denied = [group_id for group_id in group_ids if group_id not in allowed]
+        await manager.send_personal({"error": "User not in group", "group_ids": denied}, connection.websocket)
+    if len(subscribed) < len(allowed):
+        await manager.send_personal({"error": "Too many subscriptions"}, connection.websocket)
+
+def _frame_group_ids(data: dict) -> Optional[list]:
+    group_ids = data.get("group_ids", [data.get("group_id")])
+    if not isinstance(group_ids, list) or not all(type(group_id) is int for group_id in group_ids):
+        return None
+    return group_ids
+
+# {"since": {"<group_id>": seq}} в кадре subscribe: с какого номера докачать события
+def _frame_since(data: dict) -> Optional[dict]:
+    since = data.get("since", {})
+    if not isinstance(since, dict):
+        return None
+    try:
+        since = {int(group_id): seq for group_id, seq in since.items()}
+    except ValueError:
+        return None
+    if not all(type(seq) is int and seq >= 0 for seq in since.values()):
+        return None
+    return since
+
+def _resume_frames(db: Session, since: dict) -> list:
+    return [events_since(db, group_id, seq) for group_id, seq in since.items()]
+
+# Пропущенные события подписанных групп — одним кадром resume (или resync_required) на группу.
+# Живые рассылки идут с момента подписки, клиент сам отбрасывает повторы по seq
+async def resume_socket(connection, since: dict):
+    since = {group_id: seq for group_id, seq in since.items() if group_id in connection.groups}
+    if not since:
+        return
+    if message_writer is not None:
+        # Разосланные, но ещё не записанные события тоже должны попасть в выборку
+        await message_writer.wait_persisted(message_writer.next_id - 1)
+    for frame in await run_read(_resume_frames, since):
+        await manager.send_personal(frame, connection.websocket)
+
+# Кадр сверх лимита: ошибка клиенту или, при политике disconnect, закрытие сокета
+# (WebSocketDisconnect завершает цикл приёма так же, как уход клиента)
+async def refuse(connection, retry_after: float):
+    if ingress.disconnects:
+        manager.close_connection(connection, RATE_LIMIT_CLOSE_CODE)
+        raise WebSocketDisconnect(RATE_LIMIT_CLOSE_CODE)
+    else:
+        await manager.send_personal(rate_limited(retry_after), connection.websocket)
+
+# group_id кадра /ws: целое число из подписок сокета. Иначе клиенту уходит кадр ошибки,
+# а сокет и остальные подписки остаются
+async def subscribed_group(connection, group_id) -> bool:
+    if type(group_id) is not int:
+        await manager.send_personal({"error": "Invalid group id"}, connection.websocket)
+        return False
+    if group_id not in connection.groups:
+        await manager.send_personal({"error": "Not subscribed to group", "group_id": group_id}, connection.websocket)
+        return False
+    return True
+
+# Типы входящих кадров /ws (метка в метриках; остальные — "unknown")
+FRAME_TYPES = ("message", "subscribe", "unsubscribe", "refresh_token", "typing", "ping", "view", "read")
+
+# Мультиплексированный сокет: один на клиента, группы подключаются управляющими кадрами
+# subscribe/unsubscribe, сообщения отправляются кадром {"type": "message", "group_id", "content"}.
+# ?encoding=compact включает компактные кадры рассылок (wire_format), по умолчанию JSON.
+# После переподключения subscribe с "since" докачивает пропущенные события групп (message_log).
+# Кадр message с recipient_id вместо group_id — личное сообщение без группы.
+# Кадры typing и ping — индикатор набора и сердцебиение для присутствия (presence).
+# {"type": "view", "group_id"} — какая группа открыта (ей идут отметки о прочтении),
+# {"type": "read", "group_id", "message_id"} — прочитано до сообщения (read_receipts)
+# Кадры и сообщения сверх лимитов (ratelimit) отклоняются по политике CHAT_RATE_POLICY
+@app.websocket("/ws")
+async def multiplexed_ws(websocket: WebSocket, token: Optional[str] = None, encoding: Optional[str] = None):
+    if token is None:
+        await reject(websocket, WS_CLOSE_UNAUTHORIZED, "Token required")
+        return
+    ok, session = await authenticate_socket(websocket, token)
+    if not ok:
+        return
+
+    user = session.user
+    connection = await manager.connect(websocket, user_id=user.id, multiplexed=True, encoding=negotiate(encoding))
+    session.start()
     try:
         while True:
             data = await websocket.receive_json()
-            content = data.get("content")
-            author_id = data.get("author_id")
-
-            if not content or not author_id:
-                await websocket.send_json({"error": "Invalid message data"})
+            kind = data.get("type") if isinstance(data, dict) else None
+            retry_after = await ingress.frame(connection.key)
+            if retry_after:
+                await refuse(connection, retry_after)
                 continue
 
-            # Проверяем, что пользователь состоит в группе
-            group_user = db.query(GroupUser).filter(
-                GroupUser.group_id == group_id,
-                GroupUser.user_id == author_id
-            ).first()
-            if not group_user:
-                await websocket.send_json({"error": "User not in group"})
-                continue
+            with ws_frame_seconds.time(kind if kind in FRAME_TYPES else "unknown"):
+                if kind == "ping":
+                    presence.ping(connection, data.get("active") is True)
+                    await manager.send_personal({"type": "pong"}, websocket)
+                    continue
+                presence.touch(connection)
+                if kind == "message":
+                    group_id = data.get("group_id")
+                    content = data.get("content")
+                    recipient_id = data.get("recipient_id")
+                    if not content or not isinstance(content, str):
+                        await manager.send_personal({"error": "Invalid message data"}, websocket)
+                        continue
+                    if group_id is None and type(recipient_id) is int:
+                        # Личное сообщение без группы: получателю и другим сокетам автора
+                        if await cached_user(recipient_id) is None:
+                            await manager.send_personal(
+                                {"error": "Recipient not found", "recipient_id": recipient_id}, websocket
+                            )
+                            continue
+                        retry_after = await ingress.message(user.id, None)
+                        if retry_after:
+                            await refuse(connection, retry_after)
+                            continue
+                        await publish_message(await store_message(user, content, recipient_id=recipient_id))
+                        continue
+                    # Членство проверено при подписке и закреплено за сокетом
+                    if not await subscribed_group(connection, group_id):
+                        continue
+                    retry_after = await ingress.message(user.id, group_id)
+                    if retry_after:
+                        await refuse(connection, retry_after)
+                        continue
+                    presence.set_typing(user.id, group_id, False)
+                    await manager.broadcast_to_group(await store_message(user, content, group_id=group_id), group_id)
+                elif kind == "typing":
+                    group_id = data.get("group_id")
+                    if not await subscribed_group(connection, group_id):
+                        continue
+                    presence.set_typing(user.id, group_id, data.get("active", True) is not False)
+                elif kind == "view":
+                    group_id = data.get("group_id")
+                    if group_id is not None and not await subscribed_group(connection, group_id):
+                        continue
+                    connection.viewing = group_id
+                    if group_id is not None:
+                        await manager.send_personal(await read_receipts.snapshot(group_id), websocket)
+                elif kind == "read":
+                    group_id = data.get("group_id")
+                    message_id = data.get("message_id")
+                    if not await subscribed_group(connection, group_id):
+                        continue
+                    if message_id is not None and type(message_id) is not int:
+                        await manager.send_personal({"error": "Invalid message id"}, websocket)
+                    else:
+                        read_receipts.mark(group_id, user.id, message_id)
+                elif kind in ("subscribe", "unsubscribe"):
+                    group_ids = _frame_group_ids(data)
+                    since = _frame_since(data)
+                    if group_ids is None:
+                        await manager.send_personal({"error": "Invalid group ids"}, websocket)
+                    elif since is None:
+                        await manager.send_personal({"error": "Invalid since"}, websocket)
+                    elif kind == "subscribe":
+                        await subscribe_socket(connection, user.id, group_ids)
+                        await resume_socket(connection, since)
+                    else:
+                        for group_id in group_ids:
+                            manager.unsubscribe(connection, group_id)
+                        await manager.send_personal(
+                            {"type": "unsubscribed", "data": {"group_ids": group_ids}}, websocket
+                        )
+                elif kind == "refresh_token":
+                    await manager.send_personal(session.refresh(), websocket)
+                else:
+                    await manager.send_personal({"error": "Unknown frame type"}, websocket)
+
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"WebSocket error: {e}")
+    finally:
+        manager.disconnect(websocket)
+        session.stop()
 
-            # Сохраняем сообщение в БД
-            new_msg = Message(
-                content=content,
-                author_id=author_id,
-                group_id=group_id,
-                timestamp=datetime.datetime.now()
-            )
-            db.add(new_msg)
-            db.commit()
-            db.refresh(new_msg)
-
-            # Формируем данные для отправки
-            author = db.query(User).filter(User.id == author_id).first()
-            message_data = {
-                "type": "new_message",
-                "data": {
-                    "id": new_msg.id,
-                    "content": new_msg.content,
-                    "author_id": new_msg.author_id,
-                    "author": {
-                        "id": author.id,
-                        "username": author.username
-                    },
-                    "group_id": new_msg.group_id,
-                    "timestamp": new_msg.timestamp.isoformat(),
-                    "edited": 0
-                }
-            }
-
-            # Отправляем сообщение всем в группе
-            await manager.broadcast_to_group(message_data, group_id)
+# Старый сокет одной группы (клиенты до /ws): одна подписка на всё время соединения
+@app.websocket("/ws/{group_id}")
+async def websocket_endpoint(websocket: WebSocket, group_id: int, token: Optional[str] = None):
+    ok, session = await authenticate_socket(websocket, token)
+    if not ok:
+        return
+    # Членство проверяем один раз при подключении и закрепляем за сокетом
+    if session is not None and session.user.id not in await group_members(group_id):
+        await reject(websocket, WS_CLOSE_FORBIDDEN, "User not in group")
+        return
+
+    connection = await manager.connect(websocket, group_id)
+    if session is not None:
+        session.start()
+    # Без токена (CHAT_WS_REQUIRE_AUTH=0): автор первого сообщения, чужие author_id отклоняются
+    pinned_author_id = None
+    try:
+        while True:
+            data = await websocket.receive_json()
+            retry_after = await ingress.frame(connection.key)
+            if retry_after:
+                await refuse(connection, retry_after)
+                continue
+            # Старый протокол: кадр без type — сообщение в группу сокета
+            with ws_frame_seconds.time("refresh_token" if data.get("type") == "refresh_token" else "legacy_message"):
+                content = data.get("content")
+
+                if session is not None:
+                    if data.get("type") == "refresh_token":
+                        await manager.send_personal(session.refresh(), websocket)
+                        continue
+                    author = session.user
+                    if not content:
+                        await manager.send_personal({"error": "Invalid message data"}, websocket)
+                        continue
+                else:
+                    author_id = data.get("author_id")
+                    if not content or type(author_id) is not int:
+                        await manager.send_personal({"error": "Invalid message data"}, websocket)
+                        continue
+                    if pinned_author_id is not None and author_id != pinned_author_id:
+                        await manager.send_personal({"error": "Author does not match connection"}, websocket)
+                        continue
+
+                    # Проверяем, что пользователь состоит в группе
+                    if author_id not in await group_members(group_id):
+                        await manager.send_personal({"error": "User not in group"}, websocket)
+                        continue
+                    pinned_author_id = author_id
+                    author = await cached_user(author_id)
+
+                retry_after = await ingress.message(author.id, group_id)
+                if retry_after:
+                    await refuse(connection, retry_after)
+                    continue
+                frame = await store_message(author, content, group_id=group_id)
+
+                # Отправляем сообщение всем в группе
+                await manager.broadcast_to_group(frame, group_id)
 
     except WebSocketDisconnect:
         manager.disconnect(websocket, group_id)
@@ -118,6 +505,9 @@ async def websocket_endpoint(websocket: WebSocket, group_id: int, db: Session =
         print(f"WebSocket error: {e}")
         await websocket.send_json({"error": f"Internal server error: {str(e)}"})
         manager.disconnect(websocket, group_id)
+    finally:
+        if session is not None:
+            session.stop()
 
 # Пользователи
 @app.post("/users", response_model=UserOut)
@@ -131,18 +521,38 @@ def create_user(user: UserCreate, db: Session = Depends(get_db)):
     return new_user
 
 @app.get("/users/{user_id}", response_model=UserOut)
-def get_user(user_id: int, db: Session = Depends(get_db)):
+def get_user(user_id: int, db: Session = Depends(get_read_db)):
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
+def _set_avatar(db: Session, user_id: int, avatar: Optional[str]):
+    user = db.query(User).filter(User.id == user_id).first()
+    user.avatar = avatar
+    db.commit()
+    return {"id": user.id, "username": user.username, "avatar": user.avatar}
+
+# Аватар — ссылка на загруженную картинку (POST /media); клиенты берут копию нужного размера через ?size=
+@app.put("/users/me/avatar", response_model=UserOut)
+async def set_avatar(update: AvatarUpdate, current_user=Depends(get_current_user)):
+    avatar = None
+    if update.media_id is not None:
+        if not MEDIA_ID.fullmatch(update.media_id) or not is_image(update.media_id):
+            raise HTTPException(status_code=400, detail="Avatar must be an uploaded image")
+        if not os.path.exists(media_path(update.media_id)):
+            raise HTTPException(status_code=404, detail="File not found")
+        avatar = f"/media/{update.media_id}"
+    user = await run_db(_set_avatar, current_user.id, avatar)
+    await manager.publish(f"profile:{current_user.id}")
+    return user
+
 @app.get("/users", response_model=List[UserOut])
-def get_users(db: Session = Depends(get_db)):
+def get_users(db: Session = Depends(get_read_db)):
     return db.query(User).all()
 
 @app.post("/login")
-def login(user: UserCreate, db: Session = Depends(get_db)):
+def login(user: UserCreate, db: Session = Depends(get_read_db)):
     db_user = db.query(User).filter(User.username == user.username).first()
     if not db_user or db_user.password != user.password:
         raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -150,198 +560,351 @@ def login(user: UserCreate, db: Session = Depends(get_db)):
     return {"access_token": access_token, "token_type": "bearer", "user_id": db_user.id}
 
 # Группы и чаты
-@app.post("/groups", response_model=GroupOut)
-async def create_group(group: GroupCreate, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    db_group = Group(name=group.name, background=group.background)
+def _create_group(db: Session, group: GroupCreate, user_id: int):
+    db_group = Group(id=next_group_id(db), name=group.name, background=group.background, type=group.type or "group")
     db.add(db_group)
     db.commit()
     db.refresh(db_group)
-    
+
     # Добавляем создателя в группу
-    group_user = GroupUser(group_id=db_group.id, user_id=current_user.id)
+    group_user = GroupUser(group_id=db_group.id, user_id=user_id)
     db.add(group_user)
+    create_summary(db, db_group.id, member_count=1)
     db.commit()
-    
+    db.refresh(db_group)
+    return db_group
+
+@app.post("/groups", response_model=GroupOut)
+async def create_group(group: GroupCreate, current_user=Depends(get_current_user)):
+    db_group = await run_db(_create_group, group, current_user.id)
+    await invalidate_members(db_group.id)
+
     # Broadcast group creation to connected clients
-    group_data = {
-        "type": "group_update",
-        "data": {
-            "action": "created",
-            "group_id": db_group.id,
-            "name": db_group.name,
-            "type": "group"
-        }
-    }
-    await notify_users_in_group_update(db_group.id, db, "created")
-    
+    await notify_users_in_group_update(db_group.id, "created", db_group.name)
+
     return db_group
 
 @app.get("/groups/{group_id}", response_model=GroupOut)
-def get_group(group_id: int, db: Session = Depends(get_db)):
+def get_group(group_id: int, db: Session = Depends(get_read_db)):
     group = db.query(Group).filter(Group.id == group_id).first()
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
     return group
 
-@app.post("/groups/{group_id}/add_user")
-def add_user_to_group(group_id: int, user_id: int, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+def _add_user_to_group(db: Session, group_id: int, user_id: int):
     group = db.query(Group).filter(Group.id == group_id).first()
     user = db.query(User).filter(User.id == user_id).first()
     if not group or not user:
         raise HTTPException(status_code=404, detail="Group or user not found")
-    if db.query(GroupUser).filter(GroupUser.group_id == group_id, GroupUser.user_id == user_id).first():
+    if membership.is_member(db, group_id, user_id):
         raise HTTPException(status_code=400, detail="User already in group")
-    group_user = GroupUser(group_id=group_id, user_id=user_id)
+    read_count, last_read_id = read_position(db, group_id)
+    group_user = GroupUser(group_id=group_id, user_id=user_id, read_count=read_count, last_read_id=last_read_id)
     db.add(group_user)
-    db.commit()
+    add_members(db, group_id)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Параллельный запрос успел добавить его раньше (уникальный индекс group_id, user_id)
+        db.rollback()
+        raise HTTPException(status_code=400, detail="User already in group")
+
+@app.post("/groups/{group_id}/add_user")
+async def add_user_to_group(group_id: int, user_id: int, current_user=Depends(get_current_user)):
+    await run_db(_add_user_to_group, group_id, user_id)
+    await invalidate_members(group_id)
     return {"message": "User added to group"}
 
 @app.get("/groups/{group_id}/users")
-def get_group_users(group_id: int, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+def get_group_users(group_id: int, current_user=Depends(get_current_user), db: Session = Depends(get_read_db)):
     group = db.query(Group).filter(Group.id == group_id).first()
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
     users = db.query(User).join(GroupUser).filter(GroupUser.group_id == group_id).all()
     return [{"id": user.id, "username": user.username} for user in users]
 
-@app.delete("/groups/{group_id}")
-async def delete_group(group_id: int, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+def _delete_group(db: Session, group_id: int, user_id: int):
     group = db.query(Group).filter(Group.id == group_id).first()
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
-    if not db.query(GroupUser).filter(GroupUser.group_id == group_id, GroupUser.user_id == current_user.id).first():
+    members = membership.members(db, group_id)
+    if user_id not in members:
         raise HTTPException(status_code=403, detail="You are not in this group")
-    
-    # Keep name for the broadcast
+
+    # Keep name and members for the broadcast
     group_name = group.name
-    
+
     db.delete(group)
+    # Иначе новая группа с тем же id (SQLite переиспользует его) унаследует участников
+    db.query(GroupUser).filter(GroupUser.group_id == group_id).delete()
+    drop_summary(db, group_id)
+    drop_log(db, group_id)
+    # Сообщений может быть много: их и архив группы вычищает фон (retention)
+    forget_group(db, group_id)
     db.commit()
-    
+    return group_name, members
+
+@app.delete("/groups/{group_id}")
+async def delete_group(group_id: int, current_user=Depends(get_current_user)):
+    group_name, members = await run_db(_delete_group, group_id, current_user.id)
+    await invalidate_members(group_id)
+    # История удалённой группы не должна отдаваться из кэша ни одним воркером
+    await forget_recent(group_id)
+    await manager.close_group(group_id)
+
     # Broadcast group deletion
-    group_data = {
-        "type": "group_update",
-        "data": {
-            "action": "deleted",
-            "group_id": group_id,
-            "name": group_name
-        }
-    }
-    
-    await notify_users_in_group_update(group_id, db, "deleted")
-    
+    await notify_users_in_group_update(group_id, "deleted", group_name, members)
+
     return {"message": "Group deleted"}
 
 # Сообщения
 @app.post("/messages", response_model=MessageOut)
-async def create_message(msg: MessageCreate, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    if msg.group_id and not db.query(GroupUser).filter(GroupUser.group_id == msg.group_id, GroupUser.user_id == current_user.id).first():
+async def create_message(msg: MessageCreate, current_user=Depends(get_current_user)):
+    if msg.group_id and current_user.id not in await group_members(msg.group_id):
         raise HTTPException(status_code=403, detail="User not in group")
-    
-    new_msg = Message(
-        content=msg.content,
-        author_id=current_user.id,
-        group_id=msg.group_id,
-        recipient_id=msg.recipient_id,
-        timestamp=datetime.datetime.now()
+    if not msg.group_id and msg.recipient_id and await cached_user(msg.recipient_id) is None:
+        raise HTTPException(status_code=404, detail="Recipient not found")
+    retry_after = await ingress.message(current_user.id, msg.group_id)
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Rate limited",
+                            headers={"Retry-After": str(math.ceil(retry_after))})
+
+    frame = await store_message(current_user, msg.content, msg.group_id, msg.recipient_id)
+    await publish_message(frame)
+    return json_response(frame["data"])
+
+# Размер страницы истории по умолчанию и максимальный
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+# Keyset-пагинация по индексу (group_id, id): без after_id идём от новых к старым.
+# Старые сообщения могут быть уже в архиве (archive): вперёд от after_id сначала читается он,
+# назад — только когда горячая часть кончилась
+def _get_messages_page(db: Session, group_id: int, before_id: int, after_id: int, limit: int):
+    # Сообщения удалённой группы лежат в БД, пока их не вычистит фон (retention)
+    if db.query(Group.id).filter(Group.id == group_id).first() is None:
+        return [], False
+    archived = []
+    if after_id is not None:
+        archived, has_more = archived_page(db, group_id, before_id, after_id, limit)
+        if has_more:
+            return archived, True
+        limit -= len(archived)
+    query = message_select().where(Message.group_id == group_id)
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    if after_id is not None:
+        query = query.where(Message.id > after_id).order_by(Message.id)
+    else:
+        query = query.order_by(Message.id.desc())
+    rows = db.execute(query.limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is not None:
+        return archived + rows_to_dicts(rows), has_more
+    rows.reverse()
+    messages = rows_to_dicts(rows)
+    if not has_more:
+        cursor = messages[0]["id"] if messages else before_id
+        archived, has_more = archived_page(db, group_id, cursor, None, limit - len(messages))
+    return archived + messages, has_more
+
+def _page(messages: List[dict], has_more: bool, forward: bool = False) -> dict:
+    next_cursor = None
+    if has_more:
+        next_cursor = messages[-1]["id"] if forward else messages[0]["id"]
+    return {"messages": messages, "next_cursor": next_cursor, "has_more": has_more}
+
+@app.get("/messages", response_model=MessagePage)
+async def get_messages(
+    group_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=MAX_HISTORY_PAGE_SIZE)
+):
+    if after_id is not None:
+        messages, has_more = await run_read(_get_messages_page, group_id, before_id, after_id, limit)
+        return json_response(_page(messages, has_more, forward=True))
+
+    cached = recent_messages.get_page(group_id, before_id, limit)
+    if cached is not None:
+        return json_response(_page(*cached))
+
+    if before_id is None:
+        recent_messages.begin_fill(group_id)
+        if message_writer is not None:
+            # Уже разосланные, но ещё не записанные сообщения должны попасть в выборку
+            await message_writer.wait_persisted(message_writer.next_id - 1)
+    messages, has_more = await run_read(_get_messages_page, group_id, before_id, None, limit)
+    if before_id is None:
+        recent_messages.fill(group_id, messages, complete=not has_more)
+    return json_response(_page(messages, has_more))
+
+# Переписка двух пользователей без группы: keyset по индексу ix_messages_direct
+# (меньший id, больший id, id), от новых к старым
+def _get_direct_page(db: Session, user_id: int, peer_id: int, before_id: Optional[int], limit: int):
+    low, high = sorted((user_id, peer_id))
+    query = message_select().where(
+        Message.recipient_id.isnot(None), Message.group_id.is_(None),
+        func.min(Message.author_id, Message.recipient_id) == low,
+        func.max(Message.author_id, Message.recipient_id) == high,
     )
-    db.add(new_msg)
-    db.commit()
-    db.refresh(new_msg)
-    
-    if msg.group_id:
-        message_data = {
-            "type": "new_message",
-            "data": {
-                "id": new_msg.id,
-                "content": new_msg.content,
-                "author_id": new_msg.author_id,
-                "author_username": current_user.username,
-                "group_id": new_msg.group_id,
-                "timestamp": new_msg.timestamp.isoformat()
-            }
-        }
-        await manager.broadcast_to_group(message_data, msg.group_id)
-    
-    return new_msg
-
-@app.get("/messages", response_model=List[MessageOut])
-async def get_messages(group_id: int, db: Session = Depends(get_db)):
-    messages = db.query(Message).filter(Message.group_id == group_id).options(
-        joinedload(Message.author)  # Добавляем загрузку связанного автора
-    ).all()
-    return messages
-
-@app.put("/messages/{message_id}", response_model=MessageOut)
-async def edit_message(message_id: int, message_update: MessageCreate, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    rows = db.execute(query.order_by(Message.id.desc()).limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows_to_dicts(rows), has_more
+
+@app.get("/messages/direct/{peer_id}", response_model=MessagePage)
+async def get_direct_messages(
+    peer_id: int,
+    before_id: Optional[int] = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=MAX_HISTORY_PAGE_SIZE),
+    current_user=Depends(get_current_user)
+):
+    if before_id is None and message_writer is not None:
+        await message_writer.wait_persisted(message_writer.next_id - 1)
+    messages, has_more = await run_read(_get_direct_page, current_user.id, peer_id, before_id, limit)
+    return json_response(_page(messages, has_more))
+
+def _search_messages(db: Session, user_id: int, query: str, group_id: Optional[int], offset: int, limit: int, order: str):
+    ids = search_message_ids(db, user_id, query, group_id, offset, limit, order)
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    found = messages_by_id(db, ids)
+    return [found[i] for i in ids if i in found], has_more
+
+@app.get("/messages/search", response_model=MessageSearchPage)
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    group_id: Optional[int] = None,
+    offset: int = Query(0, ge=0, le=MAX_SEARCH_OFFSET),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=MAX_SEARCH_PAGE_SIZE),
+    order: str = Query("rank", pattern="^(rank|recent)$"),
+    current_user=Depends(get_current_user)
+):
+    if group_id is not None and current_user.id not in await group_members(group_id):
+        raise HTTPException(status_code=403, detail="User not in group")
+    query = match_query(q)
+    if query is None:
+        return {"messages": [], "next_offset": None, "has_more": False}
+    messages, has_more = await run_read(_search_messages, current_user.id, query, group_id, offset, limit, order)
+    return json_response({"messages": messages, "next_offset": offset + limit if has_more else None,
+                          "has_more": has_more})
+
+# Загрузка файла сырым телом запроса (не multipart): тело пишется на диск по мере чтения,
+# тип определяется по содержимому (media.py). Повторная загрузка того же файла вернёт тот же id
+@app.post("/media", response_model=MediaOut)
+async def upload_media(request: Request, current_user=Depends(get_current_user)):
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File is larger than {MAX_UPLOAD_BYTES} bytes")
+    media_id, size = await save_upload(request.stream())
+    return json_response(media_info(media_id, size))
+
+# Файл или его уменьшенная копия (?size= из THUMBNAIL_SIZES): ETag, Range и кэш навсегда
+@app.get("/media/{media_id}")
+async def get_media(media_id: str, size: Optional[int] = None, if_none_match: Optional[str] = Header(None)):
+    if not MEDIA_ID.fullmatch(media_id):
+        raise HTTPException(status_code=404, detail="File not found")
+    if size is not None and size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"size must be one of {list(THUMBNAIL_SIZES)}")
+    return await media_response(media_id, size, if_none_match)
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    return {"recent_messages": recent_messages.stats(), "membership": membership.stats(),
+            "archive_segments": segment_cache.stats()}
+
+# Метрики этого воркера в текстовом формате Prometheus
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def _edit_message(db: Session, message_id: int, content: str, author: CachedUser):
     msg = db.query(Message).filter(Message.id == message_id).first()
     if not msg:
         raise HTTPException(status_code=404, detail="Message not found")
-    if msg.author_id != current_user.id:
+    if msg.author_id != author.id:
         raise HTTPException(status_code=403, detail="Not authorized to edit this message")
-    
-    msg.content = message_update.content
+
+    msg.content = content
     msg.edited = msg.edited + 1 if msg.edited else 1
+    seq = None
+    if msg.group_id:
+        message_edited(db, msg)
+        seq = log_event(db, msg.group_id, UPDATED_MESSAGE, msg.id)
     db.commit()
     db.refresh(msg)
-    
-    if msg.group_id:
-        message_data = {
-            "type": "updated_message",
-            "data": {
-                "id": msg.id,
-                "content": msg.content,
-                "author_id": msg.author_id,
-                "author": {
-                    "id": current_user.id,
-                    "username": current_user.username
-                },
-                "group_id": msg.group_id,
-                "timestamp": msg.timestamp.isoformat(),
-                "edited": msg.edited
-            }
-        }
-        await manager.broadcast_to_group(message_data, msg.group_id)
-    
-    return msg
+    return {"type": "updated_message", "seq": seq, "data": message_to_dict(msg, author)}
 
-@app.delete("/messages/{message_id}")
-async def delete_message(message_id: int, current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+@app.put("/messages/{message_id}", response_model=MessageOut)
+async def edit_message(message_id: int, message_update: MessageCreate, current_user=Depends(get_current_user)):
+    if message_writer is not None:
+        await message_writer.wait_persisted(message_id)
+    frame = await run_db(_edit_message, message_id, message_update.content, current_user)
+    await publish_message(frame)
+    return json_response(frame["data"])
+
+def _delete_message(db: Session, message_id: int, user_id: int):
     msg = db.query(Message).filter(Message.id == message_id).first()
     if not msg:
         raise HTTPException(status_code=404, detail="Message not found")
-    if msg.author_id != current_user.id:
+    if msg.author_id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this message")
-    
+
     group_id = msg.group_id
-    
+    data = {"id": message_id, "group_id": group_id}
+    if not group_id and msg.recipient_id:
+        data.update(author_id=msg.author_id, recipient_id=msg.recipient_id)
+
     db.delete(msg)
-    db.commit()
-    
+    # Удалили последнее сообщение — следующее всё равно получит новый id
+    raise_id_floor(db, "messages", message_id)
+    seq = None
     if group_id:
-        await manager.broadcast_to_group({
-            "type": "deleted_message", 
-            "data": {
-                "id": message_id,
-                "group_id": group_id
-            }
-        }, group_id)
-    
+        message_deleted(db, group_id, message_id, msg.author_id)
+        seq = log_event(db, group_id, DELETED_MESSAGE, message_id)
+    db.commit()
+    return {"type": "deleted_message", "seq": seq, "data": data}
+
+@app.delete("/messages/{message_id}")
+async def delete_message(message_id: int, current_user=Depends(get_current_user)):
+    if message_writer is not None:
+        await message_writer.wait_persisted(message_id)
+    await publish_message(await run_db(_delete_message, message_id, current_user.id))
     return {"message": "Message deleted"}
 
 # Чаты
+# Список чатов одним запросом из сводок (chat_list), свежие сверху
 @app.get("/chats")
-def get_user_chats(current_user=Depends(get_current_user), db: Session = Depends(get_db)):
-    groups = db.query(Group).join(GroupUser).filter(GroupUser.user_id == current_user.id).all()
-    return [{
-        "id": group.id,
-        "name": group.name,
-        "type": "group" if db.query(GroupUser).filter(GroupUser.group_id == group.id).count() > 2 else "private",
-        "background": group.background
-    } for group in groups]
+def get_user_chats(current_user=Depends(get_current_user), db: Session = Depends(get_read_db)):
+    return json_response(user_chats(db, current_user.id))
+
+# Прочитано до message_id (без него — до последнего сообщения). Запись идёт пакетом вместе
+# с отметками других пользователей, ответ — после неё (read_receipts)
+@app.post("/chats/{group_id}/read")
+async def read_chat(group_id: int, message_id: Optional[int] = None, current_user=Depends(get_current_user)):
+    result = await read_receipts.read(group_id, current_user.id, message_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    last_read_id, unread_count, _, _ = result
+    return {"group_id": group_id, "last_read_id": last_read_id, "unread_count": unread_count}
+
+def _private_chat(group: Group, created: bool) -> dict:
+    return {"id": group.id, "name": group.name, "type": "private", "background": group.background,
+            "created": created}
+
+# Личный чат пары пользователей один: повторное открытие возвращает существующую группу
+# (groups.dm_key), гонку двух одновременных открытий решает уникальный индекс
+def _create_private_chat(db: Session, chat: PrivateChatCreate):
+    dm_key = "{}:{}".format(*sorted((chat.user_id, chat.recipient_id)))
+    existing = db.query(Group).filter(Group.dm_key == dm_key).first()
+    if existing:
+        return _private_chat(existing, created=False)
 
-@app.post("/chats", response_model=dict)
-def create_private_chat(chat: PrivateChatCreate, db: Session = Depends(get_db)):
     # Check if users exist
     user = db.query(User).filter(User.id == chat.user_id).first()
     recipient = db.query(User).filter(User.id == chat.recipient_id).first()
@@ -352,61 +915,77 @@ def create_private_chat(chat: PrivateChatCreate, db: Session = Depends(get_db)):
     # Generate chat name if not provided
     chat_name = chat.name or f"Chat with {recipient.username}"
     
-    # Create a new group for this private chat
+    # Группа, оба участника и сводка — одной транзакцией
     db_group = Group(
+        id=next_group_id(db),
         name=chat_name,
         type="private",
-        background="#E5DDD5"
+        background="#E5DDD5",
+        dm_key=dm_key
     )
     db.add(db_group)
-    db.commit()
-    db.refresh(db_group)
-    
-    # Add both users to the group
-    user_group1 = GroupUser(group_id=db_group.id, user_id=chat.user_id)
-    user_group2 = GroupUser(group_id=db_group.id, user_id=chat.recipient_id)
-    db.add(user_group1)
-    db.add(user_group2)
-    db.commit()
-    
-    # Return the new chat info
-    return {
-        "id": db_group.id,
-        "name": chat_name,
-        "type": "private",
-        "background": db_group.background
-    }
+    try:
+        db.flush()
+        db.add(GroupUser(group_id=db_group.id, user_id=chat.user_id))
+        if chat.recipient_id != chat.user_id:
+            db.add(GroupUser(group_id=db_group.id, user_id=chat.recipient_id))
+        create_summary(db, db_group.id, member_count=len({chat.user_id, chat.recipient_id}))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        existing = db.query(Group).filter(Group.dm_key == dm_key).first()
+        if existing:
+            return _private_chat(existing, created=False)
+        raise HTTPException(status_code=400, detail="Chat name already taken")
+    return _private_chat(db_group, created=True)
+
+@app.post("/chats", response_model=dict)
+async def create_private_chat(chat: PrivateChatCreate):
+    new_chat = await run_db(_create_private_chat, chat)
+    if new_chat["created"]:
+        await invalidate_members(new_chat["id"])
+    return new_chat
     
+# Старый сокет обновлений списка чатов; /ws получает те же group_update
 @chat_router.websocket("/ws/chats/{user_id}")
-async def chat_updates_ws(websocket: WebSocket, user_id: int):
-    await websocket.accept()
-
-    if user_id not in chat_group_subscriptions:
-        chat_group_subscriptions[user_id] = []
-    chat_group_subscriptions[user_id].append(websocket)
-
+async def chat_updates_ws(websocket: WebSocket, user_id: int, token: Optional[str] = None):
+    # Обновления чужого списка чатов без токена не отдаются даже в режиме совместимости
+    if token is None:
+        await reject(websocket, WS_CLOSE_UNAUTHORIZED, "Token required")
+        return
+    ok, session = await authenticate_socket(websocket, token)
+    if not ok:
+        return
+    if session.user.id != user_id:
+        await reject(websocket, WS_CLOSE_FORBIDDEN, "Token does not match user")
+        return
+
+    connection = await manager.connect_user(websocket, user_id)
+    session.start()
     try:
         while True:
-            await websocket.receive_text()  # держим соединение открытым
+            data = await websocket.receive_json()  # держим соединение открытым
+            presence.touch(connection)
+            if isinstance(data, dict) and data.get("type") == "refresh_token":
+                await manager.send_personal(session.refresh(), websocket)
     except Exception:
         pass
     finally:
-        chat_group_subscriptions[user_id].remove(websocket)
-        if not chat_group_subscriptions[user_id]:
-            del chat_group_subscriptions[user_id]
+        manager.disconnect(websocket)
+        session.stop()
+
+# Роутер подключаем после объявления его маршрутов, иначе они не попадут в app
+app.include_router(chat_router)
 
 # Утилита: уведомить всех пользователей, у которых изменился список чатов
-async def notify_users_in_group_update(group_id: int, db: Session, action: str):
-    users = db.query(GroupUser).filter(GroupUser.group_id == group_id).all()
-    group = db.query(Group).filter(Group.id == group_id).first()
-    for user in users:
-        ws_list = chat_group_subscriptions.get(user.user_id, [])
-        for ws in ws_list:
-            await ws.send_json({
-                "type": "group_update",
-                "data": {
-                    "group_id": group.id,
-                    "name": group.name,
-                    "action": action
-                }
-            })
\ No newline at end of file
+async def notify_users_in_group_update(group_id: int, action: str, name: str, user_ids=None):
+    if user_ids is None:
+        user_ids = await group_members(group_id)
+    await manager.send_to_users({
+        "type": "group_update",
+        "data": {
+            "group_id": group_id,
+            "name": name,
+            "action": action
+        }
+    }, user_ids)
@@ -0,0 +1,237 @@
+# media.py
+# Загруженные файлы (аватары, фоны чатов, вложения). Тело запроса пишется на диск кусками
+# по мере чтения, целиком в памяти не держится, и хранится по sha256 содержимого:
+#   <MEDIA_DIR>/<первые 2 символа>/<sha256>.<расширение>
+# Одинаковые файлы хранятся один раз, а содержимое по id (имени файла) никогда не меняется:
+# ETag — сам id, клиенты кэшируют ответ навсегда, повторные отрисовки чата не качают заново.
+#
+# Тип определяется по сигнатуре содержимого, а не по заголовку клиента: картинки отдаются
+# как картинки, всё остальное — application/octet-stream вложением.
+# Уменьшенные копии картинок (?size=) один раз, при первом запросе, делает Pillow в своём
+# пуле потоков; для битой картинки отдаётся оригинал. Без Pillow копий нет: ответ загрузки
+# не обещает ссылок ?size=, а такой запрос получает оригинал.
+import asyncio
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Optional, Tuple
+from uuid import uuid4
+from fastapi import HTTPException, Response
+from fastapi.responses import FileResponse
+from database import engine
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+_database_dir = os.path.dirname(os.path.abspath(engine.url.database or "chat.db"))
+MEDIA_DIR = os.environ.get("CHAT_MEDIA_DIR") or os.path.join(_database_dir, "media")
+MAX_UPLOAD_BYTES = int(os.environ.get("CHAT_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Допустимые стороны уменьшенных копий, пикселей: произвольный ?size= не плодит файлы
+THUMBNAIL_SIZES = tuple(int(size) for size in os.environ.get("CHAT_THUMBNAIL_SIZES", "64,256").split(","))
+THUMBNAIL_WORKERS = int(os.environ.get("CHAT_THUMBNAIL_WORKERS", "2"))
+# Сколько последних битых картинок помнить, чтобы не пробовать их снова
+MAX_FAILED_THUMBNAILS = 10_000
+# Содержимое по id неизменно — кэшировать можно сколько угодно
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+# Расширение -> (сигнатура в начале файла, тип); прочее сохраняется как .bin
+IMAGE_TYPES = {
+    "jpg": (b"\xff\xd8\xff", "image/jpeg"),
+    "png": (b"\x89PNG\r\n\x1a\n", "image/png"),
+    "gif": (b"GIF8", "image/gif"),
+    "webp": (b"RIFF", "image/webp"),
+}
+MEDIA_ID = re.compile(r"[0-9a-f]{64}\.(jpg|png|gif|webp|bin)")
+# Сколько первых байт нужно для определения типа
+_SNIFF_BYTES = 12
+
+
+def sniff(head: bytes) -> str:
+    for extension, (signature, _) in IMAGE_TYPES.items():
+        if head.startswith(signature) and (extension != "webp" or head[8:12] == b"WEBP"):
+            return extension
+    return "bin"
+
+
+def media_type(media_id: str) -> str:
+    extension = media_id.rsplit(".", 1)[-1]
+    return IMAGE_TYPES[extension][1] if extension in IMAGE_TYPES else "application/octet-stream"
+
+
+def is_image(media_id: str) -> bool:
+    return media_id.rsplit(".", 1)[-1] in IMAGE_TYPES
+
+
+def has_thumbnails(media_id: str) -> bool:
+    return Image is not None and is_image(media_id)
+
+
+def media_path(media_id: str) -> str:
+    return os.path.join(MEDIA_DIR, media_id[:2], media_id)
+
+
+def thumbnail_path(media_id: str, size: int) -> str:
+    digest, extension = media_id.rsplit(".", 1)
+    # Из gif берётся первый кадр
+    extension = "png" if extension == "gif" else extension
+    return os.path.join(MEDIA_DIR, digest[:2], f"{digest}.{size}.{extension}")
+
+
+def media_info(media_id: str, size: int) -> dict:
+    url = f"/media/{media_id}"
+    return {
+        "id": media_id,
+        "url": url,
+        "content_type": media_type(media_id),
+        "size": size,
+        "thumbnails": {str(side): f"{url}?size={side}" for side in THUMBNAIL_SIZES} if has_thumbnails(media_id) else {},
+    }
+
+
+def _write(file, digest, chunk: bytes):
+    file.write(chunk)
+    digest.update(chunk)
+
+
+def _commit(file, temporary: str, path: str):
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+    if os.path.exists(path):
+        # Такой файл уже загружали
+        os.remove(temporary)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temporary, path)
+
+
+def _discard(file, temporary: str):
+    file.close()
+    try:
+        os.remove(temporary)
+    except FileNotFoundError:
+        pass
+
+
+async def save_upload(chunks: AsyncIterator[bytes], max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[str, int]:
+    """Stream chunks into a temporary file while hashing them; returns (media id, size)."""
+    temporary_dir = os.path.join(MEDIA_DIR, "tmp")
+    os.makedirs(temporary_dir, exist_ok=True)
+    temporary = os.path.join(temporary_dir, uuid4().hex)
+    file = await asyncio.to_thread(open, temporary, "wb")
+    digest = hashlib.sha256()
+    head = b""
+    size = 0
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"File is larger than {max_bytes} bytes")
+            if len(head) < _SNIFF_BYTES:
+                head += chunk[:_SNIFF_BYTES - len(head)]
+            # Запись и хэш — в потоке: диск не задерживает цикл событий
+            await asyncio.to_thread(_write, file, digest, chunk)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Empty upload")
+        media_id = f"{digest.hexdigest()}.{sniff(head)}"
+        await asyncio.to_thread(_commit, file, temporary, media_path(media_id))
+    except BaseException:
+        # В том числе обрыв соединения клиентом посреди загрузки
+        await asyncio.to_thread(_discard, file, temporary)
+        raise
+    return media_id, size
+
+
+def _make_thumbnail(source: str, target: str, side: int):
+    with Image.open(source) as image:
+        image.thumbnail((side, side))
+        if target.endswith(".jpg") and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        temporary = f"{target}.{uuid4().hex}.tmp"
+        try:
+            image.save(temporary, format={"jpg": "JPEG", "png": "PNG", "webp": "WEBP"}[target.rsplit(".", 1)[-1]])
+            os.replace(temporary, target)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+
+class Thumbnails:
+    """Resized copies of uploaded images, each generated once in a worker pool off the event loop."""
+
+    def __init__(self, workers: int = THUMBNAIL_WORKERS, max_failed: int = MAX_FAILED_THUMBNAILS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+        # Путь копии -> идущая генерация: одновременные запросы ждут одну и ту же
+        self.pending: Dict[str, asyncio.Future] = {}
+        # Копии, которые Pillow не смог сделать: для них сразу отдаётся оригинал. Порядок —
+        # последнего обращения, при переполнении забываются давно не запрошенные
+        self.failed: "OrderedDict[str, None]" = OrderedDict()
+        self.max_failed = max_failed
+
+    async def get(self, media_id: str, side: int) -> Optional[str]:
+        # Путь готовой копии; None — отдавать оригинал
+        if not has_thumbnails(media_id):
+            return None
+        target = thumbnail_path(media_id, side)
+        if target in self.failed:
+            self.failed.move_to_end(target)
+            return None
+        if os.path.exists(target):
+            return target
+        future = self.pending.get(target)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.pool, _make_thumbnail, media_path(media_id), target, side
+            )
+            self.pending[target] = future
+            future.add_done_callback(lambda _: self.pending.pop(target, None))
+        try:
+            # Отменённый запрос не отменяет генерацию, которую ждут другие
+            await asyncio.shield(future)
+        except Exception as e:
+            print(f"Thumbnail of {media_id} failed: {e}")
+            self.failed[target] = None
+            if len(self.failed) > self.max_failed:
+                self.failed.popitem(last=False)
+            return None
+        return target
+
+
+thumbnails = Thumbnails()
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+async def media_response(media_id: str, side: Optional[int], if_none_match: Optional[str]) -> Response:
+    """The file or its resized copy with immutable caching; 304 when the client already has it."""
+    # У каждой ссылки свой ETag: копия и оригинал — разные ответы
+    etag = f'"{media_id}"' if side is None else f'"{media_id}.{side}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={MEDIA_MAX_AGE}, immutable",
+        "X-Content-Type-Options": "nosniff",
+    }
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    path = media_path(media_id)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="File not found")
+    if side is not None:
+        path = await thumbnails.get(media_id, side) or path
+    if is_image(media_id):
+        return FileResponse(path, media_type=media_type(path), headers=headers)
+    # Не картинки браузер только скачивает: загруженный HTML не выполнится на нашем origin
+    return FileResponse(path, media_type=media_type(media_id), headers=headers,
+                        filename=media_id, content_disposition_type="attachment")
@@ -0,0 +1,150 @@
+# membership_cache.py
+# Кэш участников групп и пользователей для проверок прав на каждом сообщении.
+# В установившемся режиме отправка сообщения не делает ни одного лишнего SELECT.
+import threading
+from collections import OrderedDict
+from typing import FrozenSet, Iterable, NamedTuple, Optional
+from sqlalchemy.orm import Session
+from models import GroupUser, User
+
+# Сколько групп и пользователей держим в памяти (вытесняются давно не использованные)
+MAX_CACHED_GROUPS = 10_000
+MAX_CACHED_USERS = 100_000
+# Пользователей на один запрос при прогреве
+PRELOAD_CHUNK = 500
+
+
+class CachedUser(NamedTuple):
+    id: int
+    username: str
+    avatar: Optional[str]
+
+
+class MembershipCache:
+    """group_id -> member ids and user_id -> identity, loaded on miss and invalidated on writes.
+
+    Used from the event loop and from DB threads, hence the lock.
+    """
+
+    def __init__(self, max_groups: int = MAX_CACHED_GROUPS, max_users: int = MAX_CACHED_USERS):
+        self.max_groups = max_groups
+        self.max_users = max_users
+        self._members: "OrderedDict[int, FrozenSet[int]]" = OrderedDict()
+        self._users: "OrderedDict[int, CachedUser]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Растут при каждой инвалидации: загрузка, начатая до неё, не попадёт в кэш
+        self._members_version = 0
+        self._users_version = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Только память: None, если группы нет в кэше
+    def cached_members(self, group_id: int) -> Optional[FrozenSet[int]]:
+        with self._lock:
+            members = self._members.get(group_id)
+            if members is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._members.move_to_end(group_id)
+            return members
+
+    def load_members(self, db: Session, group_id: int) -> FrozenSet[int]:
+        version = self._members_version
+        members = frozenset(
+            user_id for (user_id,) in db.query(GroupUser.user_id).filter(GroupUser.group_id == group_id)
+        )
+        with self._lock:
+            if version == self._members_version:
+                self._members[group_id] = members
+                if len(self._members) > self.max_groups:
+                    self._members.popitem(last=False)
+        return members
+
+    def members(self, db: Session, group_id: int) -> FrozenSet[int]:
+        members = self.cached_members(group_id)
+        return members if members is not None else self.load_members(db, group_id)
+
+    def is_member(self, db: Session, group_id: int, user_id: int) -> bool:
+        return user_id in self.members(db, group_id)
+
+    # Только память: None, если пользователя нет в кэше
+    def cached_user(self, user_id: int) -> Optional[CachedUser]:
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._users.move_to_end(user_id)
+            return user
+
+    def load_user(self, db: Session, user_id: int) -> Optional[CachedUser]:
+        version = self._users_version
+        row = db.query(User.id, User.username, User.avatar).filter(User.id == user_id).first()
+        if row is None:
+            # Отсутствие не кэшируем: пользователь с таким id может появиться позже
+            return None
+        user = CachedUser(*row)
+        with self._lock:
+            if version == self._users_version:
+                self._users[user_id] = user
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+        return user
+
+    def user(self, db: Session, user_id: int) -> Optional[CachedUser]:
+        user = self.cached_user(user_id)
+        return user if user is not None else self.load_user(db, user_id)
+
+    def preload(self, db: Session, group_ids: Iterable[int]) -> int:
+        """Load members of the given groups and those users in bulk; returns how many users were loaded."""
+        group_ids = list(group_ids)
+        if not group_ids:
+            return 0
+        members_version, users_version = self._members_version, self._users_version
+        members = {group_id: set() for group_id in group_ids}
+        for group_id, user_id in db.query(GroupUser.group_id, GroupUser.user_id).filter(
+            GroupUser.group_id.in_(group_ids)
+        ):
+            members[group_id].add(user_id)
+        user_ids = sorted(set().union(*members.values()))
+        users = []
+        # Пакетами, чтобы не упереться в предел параметров запроса SQLite
+        for start in range(0, len(user_ids), PRELOAD_CHUNK):
+            chunk = user_ids[start:start + PRELOAD_CHUNK]
+            users += [CachedUser(*row) for row in
+                      db.query(User.id, User.username, User.avatar).filter(User.id.in_(chunk))]
+        with self._lock:
+            if members_version == self._members_version:
+                for group_id in group_ids[:self.max_groups]:
+                    self._members[group_id] = frozenset(members[group_id])
+                while len(self._members) > self.max_groups:
+                    self._members.popitem(last=False)
+            if users_version == self._users_version:
+                for user in users[:self.max_users]:
+                    self._users[user.id] = user
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+        return len(users)
+
+    def invalidate_group(self, group_id: int):
+        with self._lock:
+            self._members_version += 1
+            self._members.pop(group_id, None)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            self._users_version += 1
+            self._users.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "groups": len(self._members),
+            "users": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+membership = MembershipCache()
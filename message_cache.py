@@ -0,0 +1,179 @@
+# message_cache.py
+# Кэш последних сообщений горячих групп: GET /messages без курсора отдаётся из памяти.
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from serialization import loads
+
+# Сколько последних сообщений держим на группу
+RECENT_MESSAGES_PER_GROUP = 200
+# Общий лимит памяти кэша (оценка по размеру содержимого)
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Примерные накладные расходы на одно сообщение (dict, автор, timestamp)
+_MESSAGE_OVERHEAD = 400
+
+
+def _message_size(message: dict) -> int:
+    return len(message.get("content") or "") + _MESSAGE_OVERHEAD
+
+
+class _GroupBuffer:
+    def __init__(self):
+        self.ids: List[int] = []
+        self.messages: List[dict] = []
+        self.bytes = 0
+        # True, если в буфере вся история группы (старше ничего нет)
+        self.complete = False
+
+
+class RecentMessageCache:
+    """Per-group ring buffer of the newest serialized messages with LRU eviction of cold groups.
+
+    A buffer always holds a contiguous tail of the group's history, so any page that
+    falls inside it can be served without touching the database.
+    """
+
+    def __init__(self, per_group: int = RECENT_MESSAGES_PER_GROUP, max_bytes: int = CACHE_MAX_BYTES):
+        self.per_group = per_group
+        self.max_bytes = max_bytes
+        self.groups: "OrderedDict[int, _GroupBuffer]" = OrderedDict()
+        self.total_bytes = 0
+        # Группы, для которых сейчас идёт загрузка из БД; True — пока грузили, были записи
+        self.filling: Dict[int, bool] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_page(self, group_id: int, before_id: Optional[int], limit: int) -> Optional[Tuple[List[dict], bool]]:
+        buffer = self.groups.get(group_id)
+        if buffer is None:
+            self.misses += 1
+            return None
+        end = len(buffer.ids) if before_id is None else bisect_left(buffer.ids, before_id)
+        if end < limit and not buffer.complete:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.groups.move_to_end(group_id)
+        start = max(0, end - limit)
+        has_more = start > 0 or not buffer.complete
+        return buffer.messages[start:end], has_more
+
+    def begin_fill(self, group_id: int):
+        self.filling[group_id] = self.filling.get(group_id, False)
+
+    def fill(self, group_id: int, messages: List[dict], complete: bool):
+        # messages — самая новая страница из БД по возрастанию id
+        dirty = self.filling.pop(group_id, True)
+        if dirty:
+            # Пока читали из БД, в группу писали — страница могла устареть
+            return
+        buffer = self.groups.get(group_id)
+        if buffer is not None:
+            # Более свежие версии из кэша важнее прочитанных из БД
+            merged = {m["id"]: m for m in messages}
+            merged.update(zip(buffer.ids, buffer.messages))
+            messages = [merged[message_id] for message_id in sorted(merged)]
+            complete = complete or buffer.complete
+            self._drop(group_id)
+        buffer = _GroupBuffer()
+        buffer.complete = complete
+        self.groups[group_id] = buffer
+        for message in messages:
+            self._insert(buffer, message)
+        self._trim(buffer)
+        self._enforce_limit()
+
+    def append(self, group_id: int, message: dict):
+        buffer = self.groups.get(group_id)
+        if buffer is None:
+            return
+        self._insert(buffer, message)
+        self._trim(buffer)
+        self._enforce_limit()
+
+    def update(self, group_id: int, message: dict):
+        buffer = self.groups.get(group_id)
+        if buffer is None:
+            return
+        index = bisect_left(buffer.ids, message["id"])
+        if index < len(buffer.ids) and buffer.ids[index] == message["id"]:
+            old = buffer.messages[index]
+            buffer.messages[index] = message
+            delta = _message_size(message) - _message_size(old)
+            buffer.bytes += delta
+            self.total_bytes += delta
+
+    def remove(self, group_id: int, message_id: int):
+        buffer = self.groups.get(group_id)
+        if buffer is None:
+            return
+        index = bisect_left(buffer.ids, message_id)
+        if index < len(buffer.ids) and buffer.ids[index] == message_id:
+            del buffer.ids[index]
+            size = _message_size(buffer.messages.pop(index))
+            buffer.bytes -= size
+            self.total_bytes -= size
+
+    def drop_group(self, group_id: int):
+        # Загрузка из БД, начатая до этого, не должна вернуть группу в кэш
+        if group_id in self.filling:
+            self.filling[group_id] = True
+        if group_id in self.groups:
+            self._drop(group_id)
+
+    def apply_event(self, group_id: int, payload: str):
+        # Вызывается для каждой рассылки в группу (во всех воркерах через брокер)
+        if group_id in self.filling:
+            self.filling[group_id] = True
+        if group_id not in self.groups:
+            return
+        event = loads(payload)
+        kind = event.get("type")
+        if kind == "new_message":
+            self.append(group_id, event["data"])
+        elif kind == "updated_message":
+            self.update(group_id, event["data"])
+        elif kind == "deleted_message":
+            self.remove(group_id, event["data"]["id"])
+
+    def stats(self) -> dict:
+        return {
+            "groups": len(self.groups),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _insert(self, buffer: _GroupBuffer, message: dict):
+        index = bisect_left(buffer.ids, message["id"])
+        if index < len(buffer.ids) and buffer.ids[index] == message["id"]:
+            return
+        # Параллельные отправки могут прийти не по порядку id
+        buffer.ids.insert(index, message["id"])
+        buffer.messages.insert(index, message)
+        size = _message_size(message)
+        buffer.bytes += size
+        self.total_bytes += size
+
+    def _trim(self, buffer: _GroupBuffer):
+        extra = len(buffer.ids) - self.per_group
+        if extra <= 0:
+            return
+        size = sum(_message_size(m) for m in buffer.messages[:extra])
+        del buffer.ids[:extra]
+        del buffer.messages[:extra]
+        buffer.bytes -= size
+        self.total_bytes -= size
+        buffer.complete = False
+
+    def _enforce_limit(self):
+        while self.total_bytes > self.max_bytes and self.groups:
+            group_id = next(iter(self.groups))
+            self._drop(group_id)
+            self.evictions += 1
+
+    def _drop(self, group_id: int):
+        buffer = self.groups.pop(group_id)
+        self.total_bytes -= buffer.bytes
@@ -0,0 +1,214 @@
+# message_log.py
+# Журнал изменений для докачки после переподключения. У каждой группы свой возрастающий
+# номер события (chat_summaries.last_seq), общий для новых, изменённых и удалённых
+# сообщений; номер приходит в кадрах рассылки ("seq"). Клиент при переподписке присылает
+# последний применённый номер и получает только пропущенное, свёрнутое до текущего
+# состояния сообщений, или resync_required, если журнал уже сжат дальше этого номера.
+import asyncio
+import os
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm import Session
+from models import ChatSummary, MessageEvent
+from serialization import messages_by_id
+from wire_format import DELETED_MESSAGE, NEW_MESSAGE, UPDATED_MESSAGE
+
+# Сколько последних событий хранить на группу; более старые удаляет compact()
+EVENT_LOG_RETENTION = int(os.environ.get("CHAT_EVENT_LOG_RETENTION", "1000"))
+# Больше событий за одну докачку не отдаём: клиенту дешевле перечитать историю
+MAX_RESUME_EVENTS = int(os.environ.get("CHAT_MAX_RESUME_EVENTS", "500"))
+# Как часто сжимать журнал, секунды
+EVENT_LOG_COMPACT_INTERVAL = 300
+
+EVENT_TYPES = {NEW_MESSAGE: "new_message", UPDATED_MESSAGE: "updated_message", DELETED_MESSAGE: "deleted_message"}
+
+
+class SequenceAllocator:
+    """In-memory event numbers for the write-behind writer, whose rows reach the DB later."""
+
+    def __init__(self, last_seqs: Dict[int, int]):
+        self.last_seqs = last_seqs
+        # Номера берут и event loop (новые сообщения), и потоки БД (правки, удаления)
+        self.lock = threading.Lock()
+
+    def allocate(self, group_id: int, count: int = 1) -> int:
+        with self.lock:
+            first = self.last_seqs.get(group_id, 0) + 1
+            self.last_seqs[group_id] = first + count - 1
+        return first
+
+
+# Задаётся MessageWriter на время его работы; иначе номера выдаёт БД в транзакции записи
+_allocator: Optional[SequenceAllocator] = None
+
+
+def use_memory_sequences(allocator: Optional[SequenceAllocator]):
+    global _allocator
+    _allocator = allocator
+
+
+def load_sequences(db: Session) -> Dict[int, int]:
+    return dict(db.query(ChatSummary.group_id, ChatSummary.last_seq))
+
+
+def allocate(db: Session, group_id: int, count: int = 1) -> Optional[int]:
+    # Первый из count номеров; None — у группы нет сводки (её уже удалили)
+    if _allocator is not None:
+        return _allocator.allocate(group_id, count)
+    # Писатель держит блокировку записи до коммита: номера видны читателям по порядку
+    last = db.execute(
+        update(ChatSummary)
+        .where(ChatSummary.group_id == group_id)
+        .values(last_seq=ChatSummary.last_seq + count)
+        .returning(ChatSummary.last_seq)
+    ).scalar()
+    return None if last is None else last - count + 1
+
+
+def record(db: Session, events: List[Tuple[int, int, int, int]]):
+    # events — (group_id, seq, kind, message_id); коммитит вызывающий
+    if not events:
+        return
+    db.execute(insert(MessageEvent), [
+        {"group_id": group_id, "seq": seq, "kind": kind, "message_id": message_id}
+        for group_id, seq, kind, message_id in events
+    ])
+    if _allocator is not None:
+        # Номера выданы в памяти: сохраняем последний, чтобы продолжить с него после перезапуска
+        last = {}
+        for group_id, seq, _, _ in events:
+            last[group_id] = max(seq, last.get(group_id, 0))
+        for group_id, seq in last.items():
+            db.execute(
+                update(ChatSummary)
+                .where(ChatSummary.group_id == group_id)
+                .values(last_seq=func.max(ChatSummary.last_seq, seq))
+            )
+
+
+def log_event(db: Session, group_id: int, kind: int, message_id: int) -> Optional[int]:
+    seq = allocate(db, group_id)
+    if seq is not None:
+        record(db, [(group_id, seq, kind, message_id)])
+    return seq
+
+
+def log_new_messages(db: Session, rows: List[dict]) -> List[Tuple[int, int, int, int]]:
+    # Пакет сообщений (с id): номера подряд на каждую группу, события по порядку id
+    events = []
+    for group_id, count in Counter(row["group_id"] for row in rows if row.get("group_id") is not None).items():
+        seq = allocate(db, group_id, count)
+        if seq is None:
+            continue
+        ids = sorted(row["id"] for row in rows if row.get("group_id") == group_id)
+        events.extend((group_id, seq + offset, NEW_MESSAGE, message_id) for offset, message_id in enumerate(ids))
+    record(db, events)
+    return events
+
+
+def drop_log(db: Session, group_id: int):
+    # Удалённая группа: её id может достаться новой, журнал начинается заново
+    db.query(MessageEvent).filter(MessageEvent.group_id == group_id).delete()
+
+
+def forget_messages(db: Session, group_id: int, message_ids: List[int]):
+    # Сообщения ушли из messages в архив или по сроку хранения (retention.py): события о них
+    # докачать уже нельзя — журнал сжимается за последнее такое событие, раньше — resync_required
+    seq = db.query(func.max(MessageEvent.seq)).filter(
+        MessageEvent.group_id == group_id, MessageEvent.message_id.in_(message_ids)
+    ).scalar()
+    if seq is None:
+        return
+    db.query(MessageEvent).filter(MessageEvent.group_id == group_id, MessageEvent.seq <= seq).delete()
+    db.execute(
+        update(ChatSummary)
+        .where(ChatSummary.group_id == group_id)
+        .values(compacted_seq=func.max(ChatSummary.compacted_seq, seq))
+    )
+
+
+def _resync(group_id: int, seq: int) -> dict:
+    return {"type": "resync_required", "data": {"group_id": group_id, "seq": seq}}
+
+
+def _collapse(rows) -> List[list]:
+    # Одна запись [kind, seq, message_id] на сообщение с его последним номером. Id удалённых
+    # сообщений новым не выдаются (id_floors, retention.next_message_id): после удаления
+    # событий этого id уже не бывает
+    entries, live = [], {}
+    for seq, kind, message_id in rows:
+        entry = live.get(message_id)
+        if kind == NEW_MESSAGE or entry is None:
+            entry = [kind, seq, message_id]
+            entries.append(entry)
+        elif kind == UPDATED_MESSAGE:
+            entry[1] = seq
+        elif entry[0] == NEW_MESSAGE:
+            # Появилось и исчезло, пока клиента не было, — ему нечего удалять
+            entries.remove(entry)
+        else:
+            entry[0], entry[1] = DELETED_MESSAGE, seq
+        live[message_id] = entry if kind != DELETED_MESSAGE else None
+    return sorted(entries, key=lambda entry: entry[1])
+
+
+def events_since(db: Session, group_id: int, since: int) -> dict:
+    """Frame with the events after `since`, collapsed to one per message, or resync_required."""
+    summary = db.query(ChatSummary.last_seq, ChatSummary.compacted_seq).filter(
+        ChatSummary.group_id == group_id
+    ).first()
+    if summary is None:
+        return _resync(group_id, 0)
+    # Номер больше текущего — клиент помнит другую базу (id удалённых групп не переиспользуются)
+    if since < summary.compacted_seq or since > summary.last_seq:
+        return _resync(group_id, summary.last_seq)
+    rows = db.execute(
+        select(MessageEvent.seq, MessageEvent.kind, MessageEvent.message_id)
+        .where(MessageEvent.group_id == group_id, MessageEvent.seq > since)
+        .order_by(MessageEvent.seq)
+        .limit(MAX_RESUME_EVENTS + 1)
+    ).all()
+    if len(rows) > MAX_RESUME_EVENTS:
+        return _resync(group_id, summary.last_seq)
+    entries = _collapse(rows)
+    ids = [message_id for kind, _, message_id in entries if kind != DELETED_MESSAGE]
+    found = messages_by_id(db, ids)
+    events = []
+    for kind, seq, message_id in entries:
+        message = found.get(message_id) if kind != DELETED_MESSAGE else None
+        if message is None:
+            events.append({"type": EVENT_TYPES[DELETED_MESSAGE], "seq": seq,
+                           "data": {"id": message_id, "group_id": group_id}})
+        else:
+            events.append({"type": EVENT_TYPES[kind], "seq": seq, "data": message})
+    return {"type": "resume", "data": {"group_id": group_id, "seq": summary.last_seq, "events": events}}
+
+
+def compact(db: Session, retention: int = EVENT_LOG_RETENTION) -> int:
+    # Группы, у которых журнал перерос порог больше чем на четверть: удаляем разом, а не по событию
+    groups = db.query(ChatSummary).filter(
+        ChatSummary.last_seq - ChatSummary.compacted_seq > retention + retention // 4
+    ).all()
+    removed = 0
+    for summary in groups:
+        bound = summary.last_seq - retention
+        removed += db.query(MessageEvent).filter(
+            MessageEvent.group_id == summary.group_id, MessageEvent.seq <= bound
+        ).delete(synchronize_session=False)
+        summary.compacted_seq = bound
+    db.commit()
+    return removed
+
+
+async def compact_periodically(run_db, interval: float = EVENT_LOG_COMPACT_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await run_db(compact)
+        except Exception as e:
+            print(f"Event log compaction failed: {e}")
+        else:
+            if removed:
+                print(f"Compacted event log: {removed} events removed")
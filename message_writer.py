@@ -0,0 +1,145 @@
+# message_writer.py
+# Запись сообщений в БД: напрямую (одна транзакция на сообщение) или через
+# фоновый писатель, который склеивает сообщения в пакетные INSERT.
+import asyncio
+import os
+from typing import List, Optional, Tuple
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+from chat_list import record_messages
+from database import run_db
+from message_log import (SequenceAllocator, load_sequences, log_event, log_new_messages, record,
+                         use_memory_sequences)
+from models import Message
+from retention import id_floor, next_message_id
+from wire_format import NEW_MESSAGE
+
+# Включает отложенную пакетную запись (только для одного процесса: id выдаются в памяти)
+WRITE_BEHIND = os.environ.get("CHAT_WRITE_BEHIND", "0") == "1"
+# Коммитим, когда накопилось столько сообщений...
+WRITE_BATCH_SIZE = int(os.environ.get("CHAT_WRITE_BATCH_SIZE", "200"))
+# ...или прошло столько миллисекунд
+WRITE_BATCH_MS = int(os.environ.get("CHAT_WRITE_BATCH_MS", "20"))
+# "commit" — отвечаем и рассылаем после коммита, "enqueue" — сразу после постановки в очередь
+WRITE_ACK = os.environ.get("CHAT_WRITE_ACK", "commit")
+
+
+# Список чатов (сводки и непрочитанное) и журнал событий группы обновляются в той же
+# транзакции, что и сообщения. Возвращает id сообщения и номер его события.
+# Id выдаётся выше удалённых и архивных (retention.next_message_id), а не max(id) + 1 базы
+def insert_message(db: Session, row: dict) -> Tuple[int, Optional[int]]:
+    result = db.execute(insert(Message).values(id=next_message_id(), **row))
+    message_id = result.inserted_primary_key[0]
+    record_messages(db, [dict(row, id=message_id)])
+    seq = log_event(db, row["group_id"], NEW_MESSAGE, message_id) if row.get("group_id") is not None else None
+    db.commit()
+    return message_id, seq
+
+
+def insert_messages(db: Session, rows: List[dict], events: Optional[List[Tuple[int, int, int, int]]] = None):
+    # Один executemany и один коммит на весь пакет; events — номера, уже выданные писателем
+    db.execute(insert(Message), rows)
+    record_messages(db, rows)
+    if events is None:
+        log_new_messages(db, rows)
+    else:
+        record(db, events)
+    db.commit()
+
+
+def _max_message_id(db: Session) -> int:
+    return max(db.query(func.max(Message.id)).scalar() or 0, id_floor(db, "messages"))
+
+
+class MessageWriter:
+    """Assigns message ids up front and persists rows in batches in the background."""
+
+    def __init__(self, batch_size: int = WRITE_BATCH_SIZE, batch_ms: int = WRITE_BATCH_MS, ack: str = WRITE_ACK):
+        if ack not in ("commit", "enqueue"):
+            raise ValueError(f"Unknown write ack mode: {ack}")
+        self.batch_size = batch_size
+        self.batch_interval = batch_ms / 1000
+        self.ack = ack
+        self.pending: List[dict] = []
+        self.pending_events: List[Tuple[int, int, int, int]] = []
+        # Разрешается, когда закоммичен пакет с текущими pending
+        self.pending_done: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.inflight_done: Optional[asyncio.Future] = None
+        self.next_id = 0
+        self.committed_id = 0
+        self.sequences: Optional[SequenceAllocator] = None
+        self.wakeup = asyncio.Event()
+        self.closing = False
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.committed_id = await run_db(_max_message_id)
+        self.next_id = self.committed_id + 1
+        # Номера событий тоже выдаём в памяти: кадр рассылается раньше, чем строка попадёт в БД
+        self.sequences = SequenceAllocator(await run_db(load_sequences))
+        use_memory_sequences(self.sequences)
+        self.task = asyncio.create_task(self._run())
+
+    async def submit(self, row: dict) -> Tuple[int, Optional[int]]:
+        row["id"] = self.next_id
+        self.next_id += 1
+        self.pending.append(row)
+        seq = None
+        if row.get("group_id") is not None:
+            seq = self.sequences.allocate(row["group_id"])
+            self.pending_events.append((row["group_id"], seq, NEW_MESSAGE, row["id"]))
+        done = self.pending_done
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+        if self.ack == "commit":
+            # Если пакет не записался, исключение получит отправитель
+            await asyncio.shield(done)
+        return row["id"], seq
+
+    async def wait_persisted(self, message_id: int):
+        # Правка/удаление сообщения, которое ещё лежит в очереди, ждёт его коммита
+        while self.committed_id < message_id < self.next_id:
+            in_pending = self.pending and message_id >= self.pending[0]["id"]
+            done = self.pending_done if in_pending else self.inflight_done
+            self.wakeup.set()
+            try:
+                await asyncio.shield(done)
+            except Exception:
+                pass
+
+    async def _run(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.batch_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        events, self.pending_events = self.pending_events, []
+        done = self.inflight_done = self.pending_done
+        self.pending_done = asyncio.get_running_loop().create_future()
+        try:
+            await run_db(insert_messages, batch, events)
+        except Exception as e:
+            # В режиме enqueue сообщения уже разосланы — остаётся только сообщить о потере
+            print(f"Write-behind flush failed, {len(batch)} messages lost: {e}")
+            done.set_exception(e)
+            done.exception()  # помечаем как полученное, если никто не ждёт
+        else:
+            done.set_result(None)
+        finally:
+            self.committed_id = batch[-1]["id"]
+
+    async def close(self):
+        # Дописываем всё, что осталось в очереди, перед остановкой
+        self.closing = True
+        self.wakeup.set()
+        if self.task is not None:
+            await self.task
+        await self.flush()
+        use_memory_sequences(None)
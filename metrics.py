@@ -0,0 +1,265 @@
+# metrics.py
+# Встроенные метрики в текстовом формате Prometheus (GET /metrics), без внешних зависимостей:
+# задержки REST по маршрутам, обработка кадров WebSocket, запросы к БД (всего и на HTTP-запрос),
+# время рассылки, сокеты по группам и задержка event loop. Метрики — на процесс-воркер.
+#
+# Медленные запросы и рассылки печатаются, только если задан порог:
+#   CHAT_SLOW_QUERY_MS=50 CHAT_SLOW_BROADCAST_MS=20 uvicorn main:app
+import asyncio
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Tuple
+
+METRICS_ENABLED = os.environ.get("CHAT_METRICS", "1") == "1"
+# Пороги журналов медленных операций, мс; 0 — выключено
+SLOW_QUERY_MS = float(os.environ.get("CHAT_SLOW_QUERY_MS", "0"))
+SLOW_BROADCAST_MS = float(os.environ.get("CHAT_SLOW_BROADCAST_MS", "0"))
+# Как часто замерять задержку event loop, секунды
+EVENT_LOOP_LAG_INTERVAL = 0.5
+# Сокеты показываем по стольким самым большим группам (ограничение числа рядов)
+TOP_GROUPS = int(os.environ.get("CHAT_METRICS_TOP_GROUPS", "50"))
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000, 5000, 10000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple, object] = {}
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.function: Optional[Callable[[], Dict[Tuple, float]]] = None
+
+    def set(self, value: float, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def set_function(self, function: Callable[[], Dict[Tuple, float]]):
+        # Значения считаются при каждом опросе /metrics, а не на горячем пути
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in self.function().items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        # Счётчики по корзинам без накопления: накапливаются только при выводе
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self.values.items()]
+        lines = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+http_requests = Counter("chat_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_request_seconds = Histogram("chat_http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+http_request_queries = Histogram("chat_http_request_db_queries", "DB queries per HTTP request", ("route",),
+                                 buckets=COUNT_BUCKETS)
+http_request_db_seconds = Histogram("chat_http_request_db_seconds", "DB time per HTTP request", ("route",))
+db_query_seconds = Histogram("chat_db_query_duration_seconds", "DB statement latency", ("pool",))
+ws_frame_seconds = Histogram("chat_ws_frame_duration_seconds", "Inbound WebSocket frame handling time", ("type",))
+broadcast_seconds = Histogram("chat_broadcast_fanout_seconds", "Time to queue a broadcast to local sockets",
+                              ("channel",))
+broadcast_recipients = Histogram("chat_broadcast_recipients", "Local sockets per broadcast", ("channel",),
+                                 buckets=COUNT_BUCKETS)
+ws_connections = Gauge("chat_ws_connections", "Open WebSocket connections")
+ws_group_connections = Gauge("chat_ws_group_connections", "Open sockets subscribed to a group (largest groups)",
+                             ("group_id",))
+event_loop_lag_seconds = Histogram("chat_event_loop_lag_seconds", "Event loop scheduling delay")
+rate_limited_total = Counter("chat_rate_limited_total", "Inbound frames and messages refused by rate limits",
+                             ("scope",))
+retention_messages_total = Counter("chat_retention_messages_total",
+                                   "Messages moved out of the hot table by retention", ("action",))
+startup_seconds = Gauge("chat_startup_seconds", "Time spent in each startup phase of this worker", ("phase",))
+warmed_entries = Gauge("chat_warmed_cache_entries", "Cache entries loaded before accepting traffic", ("cache",))
+
+REGISTRY = [
+    http_requests, http_request_seconds, http_request_queries, http_request_db_seconds, db_query_seconds,
+    ws_frame_seconds, broadcast_seconds, broadcast_recipients, ws_connections, ws_group_connections,
+    event_loop_lag_seconds, rate_limited_total, retention_messages_total, startup_seconds, warmed_entries,
+]
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+class _RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Статистика текущего HTTP-запроса; потоки БД видят её через copy_context (database.run_db)
+_request_stats: ContextVar[Optional[_RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def instrument_engine(engine, pool: str):
+    from sqlalchemy import event
+
+    if not METRICS_ENABLED:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Начало — в контексте выполнения: упавший запрос не оставит его висеть
+        context.query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.query_started
+        db_query_seconds.observe(elapsed, pool)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            print(f"Slow query ({pool}, {elapsed * 1000:.1f} ms): {' '.join(statement.split())[:300]}")
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing HTTP requests per route template, with their DB query count."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        stats = _RequestStats()
+        token = _request_stats.set(stats)
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_stats.reset(token)
+            # Шаблон маршрута (/messages/{message_id}), а не путь: число рядов не растёт с id.
+            # Статика и 404 — одним рядом
+            route = getattr(scope.get("route"), "path", "other")
+            http_requests.inc(scope["method"], route, status[0])
+            http_request_seconds.observe(elapsed, scope["method"], route)
+            http_request_queries.observe(stats.queries, route)
+            http_request_db_seconds.observe(stats.db_seconds, route)
+
+
+def observe_broadcast(channel: str, recipients: int, elapsed: float):
+    broadcast_seconds.observe(elapsed, channel)
+    broadcast_recipients.observe(recipients, channel)
+    if SLOW_BROADCAST_MS and elapsed * 1000 >= SLOW_BROADCAST_MS:
+        print(f"Slow broadcast ({channel}) to {recipients} sockets: {elapsed * 1000:.1f} ms")
+
+
+def watch_connections(manager):
+    ws_connections.set_function(lambda: {(): len(manager.all_connections)})
+
+    def largest_groups():
+        sizes = sorted(((len(sockets), group_id) for group_id, sockets in manager.group_connections.items()),
+                       reverse=True)[:TOP_GROUPS]
+        return {(group_id,): size for size, group_id in sizes}
+
+    ws_group_connections.set_function(largest_groups)
+
+
+async def monitor_event_loop(interval: float = EVENT_LOOP_LAG_INTERVAL):
+    # Насколько позже заказанного просыпается sleep: время, которое кто-то занимал loop
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, loop.time() - started - interval))
@@ -0,0 +1,224 @@
+# migrations.py
+# Версионированные изменения схемы для уже существующих баз (chat.db). Номер применённой
+# версии хранится в PRAGMA user_version. Каждая миграция идемпотентна: на новой базе
+# baseline уже создаёт актуальную схему из models.py, а остальные шаги ничего не меняют.
+#
+# Применяются при импорте database.py (CHAT_AUTO_MIGRATE=0 — только вручную):
+#   python -m migrations            # текущая версия и список миграций
+#   python -m migrations upgrade    # до последней версии (или upgrade <N>)
+import sqlite3
+import sys
+import time
+from contextlib import nullcontext
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from models import ArchiveSegment, Base, DeletedGroup, IdFloor, MessageEvent
+from search import create_search_index
+
+
+def _columns(connection: Connection, table: str) -> set:
+    return {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def _baseline(connection: Connection):
+    # Недостающие таблицы (с их индексами); существующие таблицы create_all не трогает
+    Base.metadata.create_all(bind=connection)
+
+
+def _unread_count(connection: Connection):
+    if "unread_count" not in _columns(connection, "group_users"):
+        connection.execute(text("ALTER TABLE group_users ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0"))
+
+
+def _unique_membership(connection: Connection):
+    # Дубли (group_id, user_id) из гонок add_user: оставляем самую раннюю запись.
+    # Участники удалённых групп тоже уходят — их id достанется новой группе
+    removed = connection.execute(text("""
+        DELETE FROM group_users WHERE id NOT IN (
+            SELECT min(id) FROM group_users GROUP BY group_id, user_id
+        ) OR group_id NOT IN (SELECT id FROM groups)
+    """)).rowcount
+    if removed:
+        print(f"Removed {removed} duplicate or orphaned group memberships")
+        connection.execute(text("""
+            UPDATE chat_summaries SET member_count = (
+                SELECT count(*) FROM group_users WHERE group_users.group_id = chat_summaries.group_id
+            )
+        """))
+    connection.execute(text("DROP INDEX IF EXISTS ix_group_users_group_id_user_id"))
+    connection.execute(text("DROP INDEX IF EXISTS ix_group_users_user_id"))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_group_users_group_id_user_id ON group_users (group_id, user_id)"
+    ))
+    # Группы пользователя (список чатов, область поиска) читаются только из индекса
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_group_users_user_id_group_id ON group_users (user_id, group_id)"
+    ))
+
+
+def _message_indexes(connection: Connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_group_id_id ON messages (group_id, id)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_group_id_timestamp ON messages (group_id, timestamp)"
+    ))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_recipient_id ON messages (recipient_id)"))
+
+
+def _event_log(connection: Connection):
+    # Нумерация событий начинается с нуля: изменения до миграции в журнал не попадают
+    columns = _columns(connection, "chat_summaries")
+    for column in ("last_seq", "compacted_seq"):
+        if column not in columns:
+            connection.execute(text(f"ALTER TABLE chat_summaries ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+    MessageEvent.__table__.create(bind=connection, checkfirst=True)
+
+
+def _read_watermarks(connection: Connection):
+    if "last_read_id" not in _columns(connection, "group_users"):
+        connection.execute(text("ALTER TABLE group_users ADD COLUMN last_read_id INTEGER"))
+    # У кого непрочитанного нет, тот прочитал группу до последнего сообщения
+    connection.execute(text("""
+        UPDATE group_users SET last_read_id = (
+            SELECT last_message_id FROM chat_summaries WHERE chat_summaries.group_id = group_users.group_id
+        ) WHERE unread_count = 0 AND last_read_id IS NULL
+    """))
+
+
+def _direct_messages(connection: Connection):
+    if "dm_key" not in _columns(connection, "groups"):
+        connection.execute(text("ALTER TABLE groups ADD COLUMN dm_key VARCHAR"))
+    # Ключ получает старейший личный чат каждой пары; дубли, созданные повторными
+    # открытиями, остаются обычными группами
+    connection.execute(text("""
+        UPDATE groups SET dm_key = (
+            SELECT min(user_id) || ':' || max(user_id) FROM group_users WHERE group_users.group_id = groups.id
+        ) WHERE type = 'private' AND dm_key IS NULL
+          AND (SELECT count(*) FROM group_users WHERE group_users.group_id = groups.id) = 2
+    """))
+    connection.execute(text("""
+        UPDATE groups SET dm_key = NULL WHERE dm_key IS NOT NULL AND id NOT IN (
+            SELECT min(id) FROM groups WHERE dm_key IS NOT NULL GROUP BY dm_key
+        )
+    """))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_groups_dm_key ON groups (dm_key) WHERE dm_key IS NOT NULL"
+    ))
+    connection.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_messages_direct
+        ON messages (min(author_id, recipient_id), max(author_id, recipient_id), id)
+        WHERE recipient_id IS NOT NULL AND group_id IS NULL
+    """))
+
+
+def _retention(connection: Connection):
+    DeletedGroup.__table__.create(bind=connection, checkfirst=True)
+    ArchiveSegment.__table__.create(bind=connection, checkfirst=True)
+    # Сообщения групп, удалённых до этой миграции, вычищаются тем же фоновым путём
+    connection.execute(text("""
+        INSERT OR IGNORE INTO deleted_groups (group_id)
+        SELECT DISTINCT group_id FROM messages
+        WHERE group_id IS NOT NULL AND group_id NOT IN (SELECT id FROM groups)
+    """))
+
+
+def _message_counters(connection: Connection):
+    # Непрочитанное = message_count группы - read_count участника. Счётчики отсчитываются от
+    # числа сообщений в таблице, так что у каждого сохраняется прежний unread_count
+    if "message_count" not in _columns(connection, "chat_summaries"):
+        connection.execute(text("ALTER TABLE chat_summaries ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0"))
+    columns = _columns(connection, "group_users")
+    if "read_count" not in columns:
+        connection.execute(text("ALTER TABLE group_users ADD COLUMN read_count INTEGER NOT NULL DEFAULT 0"))
+    connection.execute(text("""
+        UPDATE chat_summaries SET message_count = (
+            SELECT count(*) FROM messages WHERE messages.group_id = chat_summaries.group_id
+        )
+    """))
+    if "unread_count" not in columns:
+        return
+    connection.execute(text("""
+        UPDATE group_users SET read_count = max(0, coalesce(
+            (SELECT message_count FROM chat_summaries WHERE chat_summaries.group_id = group_users.group_id),
+            (SELECT count(*) FROM messages WHERE messages.group_id = group_users.group_id)
+        ) - unread_count)
+    """))
+    # DROP COLUMN появился в SQLite 3.35; на старых версиях колонка остаётся и не используется
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        connection.execute(text("ALTER TABLE group_users DROP COLUMN unread_count"))
+
+
+def _id_floors(connection: Connection):
+    IdFloor.__table__.create(bind=connection, checkfirst=True)
+    # Ещё не вычищенные удалённые группы и ушедшие в архив сообщения уже заняли свои id
+    connection.execute(text("""
+        INSERT OR IGNORE INTO id_floors (name, value)
+        SELECT 'groups', (SELECT max(group_id) FROM deleted_groups) WHERE EXISTS (SELECT 1 FROM deleted_groups)
+    """))
+    connection.execute(text("""
+        INSERT OR IGNORE INTO id_floors (name, value)
+        SELECT 'messages', (SELECT max(last_id) FROM archive_segments) WHERE EXISTS (SELECT 1 FROM archive_segments)
+    """))
+
+
+# (версия, описание, функция); новые миграции — только в конец списка
+MIGRATIONS = [
+    (1, "baseline tables", _baseline),
+    (2, "group_users.unread_count", _unread_count),
+    (3, "unique group membership", _unique_membership),
+    (4, "message history and recipient indexes", _message_indexes),
+    (5, "full-text search index", create_search_index),
+    (6, "message event log", _event_log),
+    (7, "read watermarks", _read_watermarks),
+    (8, "direct messages and private chat keys", _direct_messages),
+    (9, "message retention and archive segments", _retention),
+    (10, "per-group message counters for unread", _message_counters),
+    (11, "id floors for deleted groups and messages", _id_floors),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection: Connection) -> int:
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine: Engine, target: Optional[int] = None, lock=None) -> int:
+    # lock — database.write_lock: воркеры, стартующие одновременно, ждут друг друга на нём,
+    # а не в busy_timeout, которого на долгую миграцию может не хватить
+    target = LATEST_VERSION if target is None else target
+    with lock.hold() if lock is not None else nullcontext():
+        with engine.connect() as connection:
+            version = current_version(connection)
+        for number, name, upgrade in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            started = time.perf_counter()
+            # Каждая миграция и новый номер версии — в одной транзакции
+            with engine.begin() as connection:
+                upgrade(connection)
+                connection.exec_driver_sql(f"PRAGMA user_version = {number}")
+            version = number
+            print(f"Applied migration {number} ({name}) in {time.perf_counter() - started:.2f}s")
+    return version
+
+
+def main():
+    from database import engine, write_lock
+
+    args = sys.argv[1:]
+    if args and args[0] == "upgrade" and len(args) <= 2:
+        version = migrate(engine, int(args[1]) if len(args) == 2 else None, write_lock)
+        print(f"Schema version {version}")
+        return
+    if args:
+        print("usage: python -m migrations [upgrade [version]]")
+        sys.exit(2)
+    with engine.connect() as connection:
+        version = current_version(connection)
+    for number, name, _ in MIGRATIONS:
+        print(f"{'x' if number <= version else ' '} {number:3d}  {name}")
+    print(f"Schema version {version} of {LATEST_VERSION}")
+
+
+if __name__ == "__main__":
+    main()
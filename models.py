@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Index, func
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
@@ -26,12 +26,90 @@ class Group(Base):
     name = Column(String, unique=True)
     background = Column(String, nullable=True)
     type = Column(String, nullable=True)  # Добавляем поле type
+    # Личный чат двух пользователей: "меньший_id:больший_id", по нему повторное открытие
+    # находит существующую группу вместо создания новой
+    dm_key = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ux_groups_dm_key", "dm_key", unique=True, sqlite_where=dm_key.isnot(None)),
+    )
 
 class GroupUser(Base):
     __tablename__ = "group_users"
     id = Column(Integer, primary_key=True, index=True)
     group_id = Column(Integer, ForeignKey("groups.id"))
     user_id = Column(Integer, ForeignKey("users.id"))
+    # Сколько сообщений группы (chat_summaries.message_count) участник уже прочитал или написал
+    # сам; непрочитанное — разность, новое сообщение меняет только строку сводки (chat_list.py)
+    read_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Водяной знак прочтения: id последнего прочитанного сообщения (read_receipts.py)
+    last_read_id = Column(Integer, nullable=True)
+
+    # Рассылки читают всех участников группы; участник — один раз.
+    # Индексы существующих баз меняются миграциями (migrations.py)
+    __table_args__ = (
+        Index("ux_group_users_group_id_user_id", "group_id", "user_id", unique=True),
+        Index("ix_group_users_user_id_group_id", "user_id", "group_id"),
+    )
+
+class ChatSummary(Base):
+    # Сводка для списка чатов: обновляется вместе с записью сообщений и состава группы
+    __tablename__ = "chat_summaries"
+    group_id = Column(Integer, ForeignKey("groups.id"), primary_key=True)
+    member_count = Column(Integer, nullable=False, default=0)
+    # Сколько сообщений записано в группу за всё время (удалённые вычитаются)
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_id = Column(Integer, nullable=True)
+    last_author_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    last_message_preview = Column(String, nullable=True)
+    last_activity = Column(DateTime, nullable=True)
+    # Номер последнего события группы и до какого номера журнал уже сжат (message_log.py)
+    last_seq = Column(Integer, nullable=False, default=0, server_default="0")
+    compacted_seq = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        Index("ix_chat_summaries_last_activity", "last_activity"),
+    )
+
+class MessageEvent(Base):
+    # Журнал изменений сообщений группы для докачки после переподключения: только номер,
+    # вид события и id сообщения, содержимое берётся из messages
+    __tablename__ = "message_events"
+    group_id = Column(Integer, primary_key=True, autoincrement=False)
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    kind = Column(Integer, nullable=False)
+    message_id = Column(Integer, nullable=False)
+
+    # Таблица и есть индекс по (group_id, seq): без отдельного rowid
+    __table_args__ = {"sqlite_with_rowid": False}
+
+class DeletedGroup(Base):
+    # Удалённая группа, чьи сообщения ещё не вычищены фоном (retention.py)
+    __tablename__ = "deleted_groups"
+    group_id = Column(Integer, primary_key=True, autoincrement=False)
+
+class IdFloor(Base):
+    # Наибольший id, который был выдан и потом удалён (name — "groups", "messages"). SQLite без
+    # AUTOINCREMENT выдаёт новой строке max(id) + 1 и отдал бы его заново (retention.py)
+    __tablename__ = "id_floors"
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False)
+
+    __table_args__ = {"sqlite_with_rowid": False}
+
+class ArchiveSegment(Base):
+    # Сегмент холодного архива: сжатый файл сообщений группы за период (archive.py).
+    # size — сколько байт файла записано подтверждённо, хвост после него не читается
+    __tablename__ = "archive_segments"
+    group_id = Column(Integer, primary_key=True, autoincrement=False)
+    bucket = Column(String, primary_key=True)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+
+    __table_args__ = {"sqlite_with_rowid": False}
 
 class Message(Base):
     __tablename__ = "messages"
@@ -54,4 +132,16 @@ class Message(Base):
     # Для личных сообщений: id получателя
     recipient_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     recipient = relationship("User", foreign_keys=[recipient_id])
+
+    # Индексы под постраничную загрузку истории группы (keyset по id и выборки по времени)
+    # и переписки двух пользователей без группы: ключ беседы (меньший id, больший id) и id
+    __table_args__ = (
+        Index("ix_messages_group_id_id", "group_id", "id"),
+        Index("ix_messages_group_id_timestamp", "group_id", "timestamp"),
+        Index("ix_messages_recipient_id", "recipient_id"),
+        Index(
+            "ix_messages_direct", func.min(author_id, recipient_id), func.max(author_id, recipient_id), id,
+            sqlite_where=recipient_id.isnot(None) & group_id.is_(None),
+        ),
+    )
     
\ No newline at end of file
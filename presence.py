@@ -0,0 +1,278 @@
+# presence.py
+# Присутствие (online / away / offline по всем сокетам пользователя во всех воркерах) и
+# индикаторы набора текста. Изменения не рассылаются по одному: воркер копит их и раз в
+# PRESENCE_TICK секунд публикует одним сообщением брокера, а каждый воркер (и он сам)
+# сводит их в общий вид и отправляет своим подписчикам каждой затронутой группы один кадр:
+#   {"type": "presence", "data": {"group_id": 1, "users": {"5": "online", "7": "offline"}, "typing": [5]}}
+# "typing" — полный список набирающих, только если он изменился. При подписке на группу
+# приходит такой же кадр с "full": true.
+#
+# Сердцебиение: клиент раз в HEARTBEAT_INTERVAL шлёт {"type": "ping", "active": bool}
+# (active — был ли пользователь активен) и получает pong. Сокет, приславший хотя бы один
+# ping и замолчавший на HEARTBEAT_TIMEOUT, закрывается как полуоткрытый.
+import asyncio
+import json
+import os
+import time
+from typing import Dict, Iterable, Set, Tuple
+from uuid import uuid4
+from websocket_manager import Connection, ConnectionManager
+
+PRESENCE_ENABLED = os.environ.get("CHAT_PRESENCE", "1") == "1"
+# Период публикации накопленных изменений, секунды
+PRESENCE_TICK = float(os.environ.get("CHAT_PRESENCE_TICK", "1.0"))
+# Столько секунд без действий пользователя — away
+AWAY_AFTER = float(os.environ.get("CHAT_AWAY_AFTER", "300"))
+# Клиент шлёт ping с этим периодом; сокет, молчащий HEARTBEAT_TIMEOUT, закрываем
+HEARTBEAT_INTERVAL = 25
+HEARTBEAT_TIMEOUT = float(os.environ.get("CHAT_HEARTBEAT_TIMEOUT", "75"))
+HEARTBEAT_CLOSE_CODE = 4408
+# Как часто проверять away и молчащие сокеты, секунды
+SWEEP_INTERVAL = 5.0
+# Индикатор набора гаснет, если его не продлили; продления чаще TYPING_REFRESH не публикуем
+TYPING_TIMEOUT = 6.0
+TYPING_REFRESH = 3.0
+# Воркер, от которого столько секунд не было ни одного тика (упал), — его пользователи offline
+WORKER_TIMEOUT = 10.0
+
+ONLINE, AWAY, OFFLINE = "online", "away", "offline"
+_RANK = {OFFLINE: 0, AWAY: 1, ONLINE: 2}
+
+
+class PresenceTracker:
+    """Presence and typing state of this worker's sockets, merged with all workers once per tick."""
+
+    def __init__(self, manager: ConnectionManager, tick: float = PRESENCE_TICK):
+        self.manager = manager
+        self.tick = tick
+        self.worker_id = uuid4().hex[:12]
+        # Своя часть: опубликованное состояние пользователей этого воркера и их группы
+        self.local_states: Dict[int, str] = {}
+        self.local_groups: Dict[int, Set[int]] = {}
+        self.changed: Set[int] = set()
+        self.typing_sent: Dict[Tuple[int, int], float] = {}
+        self.pending_typing: Dict[Tuple[int, int], bool] = {}
+        # Общий вид по всем воркерам: user -> worker -> state, group -> user -> срок набора
+        self.states: Dict[int, Dict[str, str]] = {}
+        self.user_groups: Dict[int, Set[int]] = {}
+        self.typing: Dict[int, Dict[int, float]] = {}
+        self.workers: Dict[str, float] = {}
+        self.task = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None
+
+    async def start(self):
+        self.manager.connection_listeners.append(self._connection_changed)
+        self.manager.channel_handlers["presence"] = self._receive
+        self.manager.channel_handlers["presence_sync"] = self._sync_requested
+        for user_id in self.manager.user_connections:
+            self.changed.add(user_id)
+        self.task = asyncio.create_task(self._run())
+        # Уже работающие воркеры перепубликуют своё состояние для нового
+        await self.manager.publish(f"presence_sync:{self.worker_id}")
+
+    async def close(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        self.task = None
+        # Остальные воркеры узнают об уходе сразу, а не через WORKER_TIMEOUT
+        users = {user_id: [OFFLINE, sorted(groups)] for user_id, groups in self.local_groups.items()}
+        await self._publish({"users": users, "typing": []})
+
+    # Входящие кадры сокета
+
+    def touch(self, connection: Connection, active: bool = True):
+        now = time.monotonic()
+        connection.last_seen = now
+        if active:
+            connection.last_active = now
+            if self.local_states.get(connection.user_id) == AWAY:
+                self.changed.add(connection.user_id)
+
+    def ping(self, connection: Connection, active: bool):
+        # Клиент с сердцебиением: теперь его молчание означает мёртвое соединение
+        connection.heartbeat = True
+        self.touch(connection, active)
+
+    def set_typing(self, user_id: int, group_id: int, active: bool = True):
+        if not self.running:
+            return
+        key = (group_id, user_id)
+        now = time.monotonic()
+        if active:
+            if now - self.typing_sent.get(key, -TYPING_REFRESH) < TYPING_REFRESH:
+                return
+            self.typing_sent[key] = now
+        elif self.typing_sent.pop(key, None) is None:
+            return
+        self.pending_typing[key] = active
+
+    def effective(self, user_id: int) -> str:
+        states = self.states.get(user_id)
+        return max(states.values(), key=_RANK.__getitem__) if states else OFFLINE
+
+    def snapshot(self, group_id: int, member_ids: Iterable[int]) -> dict:
+        # Кто из участников сейчас не offline: перебираем меньшее из двух множеств
+        member_ids = set(member_ids)
+        candidates = member_ids if len(member_ids) < len(self.states) else [
+            user_id for user_id in self.states if user_id in member_ids
+        ]
+        users = {}
+        for user_id in candidates:
+            state = self.effective(user_id)
+            if state != OFFLINE:
+                users[user_id] = state
+        return {"type": "presence", "data": {
+            "group_id": group_id, "users": users, "typing": sorted(self.typing.get(group_id, {})), "full": True,
+        }}
+
+    # Своё состояние: копится между тиками и публикуется одним сообщением
+
+    def _connection_changed(self, connection: Connection):
+        if connection.user_id is not None:
+            self.changed.add(connection.user_id)
+
+    def _local_state(self, user_id: int, now: float) -> Tuple[str, Set[int]]:
+        connections = self.manager.user_connections.get(user_id)
+        if not connections:
+            return OFFLINE, set()
+        groups = set().union(*(connection.groups for connection in connections.values()))
+        active = any(now - connection.last_active < AWAY_AFTER for connection in connections.values())
+        return ONLINE if active else AWAY, groups
+
+    def _collect(self, now: float) -> dict:
+        users = {}
+        for user_id in self.changed:
+            state, groups = self._local_state(user_id, now)
+            known = self.local_groups.get(user_id, set())
+            if state == self.local_states.get(user_id, OFFLINE) and (state == OFFLINE or groups == known):
+                continue
+            if state == OFFLINE:
+                # У закрытых сокетов подписок уже нет — сообщаем группам, где пользователя видели
+                users[user_id] = [OFFLINE, sorted(known)]
+                self.local_states.pop(user_id, None)
+                self.local_groups.pop(user_id, None)
+            else:
+                users[user_id] = [state, sorted(groups)]
+                self.local_states[user_id] = state
+                self.local_groups[user_id] = groups
+        self.changed.clear()
+        typing = [[group_id, user_id, int(active)] for (group_id, user_id), active in self.pending_typing.items()]
+        self.pending_typing.clear()
+        return {"users": users, "typing": typing}
+
+    def _sweep(self, now: float):
+        for connection in list(self.manager.all_connections.values()):
+            if connection.heartbeat and now - connection.last_seen > HEARTBEAT_TIMEOUT:
+                self.manager.close_connection(connection, HEARTBEAT_CLOSE_CODE)
+        # online -> away: пересчитываем только тех, у кого все сокеты давно без действий
+        for user_id, state in self.local_states.items():
+            connections = self.manager.user_connections.get(user_id)
+            if state == ONLINE and (not connections or all(
+                now - connection.last_active >= AWAY_AFTER for connection in connections.values()
+            )):
+                self.changed.add(user_id)
+        self.typing_sent = {key: sent for key, sent in self.typing_sent.items() if now - sent < TYPING_TIMEOUT}
+
+    async def _publish(self, update: dict):
+        await self.manager.publish(f"presence:{self.worker_id}", json.dumps(update, separators=(",", ":")))
+
+    async def _run(self):
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            try:
+                if now - last_sweep >= SWEEP_INTERVAL:
+                    self._sweep(now)
+                    last_sweep = now
+                # Пустое обновление тоже публикуем: по нему остальные знают, что воркер жив
+                await self._publish(self._collect(now))
+                self._expire(now)
+            except Exception as e:
+                print(f"Presence tick failed: {e}")
+
+    def _sync_requested(self, worker_id: str, payload: str):
+        if worker_id == self.worker_id:
+            return
+        self.local_states.clear()
+        self.changed.update(self.manager.user_connections)
+
+    # Общий вид: сообщения всех воркеров сводятся в диффы по группам
+
+    def _receive(self, worker_id: str, payload: str):
+        now = time.monotonic()
+        self.workers[worker_id] = now
+        update = json.loads(payload)
+        diffs: Dict[int, dict] = {}
+        for user_id, (state, groups) in update["users"].items():
+            self._apply_state(int(user_id), worker_id, state, set(groups), diffs)
+        for group_id, user_id, active in update["typing"]:
+            self._apply_typing(group_id, user_id, bool(active), now, diffs)
+        self._send(diffs)
+
+    def _apply_state(self, user_id: int, worker_id: str, state: str, groups: Set[int], diffs: Dict[int, dict]):
+        before = self.effective(user_id)
+        known = self.user_groups.get(user_id, set())
+        states = self.states.setdefault(user_id, {})
+        if state == OFFLINE:
+            states.pop(worker_id, None)
+        else:
+            states[worker_id] = state
+        if not states:
+            del self.states[user_id]
+        after = self.effective(user_id)
+        if after == OFFLINE:
+            self.user_groups.pop(user_id, None)
+        else:
+            self.user_groups[user_id] = known | groups
+        # Состояние не изменилось — сообщаем только группам, где пользователь появился впервые
+        notify = known | groups if after != before else groups - known
+        for group_id in notify:
+            _diff(diffs, group_id)["users"][user_id] = after
+            if after == OFFLINE and user_id in self.typing.get(group_id, {}):
+                self._apply_typing(group_id, user_id, False, 0, diffs)
+
+    def _apply_typing(self, group_id: int, user_id: int, active: bool, now: float, diffs: Dict[int, dict]):
+        typists = self.typing.setdefault(group_id, {})
+        if active:
+            changed = user_id not in typists
+            typists[user_id] = now + TYPING_TIMEOUT
+        else:
+            changed = typists.pop(user_id, None) is not None
+        if not typists:
+            del self.typing[group_id]
+        if changed:
+            _diff(diffs, group_id)["typing"] = True
+
+    def _expire(self, now: float):
+        diffs: Dict[int, dict] = {}
+        for group_id, typists in list(self.typing.items()):
+            for user_id, expires in list(typists.items()):
+                if expires <= now:
+                    self._apply_typing(group_id, user_id, False, now, diffs)
+        for worker_id, seen in list(self.workers.items()):
+            if worker_id != self.worker_id and now - seen > WORKER_TIMEOUT:
+                del self.workers[worker_id]
+                for user_id in [user_id for user_id, states in self.states.items() if worker_id in states]:
+                    self._apply_state(user_id, worker_id, OFFLINE, set(), diffs)
+        self._send(diffs)
+
+    def _send(self, diffs: Dict[int, dict]):
+        for group_id, diff in diffs.items():
+            data = {"group_id": group_id}
+            if diff["users"]:
+                data["users"] = diff["users"]
+            if diff["typing"]:
+                data["typing"] = sorted(self.typing.get(group_id, {}))
+            self.manager.send_to_local_group({"type": "presence", "data": data}, group_id, "presence")
+
+
+def _diff(diffs: Dict[int, dict], group_id: int) -> dict:
+    diff = diffs.get(group_id)
+    if diff is None:
+        diff = diffs[group_id] = {"users": {}, "typing": False}
+    return diff
@@ -0,0 +1,125 @@
+# ratelimit.py
+# Ограничение входящего потока: корзины токенов в памяти воркера на соединение (все кадры),
+# на пользователя и на группу (сообщения из /ws, старого /ws/{group_id} и POST /messages).
+# Проверка — O(1): корзина пополняется по времени при обращении. Корзины лежат в порядке
+# последнего обращения; полностью наполнившаяся (простаивала burst / rate секунд) ничем не
+# отличается от новой и удаляется, так что состояние ограничено активными ключами.
+#
+# Политика при превышении (CHAT_RATE_POLICY):
+#   reject     — кадр {"error": "Rate limited", "retry_after": 0.4} / HTTP 429 с Retry-After
+#   delay      — ждём токенов (не читая следующий кадр), но не дольше MAX_DELAY, иначе reject
+#   disconnect — закрываем сокет с кодом RATE_LIMIT_CLOSE_CODE / HTTP 429
+# Лимиты — на воркер: при N воркерах пользователь может получить до N раз больше.
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+from metrics import rate_limited_total
+
+RATE_POLICY = os.environ.get("CHAT_RATE_POLICY", "reject")
+# Кадров в секунду на сокет и запас на всплеск; 0 — без ограничения
+CONNECTION_RATE = float(os.environ.get("CHAT_RATE_CONNECTION", "20"))
+CONNECTION_BURST = int(os.environ.get("CHAT_RATE_CONNECTION_BURST", "40"))
+# Сообщений в секунду от пользователя (со всех его сокетов и REST) и в одну группу
+USER_RATE = float(os.environ.get("CHAT_RATE_USER", "5"))
+USER_BURST = int(os.environ.get("CHAT_RATE_USER_BURST", "20"))
+GROUP_RATE = float(os.environ.get("CHAT_RATE_GROUP", "50"))
+GROUP_BURST = int(os.environ.get("CHAT_RATE_GROUP_BURST", "100"))
+# Дольше этого политика delay не ждёт, секунды
+MAX_DELAY = 2.0
+# Предел числа корзин одного лимита: при переполнении уходят давно не использованные
+MAX_BUCKETS = 100_000
+RATE_LIMIT_CLOSE_CODE = 4429
+
+
+class RateLimiter:
+    """Token buckets keyed by user, group or connection, oldest-first so idle ones expire in O(1)."""
+
+    def __init__(self, scope: str, rate: float, burst: int, max_buckets: int = MAX_BUCKETS):
+        self.scope = scope
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        # За это время пустая корзина наполняется целиком — дальше её можно забыть
+        self.idle = burst / rate
+        # key -> [токены, время последнего пополнения]
+        self.buckets: "OrderedDict[Hashable, list]" = OrderedDict()
+
+    def wait(self, key: Hashable, now: float) -> float:
+        # Через сколько секунд будет токен (0 — уже есть); сам токен не забирает
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(self.burst), now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+        self._expire(now)
+        return 0.0 if bucket[0] >= 1 else (1 - bucket[0]) / self.rate
+
+    def consume(self, key: Hashable):
+        self.buckets[key][0] -= 1
+
+    def forget(self, key: Hashable):
+        self.buckets.pop(key, None)
+
+    def _expire(self, now: float):
+        # Спереди — самые давние обращения; проверяем, пока не встретим свежую корзину
+        while len(self.buckets) > 1:
+            _, updated = next(iter(self.buckets.values()))
+            if now - updated < self.idle and len(self.buckets) <= self.max_buckets:
+                break
+            self.buckets.popitem(last=False)
+
+
+def _limiter(scope: str, rate: float, burst: int) -> Optional[RateLimiter]:
+    return RateLimiter(scope, rate, burst) if rate > 0 else None
+
+
+class IngressLimiter:
+    """Connection, user and group limits for inbound frames and messages, with one overflow policy."""
+
+    def __init__(self, policy: str = RATE_POLICY):
+        if policy not in ("reject", "delay", "disconnect"):
+            raise ValueError(f"Unknown rate limit policy: {policy}")
+        self.policy = policy
+        self.connections = _limiter("connection", CONNECTION_RATE, CONNECTION_BURST)
+        self.users = _limiter("user", USER_RATE, USER_BURST)
+        self.groups = _limiter("group", GROUP_RATE, GROUP_BURST)
+
+    @property
+    def disconnects(self) -> bool:
+        return self.policy == "disconnect"
+
+    async def frame(self, connection_key: Hashable) -> float:
+        return await self._admit((self.connections, connection_key))
+
+    def forget_connection(self, connection_key: Hashable):
+        # Сокет отключился: его корзина больше не понадобится
+        if self.connections is not None:
+            self.connections.forget(connection_key)
+
+    async def message(self, user_id: int, group_id: Optional[int]) -> float:
+        return await self._admit((self.users, user_id), (self.groups, group_id))
+
+    async def _admit(self, *checks: Tuple[Optional[RateLimiter], Hashable]) -> float:
+        # 0 — пропускаем (при delay — дождавшись токенов), иначе через сколько повторить.
+        # Токены берутся, только если есть во всех корзинах: отказ по группе не тратит лимит пользователя
+        checks = [(limiter, key) for limiter, key in checks if limiter is not None and key is not None]
+        while checks:
+            now = time.monotonic()
+            wait, scope = max((limiter.wait(key, now), limiter.scope) for limiter, key in checks)
+            if wait == 0:
+                for limiter, key in checks:
+                    limiter.consume(key)
+                break
+            if self.policy != "delay" or wait > MAX_DELAY:
+                rate_limited_total.inc(scope)
+                return wait
+            await asyncio.sleep(wait)
+        return 0.0
+
+
+def rate_limited(retry_after: float) -> dict:
+    return {"error": "Rate limited", "retry_after": round(retry_after, 2)}
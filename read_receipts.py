@@ -0,0 +1,107 @@
+# read_receipts.py
+# Отметки о прочтении. У каждого участника группы есть водяной знак group_users.last_read_id —
+# id последнего прочитанного сообщения; непрочитанное считается от него (chat_list.apply_reads).
+# Запросы "прочитано" (POST /chats/{id}/read и кадр read сокета /ws) не пишутся по одному:
+# ReadReceipts копит наибольший id на (группу, участника) и раз в READ_FLUSH_MS записывает
+# всё одной транзакцией. Сдвинувшиеся знаки расходятся одним кадром на группу
+#   {"type": "read_receipts", "data": {"group_id": 1, "reads": {"5": 120}}}
+# и только сокетам, у которых группа сейчас открыта (кадр view); при открытии приходит
+# такой же кадр с "full": true. Устройства самого читателя получают chat_read с новым счётчиком.
+import asyncio
+import os
+from typing import Dict, Optional, Tuple
+from chat_list import apply_reads, read_watermarks
+from database import run_db, run_read
+from websocket_manager import ConnectionManager
+
+# Как часто записывать накопленные отметки, миллисекунды
+READ_FLUSH_MS = int(os.environ.get("CHAT_READ_FLUSH_MS", "250"))
+
+
+class ReadReceipts:
+    """Debounces read marks per (group, user) and writes them in one batch per interval."""
+
+    def __init__(self, manager: ConnectionManager, flush_ms: int = READ_FLUSH_MS):
+        self.manager = manager
+        self.interval = flush_ms / 1000
+        self.pending: Dict[Tuple[int, int], Optional[int]] = {}
+        # Разрешается результатами apply_reads пакета с текущими pending
+        self.pending_done: Optional[asyncio.Future] = None
+        # MessageWriter в режиме write-behind: знак не должен обогнать записанные сообщения
+        self.writer = None
+        self.wakeup = asyncio.Event()
+        self.closing = False
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # Дописываем накопленные отметки перед остановкой
+        self.closing = True
+        self.wakeup.set()
+        if self.task is not None:
+            await self.task
+        await self.flush()
+
+    def mark(self, group_id: int, user_id: int, message_id: Optional[int] = None) -> asyncio.Future:
+        # message_id=None — прочитано до последнего сообщения группы
+        key = (group_id, user_id)
+        if key in self.pending:
+            previous = self.pending[key]
+            message_id = None if previous is None or message_id is None else max(previous, message_id)
+        self.pending[key] = message_id
+        if self.pending_done is None:
+            self.pending_done = asyncio.get_running_loop().create_future()
+        return self.pending_done
+
+    async def read(self, group_id: int, user_id: int, message_id: Optional[int] = None) -> Optional[tuple]:
+        # Для REST: ждёт записи пакета; None — пользователь не участник группы
+        results = await asyncio.shield(self.mark(group_id, user_id, message_id))
+        return results.get((group_id, user_id))
+
+    async def snapshot(self, group_id: int) -> dict:
+        reads = await run_read(read_watermarks, group_id)
+        return {"type": "read_receipts", "data": {"group_id": group_id, "reads": reads, "full": True}}
+
+    async def _run(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Read receipts flush failed: {e}")
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        done, self.pending_done = self.pending_done, None
+        try:
+            if self.writer is not None:
+                await self.writer.wait_persisted(self.writer.next_id - 1)
+            results = await run_db(apply_reads, batch)
+        except Exception as e:
+            done.set_exception(e)
+            done.exception()  # помечаем как полученное, если никто не ждёт
+            raise
+        done.set_result(results)
+        await self._announce(results)
+
+    async def _announce(self, results: Dict[Tuple[int, int], tuple]):
+        receipts: Dict[int, Dict[int, int]] = {}
+        for (group_id, user_id), (watermark, unread, advanced, changed) in results.items():
+            if changed:
+                # Другие вкладки и устройства пользователя обновляют счётчик у себя
+                await self.manager.send_to_users({"type": "chat_read", "data": {
+                    "group_id": group_id, "last_read_id": watermark, "unread_count": unread,
+                }}, [user_id])
+            if advanced:
+                receipts.setdefault(group_id, {})[user_id] = watermark
+        for group_id, reads in receipts.items():
+            await self.manager.send_to_viewers(
+                {"type": "read_receipts", "data": {"group_id": group_id, "reads": reads}}, group_id
+            )
@@ -0,0 +1,288 @@
+# retention.py
+# Фоновое обслуживание таблицы messages, чтобы она и её индексы не росли без предела:
+#   - сообщения удалённых групп (deleted_groups) вычищаются пакетами, а не в DELETE /groups;
+#   - по политике типа группы старые сообщения уходят в холодный архив (archive.py), а совсем
+#     старые удаляются вместе с сегментами архива;
+#   - освободившиеся страницы возвращаются файлу через PRAGMA incremental_vacuum.
+# Id удалённых групп и удалённых/архивных сообщений больше не выдаются (id_floors): иначе
+# новая группа получила бы чужую историю, а новое сообщение — id из архива.
+# Каждый пакет — своя короткая транзакция записи, между пакетами пишут остальные.
+#
+# Политики (CHAT_RETENTION): "тип:архив_через_дней:удалить_через_дней" через запятую, 0 — никогда.
+# По умолчанию ничего не архивируется и не удаляется, работает только очистка удалённых групп.
+#   CHAT_RETENTION="group:90:0,private:30:365" uvicorn main:app
+# Группы без своей политики (и без типа) живут по политике "group". Личные сообщения без
+# группы не архивируются.
+#
+#   python -m retention           # один проход сейчас
+#   python -m retention vacuum    # включить incremental auto_vacuum у существующей базы (VACUUM)
+import asyncio
+import datetime
+import os
+import sys
+from collections import Counter
+from contextlib import nullcontext
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from archive import archive_messages, drop_segments, remove_files
+from message_log import forget_messages
+from metrics import retention_messages_total
+from models import ArchiveSegment, DeletedGroup, Group, IdFloor, Message
+from serialization import message_select
+
+RETENTION_SPEC = os.environ.get("CHAT_RETENTION", "")
+# Сообщений за одну транзакцию
+RETENTION_BATCH = int(os.environ.get("CHAT_RETENTION_BATCH", "2000"))
+# Как часто запускать проход, секунды
+RETENTION_INTERVAL = float(os.environ.get("CHAT_RETENTION_INTERVAL", "600"))
+# Страниц за один шаг incremental_vacuum
+VACUUM_PAGES = 2000
+INCREMENTAL = 2
+
+
+class RetentionPolicy(NamedTuple):
+    archive_after_days: float = 0
+    delete_after_days: float = 0
+
+    def cutoffs(self, now: datetime.datetime) -> Tuple[Optional[datetime.datetime], Optional[datetime.datetime]]:
+        # (в архив всё старше, удалить всё старше); None — не делать
+        return tuple(now - datetime.timedelta(days=days) if days > 0 else None
+                     for days in (self.archive_after_days, self.delete_after_days))
+
+
+def parse_policies(spec: str) -> Dict[str, RetentionPolicy]:
+    policies = {"group": RetentionPolicy()}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            group_type, archive_after, delete_after = item.split(":")
+            policy = RetentionPolicy(float(archive_after), float(delete_after))
+        except ValueError:
+            raise ValueError(f"Invalid retention policy: {item}")
+        if 0 < policy.delete_after_days < policy.archive_after_days:
+            raise ValueError(f"Retention policy {item} deletes messages before archiving them")
+        policies[group_type] = policy
+    return policies
+
+
+RETENTION_POLICIES = parse_policies(RETENTION_SPEC)
+
+
+def policy_for(group_type: Optional[str], policies: Dict[str, RetentionPolicy] = RETENTION_POLICIES):
+    return policies.get(group_type) or policies["group"]
+
+
+# Занятые id
+
+def id_floor(db: Session, name: str) -> int:
+    return db.query(IdFloor.value).filter(IdFloor.name == name).scalar() or 0
+
+
+def raise_id_floor(db: Session, name: str, value: int):
+    # Вызывается в транзакции, которая удаляет строки с id до value включительно
+    statement = sqlite_insert(IdFloor).values(name=name, value=value)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[IdFloor.name], set_={"value": func.max(IdFloor.value, statement.excluded.value)}
+    ))
+
+
+def next_message_id():
+    # Выражение для INSERT: следующий id после живых, удалённых и архивных сообщений
+    floor = select(IdFloor.value).where(IdFloor.name == "messages").scalar_subquery()
+    last = select(func.max(Message.id)).scalar_subquery()
+    return func.max(func.coalesce(last, 0), func.coalesce(floor, 0)) + 1
+
+
+# Удалённые группы
+
+def forget_group(db: Session, group_id: int):
+    # Вызывается в транзакции удаления группы; сообщения вычистит purge_deleted_groups
+    db.execute(insert(DeletedGroup).prefix_with("OR IGNORE").values(group_id=group_id))
+    raise_id_floor(db, "groups", group_id)
+
+
+def next_group_id(db: Session) -> Optional[int]:
+    # None — групп не удаляли, id выбирает база
+    floor = id_floor(db, "groups")
+    if not floor:
+        return None
+    return max(floor, db.query(func.max(Group.id)).scalar() or 0) + 1
+
+
+def purge_deleted_groups(db: Session, batch: int = RETENTION_BATCH) -> Tuple[int, List[int]]:
+    """Delete up to `batch` messages of deleted groups; a finished group loses its archive too.
+
+    Returns the number of deleted messages and the ids of groups purged completely.
+    """
+    removed, paths, purged = 0, [], []
+    while removed < batch:
+        # Вычищенная группа уходит из очереди в этой же транзакции, следующая — по порядку id
+        group_id = db.query(func.min(DeletedGroup.group_id)).scalar()
+        if group_id is None:
+            break
+        ids = list(db.scalars(select(Message.id).where(Message.group_id == group_id).limit(batch - removed)))
+        if ids:
+            db.execute(delete(Message).where(Message.id.in_(ids)))
+            raise_id_floor(db, "messages", max(ids))
+            removed += len(ids)
+        if removed >= batch:
+            break
+        paths += drop_segments(db, group_id)
+        db.query(DeletedGroup).filter(DeletedGroup.group_id == group_id).delete()
+        purged.append(group_id)
+    db.commit()
+    remove_files(paths)
+    return removed, purged
+
+
+# Политики хранения
+
+def retention_candidates(db: Session, policies: Dict[str, RetentionPolicy],
+                         now: datetime.datetime) -> List[Tuple[int, RetentionPolicy]]:
+    # Группы, у которых самое старое сообщение или сегмент архива уже вышли за срок политики
+    oldest_message = select(func.min(Message.timestamp)).where(Message.group_id == Group.id).scalar_subquery()
+    oldest_segment = select(func.min(ArchiveSegment.last_timestamp)).where(
+        ArchiveSegment.group_id == Group.id
+    ).scalar_subquery()
+    candidates = []
+    for group_id, group_type, message_time, segment_time in db.execute(
+        select(Group.id, Group.type, oldest_message, oldest_segment)
+    ):
+        policy = policy_for(group_type, policies)
+        archive_before, delete_before = policy.cutoffs(now)
+        cutoff = archive_before or delete_before
+        if (message_time is not None and cutoff is not None and message_time < cutoff) or (
+            segment_time is not None and delete_before is not None and segment_time < delete_before
+        ):
+            candidates.append((group_id, policy))
+    return candidates
+
+
+def compact_group(db: Session, group_id: int, policy: RetentionPolicy, now: datetime.datetime,
+                  batch: int = RETENTION_BATCH) -> Counter:
+    """Archive or delete one batch of the group's oldest messages and drop expired segments."""
+    archive_before, delete_before = policy.cutoffs(now)
+    counts = Counter()
+    paths = []
+    if delete_before is not None:
+        paths = drop_segments(db, group_id, before=delete_before)
+        counts["expired_segments"] = len(paths)
+    cutoff = max(filter(None, (archive_before, delete_before)), default=None)
+    if cutoff is not None:
+        rows = db.execute(
+            message_select().where(Message.group_id == group_id, Message.timestamp < cutoff)
+            .order_by(Message.timestamp, Message.id).limit(batch)
+        ).all()
+        # Старше срока хранения — сразу удаляем, остальное — в архив
+        expired = [row for row in rows if delete_before is not None and row.timestamp < delete_before]
+        archived = [row for row in rows if delete_before is None or row.timestamp >= delete_before]
+        if archived:
+            counts["archived"] = archive_messages(db, group_id, archived)
+        counts["deleted"] = len(expired)
+        ids = [row.id for row in rows]
+        if ids:
+            db.execute(delete(Message).where(Message.id.in_(ids)))
+            raise_id_floor(db, "messages", max(ids))
+            forget_messages(db, group_id, ids)
+    db.commit()
+    remove_files(paths)
+    return counts
+
+
+def auto_vacuum_mode(db: Session) -> int:
+    return db.execute(text("PRAGMA auto_vacuum")).scalar()
+
+
+def incremental_vacuum(db: Session, pages: int = VACUUM_PAGES) -> int:
+    # Возвращает файлу до pages свободных страниц; сколько свободных осталось. Каждую страницу
+    # освобождает отдельный шаг без колонок, а execute в sqlite3 делает только первый —
+    # executescript проходит до конца, но коммитит открытую транзакцию, поэтому соединение
+    # берётся мимо сессии (run_db держит блокировку записи)
+    connection = db.get_bind().raw_connection()
+    try:
+        cursor = connection.cursor()
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != INCREMENTAL:
+            return 0
+        cursor.executescript(f"PRAGMA incremental_vacuum({pages})")
+        return cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        connection.close()
+
+
+async def enforce(run_db, run_read, policies: Dict[str, RetentionPolicy] = RETENTION_POLICIES,
+                  on_compacted=None) -> Counter:
+    """One retention pass: purge deleted groups, apply policies, then vacuum freed pages."""
+    totals = Counter()
+    while True:
+        removed, purged = await run_db(purge_deleted_groups)
+        totals["orphaned"] += removed
+        # Кэши воркеров не должны хранить историю вычищенной группы
+        if on_compacted is not None:
+            for group_id in purged:
+                await on_compacted(group_id)
+        if removed < RETENTION_BATCH:
+            break
+    if any(policy.archive_after_days or policy.delete_after_days for policy in policies.values()):
+        now = datetime.datetime.now()
+        for group_id, policy in await run_read(retention_candidates, policies, now):
+            while True:
+                counts = await run_db(compact_group, group_id, policy, now)
+                totals.update(counts)
+                if counts["archived"] + counts["deleted"] < RETENTION_BATCH:
+                    break
+            if on_compacted is not None:
+                await on_compacted(group_id)
+    for action in ("orphaned", "archived", "deleted"):
+        if totals[action]:
+            retention_messages_total.inc(action, amount=totals[action])
+    if totals["orphaned"] or totals["archived"] or totals["deleted"] or totals["expired_segments"]:
+        while await run_db(incremental_vacuum):
+            pass
+    return totals
+
+
+async def enforce_periodically(run_db, run_read, on_compacted=None, interval: float = RETENTION_INTERVAL):
+    if await run_read(auto_vacuum_mode) != INCREMENTAL:
+        print("Freed database pages are not returned to the file; run `python -m retention vacuum` once")
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            totals = await enforce(run_db, run_read, on_compacted=on_compacted)
+        except Exception as e:
+            print(f"Retention pass failed: {e}")
+        else:
+            if +totals:
+                print("Retention: " + ", ".join(f"{count} {action}" for action, count in sorted(totals.items())))
+
+
+def vacuum(engine, lock=None):
+    # Режим auto_vacuum существующей базы меняется только полной перестройкой файла
+    connection = engine.raw_connection()
+    try:
+        with lock.hold() if lock is not None else nullcontext():
+            cursor = connection.cursor()
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("VACUUM")
+            cursor.close()
+    finally:
+        connection.close()
+
+
+def main():
+    from database import engine, run_db, run_read, write_lock
+
+    args = sys.argv[1:]
+    if args == ["vacuum"]:
+        vacuum(engine, write_lock)
+        print("auto_vacuum = INCREMENTAL")
+        return
+    if args:
+        print("usage: python -m retention [vacuum]")
+        sys.exit(2)
+    totals = asyncio.run(enforce(run_db, run_read))
+    print(", ".join(f"{count} {action}" for action, count in sorted(totals.items())) or "Nothing to do")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,14 @@
 # schemas.py
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Dict, Optional, List
 from datetime import datetime
 
+
 class UserCreate(BaseModel):
     username: str
     password: str
 
+
 class UserOut(BaseModel):
     id: int
     username: str
@@ -15,11 +17,13 @@ class UserOut(BaseModel):
     class Config:
         from_attributes = True  # вместо orm_mode = True
 
+
 class GroupCreate(BaseModel):
     name: str
     background: Optional[str] = None
     type: Optional[str] = None
 
+
 class GroupOut(BaseModel):
     id: int
     name: str
@@ -29,11 +33,13 @@ class GroupOut(BaseModel):
     class Config:
         from_attributes = True  # вместо orm_mode = True
 
+
 class MessageCreate(BaseModel):
     content: str
     group_id: Optional[int] = None
     recipient_id: Optional[int] = None
 
+
 class MessageOut(BaseModel):
     id: int
     content: str
@@ -46,9 +52,34 @@ class MessageOut(BaseModel):
 
     class Config:
         from_attributes = True  # вместо orm_mode = True
-        
+
+
+class MessagePage(BaseModel):
+    messages: List[MessageOut]  # по возрастанию id
+    next_cursor: Optional[int]  # before_id (или after_id) для следующей страницы
+    has_more: bool
+
+
+class MessageSearchPage(BaseModel):
+    messages: List[MessageOut]  # по убыванию релевантности (или от новых к старым)
+    next_offset: Optional[int]
+    has_more: bool
+
+
 class PrivateChatCreate(BaseModel):
     user_id: int
     recipient_id: int
     name: Optional[str] = None
-    type: str = "private"
\ No newline at end of file
+    type: str = "private"
+
+
+class MediaOut(BaseModel):
+    id: str  # sha256 содержимого и расширение по типу
+    url: str
+    content_type: str
+    size: int
+    thumbnails: Dict[str, str]  # сторона в пикселях -> ссылка на уменьшенную копию
+
+
+class AvatarUpdate(BaseModel):
+    media_id: Optional[str] = None  # None — убрать аватар
@@ -0,0 +1,112 @@
+# search.py
+# Полнотекстовый поиск по сообщениям: FTS5-таблица поверх messages (external content),
+# синхронизируется триггерами, поэтому её видят все пути записи, включая пакетные INSERT.
+#
+# Заполнить индекс для существующей базы (chat.db или CHAT_DATABASE_URL):
+#   python -m search rebuild
+import re
+import sys
+import time
+from contextlib import nullcontext
+from typing import List, Optional
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+FTS_TABLE = "messages_fts"
+# Новую таблицу для базы не больше такого размера заполняем сразу при старте,
+# для больших — печатаем подсказку про python -m search rebuild
+AUTO_REBUILD_ROWS = 100_000
+# Сколько найденных сообщений отдаём за раз
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+# Глубже ранжированная выдача не листается: каждый шаг offset пересчитывает все совпадения
+MAX_SEARCH_OFFSET = 1000
+
+_DDL = [
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+    f"""CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    f"""CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+
+
+def create_search_index(connection: Connection):
+    # Миграция схемы (см. migrations.py)
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": FTS_TABLE}
+    ).first()
+    if exists:
+        return
+    for statement in _DDL:
+        connection.execute(text(statement))
+    rows = connection.execute(text("SELECT count(*) FROM messages")).scalar()
+    if rows <= AUTO_REBUILD_ROWS:
+        rebuild(connection)
+    else:
+        print(f"Search index created empty for {rows} messages; run `python -m search rebuild` to backfill")
+
+
+def rebuild(connection: Connection):
+    # Перечитывает все сообщения из messages (external content) и сжимает индекс
+    connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')"))
+
+
+def match_query(q: str) -> Optional[str]:
+    # Пользовательский ввод не должен попадать в синтаксис FTS5: берём только слова,
+    # каждое в кавычках (все обязательны), последнее — по префиксу для поиска при наборе
+    words = re.findall(r"\w+", q)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_message_ids(db: Session, user_id: int, query: str, group_id: Optional[int],
+                       offset: int, limit: int, order: str = "rank") -> List[int]:
+    # Только группы, в которых состоит пользователь; limit + 1 — чтобы узнать has_more
+    scope = "m.group_id = :group_id" if group_id is not None else \
+        "m.group_id IN (SELECT group_id FROM group_users WHERE user_id = :user_id)"
+    order_by = f"bm25({FTS_TABLE}), m.id DESC" if order == "rank" else f"{FTS_TABLE}.rowid DESC"
+    rows = db.execute(text(f"""
+        SELECT m.id FROM {FTS_TABLE} JOIN messages m ON m.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH :query AND {scope}
+        ORDER BY {order_by} LIMIT :limit OFFSET :offset
+    """), {"query": query, "group_id": group_id, "user_id": user_id, "limit": limit + 1, "offset": offset})
+    return [message_id for (message_id,) in rows]
+
+
+def rebuild_index(engine, lock=None) -> int:
+    # lock — database.write_lock: запущенный сервер не пишет сообщения посреди перестройки
+    with lock.hold() if lock is not None else nullcontext():
+        with engine.begin() as connection:
+            rebuild(connection)
+            return connection.execute(text("SELECT count(*) FROM messages")).scalar()
+
+
+def main():
+    from database import engine, write_lock
+    from migrations import migrate
+
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python -m search rebuild")
+        sys.exit(2)
+    migrate(engine, lock=write_lock)
+    started = time.perf_counter()
+    rows = rebuild_index(engine, write_lock)
+    print(f"Indexed {rows} messages in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
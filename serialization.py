@@ -0,0 +1,82 @@
+# serialization.py
+# Единый путь сериализации сообщений для REST-истории, поиска, докачки, рассылок по сокетам
+# и списка чатов. Нужные колонки выбираются core-запросом (без ORM-объектов и identity map),
+# строка сразу превращается в dict того вида, который видят клиенты, а ответ кодируется в
+# JSON-байты один раз, без проверки через response_model (MessageOut остаётся описанием в OpenAPI).
+#
+# Кодировщик — orjson, если он установлен, иначе стандартный json с теми же настройками.
+import json
+from typing import Any, List, Sequence
+from fastapi import Response
+from sqlalchemy import Select, select
+from models import Message, User
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+# Порядок колонок совпадает с распаковкой в row_to_dict
+MESSAGE_COLUMNS = (
+    Message.id, Message.content, Message.author_id, User.username, User.avatar,
+    Message.group_id, Message.recipient_id, Message.timestamp, Message.edited,
+)
+
+
+def dumps(value: Any) -> bytes:
+    if orjson is not None:
+        # Ключи-числа (user_id -> состояние) json превращает в строки — так же и здесь
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return _encoder.encode(value).encode()
+
+
+def dumps_str(value: Any) -> str:
+    # Для сокетов и брокера, которые передают текст
+    return dumps(value).decode() if orjson is not None else _encoder.encode(value)
+
+
+def loads(payload) -> Any:
+    return orjson.loads(payload) if orjson is not None else json.loads(payload)
+
+
+def json_response(value: Any) -> Response:
+    return Response(content=dumps(value), media_type="application/json")
+
+
+def message_select() -> Select:
+    # Сообщение с автором одним запросом; фильтры и порядок добавляет вызывающий
+    return select(*MESSAGE_COLUMNS).select_from(Message).outerjoin(User, User.id == Message.author_id)
+
+
+def row_to_dict(row: Sequence) -> dict:
+    # row — строка message_select() или кортеж тех же полей
+    message_id, content, author_id, username, avatar, group_id, recipient_id, timestamp, edited = row
+    return {
+        "id": message_id,
+        "content": content,
+        "author_id": author_id,
+        "author": {"id": author_id, "username": username, "avatar": avatar},
+        "group_id": group_id,
+        "recipient_id": recipient_id,
+        "timestamp": timestamp.isoformat(),
+        "edited": edited or 0,
+    }
+
+
+def message_to_dict(msg: Message, author: User) -> dict:
+    return row_to_dict((msg.id, msg.content, msg.author_id, author.username, author.avatar,
+                        msg.group_id, msg.recipient_id, msg.timestamp, msg.edited))
+
+
+def rows_to_dicts(rows) -> List[dict]:
+    return [row_to_dict(row) for row in rows]
+
+
+def messages_by_id(db, ids: List[int]) -> dict:
+    # Сообщения по списку id (поиск, докачка): id -> dict
+    if not ids:
+        return {}
+    rows = db.execute(message_select().where(Message.id.in_(ids))).all()
+    return {row[0]: row_to_dict(row) for row in rows}
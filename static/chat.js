@@ -1,5 +1,5 @@
 const API_URL = window.location.origin;
-const token = localStorage.getItem("access_token");
+let token = localStorage.getItem("access_token");
 const currentUserId = parseInt(localStorage.getItem("user_id")) || null;
 
 if (!currentUserId || !token) {
@@ -7,21 +7,47 @@ if (!currentUserId || !token) {
 }
 
 let currentGroupId = null;
-let messageWS = null;
-let chatWS = null;
+// Один сокет на все чаты: подписки на группы идут управляющими кадрами
+let socket = null;
+let subscribedGroups = new Set();
+let reconnectDelay = 1000;
+// Задержка переподключения, назначенная сервером перед перезапуском (кадр reconnect)
+let reconnectAfter = null;
 let chats = [];
 let users = [];
+// Курсор для подгрузки более старых сообщений (before_id) и флаг идущей загрузки
+let historyCursor = null;
+let historyLoading = false;
+// Отложенные запросы "прочитано" по чатам
+const readTimers = {};
+// Номер последнего применённого события по группам: после переподключения сервер
+// присылает только пропущенное с этого номера (кадр resume или resync_required)
+const groupSeq = {};
+// Группы, ждущие ответа на докачку: живые кадры копятся до него
+let resuming = {};
+// Присутствие (presence.py) по группам: состояние участников и кто набирает текст
+const groupPresence = {};
+const typingByGroup = {};
+// Докуда прочитали открытый чат участники (read_receipts.py): user_id -> id сообщения
+let groupReads = {};
+// Сердцебиение: ping раз в 25 с; если сервер молчит дольше минуты, соединение полуоткрыто
+const HEARTBEAT_INTERVAL = 25000;
+const HEARTBEAT_TIMEOUT = 60000;
+let lastFrameAt = 0;
+let lastInputAt = Date.now();
+let lastTypingAt = 0;
 
 const messagesContainer = document.getElementById("messagesContainer");
 const chatTitle = document.getElementById("chatTitle");
 const chatMessageInput = document.getElementById("chatMessageInput");
 const sendMessageBtn = document.getElementById("sendMessageBtn");
+const chatStatus = document.getElementById("chatStatus");
 
 // Инициализация
 window.addEventListener("DOMContentLoaded", async () => {
     await loadChats();
     setupEventListeners();
-    connectChatWebSocket();
+    connectSocket();
 });
 
 async function initializeApp() {
@@ -31,9 +57,16 @@ async function initializeApp() {
 
 function setupEventListeners() {
     sendMessageBtn.addEventListener("click", sendMessage);
+    messagesContainer.addEventListener("scroll", () => {
+        if (messagesContainer.scrollTop < 100) loadOlderMessages();
+    });
     chatMessageInput.addEventListener("keypress", (e) => {
         if (e.key === "Enter") sendMessage();
     });
+    chatMessageInput.addEventListener("input", sendTyping);
+    ["keydown", "mousemove", "click"].forEach(type =>
+        document.addEventListener(type, () => { lastInputAt = Date.now(); }, { passive: true }));
+    setInterval(heartbeat, HEARTBEAT_INTERVAL);
     document.addEventListener("click", (e) => {
         if (!e.target.closest(".edit-delete")) {
             document.querySelectorAll(".dropdown-menu").forEach(m => m.style.display = "none");
@@ -48,109 +81,340 @@ function setupEventListeners() {
     });
 }
 
-function connectChatWebSocket() {
-    const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
-    const wsUrl = `${protocol}//${window.location.host}/ws/chats/${currentUserId}`;
-    chatWS = new WebSocket(wsUrl);
+// Служебные сообщения авторизованного сокета: продление токена без переподключения
+function handleAuthFrame(ws, data) {
+    if (data.type === "token_expiring") {
+        ws.send(JSON.stringify({ type: "refresh_token" }));
+        return true;
+    }
+    if (data.type === "token") {
+        token = data.data.access_token;
+        localStorage.setItem("access_token", token);
+        return true;
+    }
+    return false;
+}
+
+// Компактные кадры (?encoding=compact, см. wire_format.py) разворачиваем в обычный вид
+const MESSAGE_FRAME_TYPES = { 1: "new_message", 2: "updated_message" };
+const GROUP_ACTIONS = { 1: "created", 2: "updated", 3: "deleted" };
+
+function decodeFrame(raw) {
+    const frame = JSON.parse(raw);
+    if (!Array.isArray(frame)) return frame;
+    const code = frame[0];
+    if (code in MESSAGE_FRAME_TYPES) {
+        const [, id, group_id, author_id, username, avatar, content, timestamp, edited, recipient_id, seq] = frame;
+        return {
+            type: MESSAGE_FRAME_TYPES[code],
+            seq,
+            data: {
+                id, group_id, author_id, content, edited, recipient_id,
+                author: { id: author_id, username, avatar },
+                timestamp: new Date(timestamp).toISOString()
+            }
+        };
+    }
+    if (code === 3) return { type: "deleted_message", seq: frame[3], data: { id: frame[1], group_id: frame[2] } };
+    if (code === 4) return { type: "group_update", data: { group_id: frame[1], action: GROUP_ACTIONS[frame[2]], name: frame[3] } };
+    return {};
+}
 
-    chatWS.onmessage = (event) => {
-        const data = JSON.parse(event.data);
-        if (data.type === "group_update") {
+function connectSocket() {
+    const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
+    socket = new WebSocket(`${protocol}//${window.location.host}/ws?token=${encodeURIComponent(token)}&encoding=compact`);
+    subscribedGroups = new Set();
+    resuming = {};
+
+    socket.onopen = () => {
+        reconnectDelay = 1000;
+        lastFrameAt = Date.now();
+        // Подписка с номерами событий догружает то, что могли пропустить
+        subscribeToChats();
+        sendView();
+        if (currentGroupId && !(currentGroupId in groupSeq)) fetchMessages();
+    };
+    socket.onmessage = (event) => {
+        lastFrameAt = Date.now();
+        const data = decodeFrame(event.data);
+        if (data.error) {
+            console.warn("Socket error:", data.error);
+            return;
+        }
+        if (handleAuthFrame(socket, data)) return;
+
+        if (data.type === "pong") {
+            return;
+        } else if (data.type === "presence") {
+            applyPresence(data.data);
+        } else if (data.type === "resume" || data.type === "resync_required") {
+            finishResume(data);
+        } else if (sequenceFrame(data)) {
+            return;
+        } else if (data.type === "group_update") {
             handleGroupUpdate(data.data);
+        } else if (data.type === "read_receipts") {
+            applyReceipts(data.data);
+        } else if (data.type === "chat_read") {
+            const chat = chats.find(c => c.id === data.data.group_id);
+            if (chat) {
+                chat.last_read_id = data.data.last_read_id;
+                if (chat.unread_count !== data.data.unread_count) {
+                    chat.unread_count = data.data.unread_count || 0;
+                    renderChatsList();
+                }
+            }
+        } else if (data.type === "unsubscribed") {
+            data.data.group_ids.forEach(id => subscribedGroups.delete(id));
+        } else if (data.type === "reconnect") {
+            reconnectAfter = data.data.after_ms;
+        } else {
+            applyMessageEvent(data);
+        }
+    };
+    socket.onclose = (event) => {
+        // 4401 — токен недействителен или истёк
+        if (event.code === 4401) {
+            window.location.href = "/login";
+            return;
+        }
+        let delay = reconnectAfter;
+        reconnectAfter = null;
+        if (delay === null) {
+            // Случайная половина задержки — чтобы клиенты, отключённые разом, не вернулись разом
+            delay = reconnectDelay / 2 + Math.random() * reconnectDelay / 2;
+            reconnectDelay = Math.min(reconnectDelay * 2, 30000);
         }
+        setTimeout(connectSocket, delay);
     };
 }
 
+// Подписываемся на все чаты из списка, которых ещё нет среди подписок сокета
+function subscribeToChats() {
+    if (!socket || socket.readyState !== WebSocket.OPEN) return;
+    const groupIds = chats.map(c => c.id).filter(id => !subscribedGroups.has(id));
+    if (groupIds.length === 0) return;
+    const since = {};
+    groupIds.forEach(id => {
+        subscribedGroups.add(id);
+        if (id in groupSeq) {
+            since[id] = groupSeq[id];
+            resuming[id] = [];
+        }
+    });
+    socket.send(JSON.stringify({ type: "subscribe", group_ids: groupIds, since }));
+}
 
-function connectMessageWebSocket(groupId) {
-    if (messageWS) {
-        messageWS.onclose = null;
-        messageWS.close();
+// Активен ли пользователь: вкладка видна и была работа с клавиатурой или мышью за минуту
+function heartbeat() {
+    if (!socket || socket.readyState !== WebSocket.OPEN) return;
+    if (Date.now() - lastFrameAt > HEARTBEAT_TIMEOUT) {
+        // Ответа на ping нет — закрываем, onclose переподключится
+        socket.close();
+        return;
     }
-    const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
-    const wsUrl = `${protocol}//${window.location.host}/ws/${groupId}`;
+    const active = document.visibilityState === "visible" && Date.now() - lastInputAt < 60000;
+    socket.send(JSON.stringify({ type: "ping", active }));
+}
+
+// Сервер сам гасит индикатор через несколько секунд, продлеваем не чаще раза в 3 с
+function sendTyping() {
+    if (!socket || socket.readyState !== WebSocket.OPEN || !currentGroupId) return;
+    if (Date.now() - lastTypingAt < 3000) return;
+    lastTypingAt = Date.now();
+    socket.send(JSON.stringify({ type: "typing", group_id: currentGroupId }));
+}
+
+// Отметки о прочтении приходят только для открытого чата: сообщаем серверу, какой открыт
+function sendView() {
+    if (!socket || socket.readyState !== WebSocket.OPEN) return;
+    socket.send(JSON.stringify({ type: "view", group_id: currentGroupId }));
+}
+
+// Кадр с full — снимок при открытии чата, остальные — сдвинувшиеся знаки
+function applyReceipts(data) {
+    if (data.group_id !== currentGroupId) return;
+    if (data.full) groupReads = {};
+    Object.entries(data.reads).forEach(([userId, messageId]) => { groupReads[userId] = messageId; });
+    renderReceipts();
+}
+
+// Своё сообщение прочитано, если до него дочитал хоть кто-то из остальных участников
+function renderReceipts() {
+    const readUpTo = Math.max(0, ...Object.entries(groupReads)
+        .filter(([userId]) => Number(userId) !== currentUserId)
+        .map(([, messageId]) => messageId));
+    messagesContainer.querySelectorAll(".message.sent").forEach(div => {
+        const receipt = div.querySelector(".message-receipt");
+        if (receipt) receipt.textContent = Number(div.dataset.messageId) <= readUpTo ? "✓✓" : "✓";
+    });
+}
+
+// Кадр с full — снимок при подписке, остальные — изменения с прошлого тика
+function applyPresence(data) {
+    if (data.full || !groupPresence[data.group_id]) groupPresence[data.group_id] = {};
+    const states = groupPresence[data.group_id];
+    Object.entries(data.users || {}).forEach(([userId, state]) => {
+        if (state === "offline") delete states[userId];
+        else states[userId] = state;
+    });
+    if (data.typing) typingByGroup[data.group_id] = data.typing.filter(id => id !== currentUserId);
+    if (data.group_id === currentGroupId) renderChatStatus();
+}
+
+function userName(userId) {
+    const user = users.find(u => u.id === userId);
+    return user ? user.username : `#${userId}`;
+}
+
+function renderChatStatus() {
+    const typing = typingByGroup[currentGroupId] || [];
+    if (typing.length) {
+        chatStatus.textContent = `${typing.map(userName).join(", ")} печатает...`;
+        return;
+    }
+    const states = groupPresence[currentGroupId] || {};
+    const online = Object.keys(states).filter(id => states[id] === "online" && Number(id) !== currentUserId);
+    chatStatus.textContent = online.length ? `в сети: ${online.length}` : "";
+}
+
+// true — кадр уже применялся или отложен до ответа на докачку группы
+function sequenceFrame(data) {
+    if (data.seq == null || !data.data) return false;
+    const groupId = data.data.group_id;
+    if (resuming[groupId]) {
+        resuming[groupId].push(data);
+        return true;
+    }
+    if (data.seq <= (groupSeq[groupId] || 0)) return true;
+    groupSeq[groupId] = data.seq;
+    return false;
+}
+
+function applyMessageEvent(data) {
+    const msg = data.data;
+    if (data.type === "new_message") touchChat(msg);
+    if (!msg || msg.group_id !== currentGroupId) return;
+    if (data.type === "new_message") {
+        if (!document.getElementById(`message-${msg.id}`)) displayMessages([msg], true);
+    } else if (data.type === "updated_message") {
+        updateMessage(msg);
+    } else if (data.type === "deleted_message") {
+        removeMessage(msg.id);
+    }
+}
 
-    messageWS = new WebSocket(wsUrl);
-    messageWS.onopen = () => {
-        console.log("Connected to chat: " + groupId);
+// Ответ на подписку с since: пропущенные события (по одному на сообщение) или, если
+// журнал уже сжат, resync_required — тогда история открытого чата перечитывается целиком
+function finishResume(data) {
+    const { group_id: groupId, seq } = data.data;
+    const pending = resuming[groupId] || [];
+    delete resuming[groupId];
+    if (data.type === "resume") {
+        data.data.events.forEach(applyMessageEvent);
+    } else if (groupId === currentGroupId) {
         fetchMessages();
-    };
-    messageWS.onmessage = (event) => {
-        const data = JSON.parse(event.data);
-        if (data.error) return;
-
-        if (data.type === "new_message" && data.data.group_id === currentGroupId) {
-            displayMessages([data.data], true);
-        } else if (data.type === "updated_message" && data.data.group_id === currentGroupId) {
-            updateMessage(data.data);
-        } else if (data.type === "deleted_message" && data.data.group_id === currentGroupId) {
-            removeMessage(data.data.id);
-        }
-    };
+    }
+    groupSeq[groupId] = seq;
+    pending.forEach(frame => {
+        if (!sequenceFrame(frame)) applyMessageEvent(frame);
+    });
 }
 
 
 // Сообщения
 async function sendMessage() {
     const content = chatMessageInput.value.trim();
-    if (!content || !messageWS || messageWS.readyState !== WebSocket.OPEN || !currentGroupId) return;
+    if (!content || !socket || socket.readyState !== WebSocket.OPEN || !currentGroupId) return;
 
-    messageWS.send(JSON.stringify({
-        content,
-        author_id: currentUserId,
-        group_id: currentGroupId
-    }));
+    // Автор определяется по токену при подключении — в кадре только группа и текст
+    socket.send(JSON.stringify({ type: "message", group_id: currentGroupId, content }));
 
     chatMessageInput.value = "";
 }
 
+async function fetchMessagesPage(params = "") {
+    const response = await fetch(`${API_URL}/messages?group_id=${currentGroupId}${params}`, {
+        headers: { Authorization: `Bearer ${token}` }
+    });
+    if (!response.ok) throw new Error("Failed to load messages");
+    return response.json();
+}
+
 async function fetchMessages() {
+    historyCursor = null;
     try {
-        const response = await fetch(`${API_URL}/messages?group_id=${currentGroupId}`, {
-            headers: { Authorization: `Bearer ${token}` }
-        });
-        if (response.ok) {
-            const messages = await response.json();
-            displayMessages(messages);
-        }
+        const page = await fetchMessagesPage();
+        historyCursor = page.next_cursor;
+        displayMessages(page.messages);
     } catch (err) {
         console.error("Error loading messages", err);
     }
 }
 
+// Бесконечная прокрутка: при подходе к верху подгружаем страницу старше курсора
+async function loadOlderMessages() {
+    if (historyLoading || historyCursor === null || !currentGroupId) return;
+    historyLoading = true;
+    const groupId = currentGroupId;
+    try {
+        const page = await fetchMessagesPage(`&before_id=${historyCursor}`);
+        if (groupId !== currentGroupId) return;
+        historyCursor = page.next_cursor;
+        prependMessages(page.messages);
+    } catch (err) {
+        console.error("Error loading older messages", err);
+    } finally {
+        historyLoading = false;
+    }
+}
+
 function displayMessages(messages, append = false) {
     if (!append) messagesContainer.innerHTML = "";
 
-    messages.forEach(msg => {
-        const isSentByMe = msg.author_id === currentUserId;
-        const messageDiv = document.createElement("div");
-        messageDiv.className = `message ${isSentByMe ? 'sent' : 'received'}`;
-        messageDiv.id = `message-${msg.id}`;
-        messageDiv.setAttribute("data-message-id", msg.id);
-
-        const authorName = isSentByMe ? 'Вы' : (msg.author && msg.author.username ? msg.author.username : 'Unknown');
-
-        messageDiv.innerHTML = `
-            <div class="message-wrapper">
-                <div class="message-author">${authorName}</div>
-                <div class="message-content">${msg.content}</div>
-                <div class="message-info">
-                    ${new Date(msg.timestamp).toLocaleTimeString()}
-                    ${msg.edited ? '(изменено)' : ''}
-                </div>
-            </div>
-        `;
+    messages.forEach(msg => messagesContainer.appendChild(renderMessage(msg)));
+    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    renderReceipts();
+}
 
-        if (isSentByMe) {
-            messageDiv.addEventListener('contextmenu', (e) => {
-                e.preventDefault();
-                showContextMenu(e, msg);
-            });
-        }
+function prependMessages(messages) {
+    // Сохраняем позицию прокрутки, чтобы лента не прыгала
+    const previousHeight = messagesContainer.scrollHeight;
+    const fragment = document.createDocumentFragment();
+    messages.forEach(msg => fragment.appendChild(renderMessage(msg)));
+    messagesContainer.insertBefore(fragment, messagesContainer.firstChild);
+    messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+    renderReceipts();
+}
 
-        messagesContainer.appendChild(messageDiv);
-    });
-    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+function renderMessage(msg) {
+    const isSentByMe = msg.author_id === currentUserId;
+    const messageDiv = document.createElement("div");
+    messageDiv.className = `message ${isSentByMe ? 'sent' : 'received'}`;
+    messageDiv.id = `message-${msg.id}`;
+    messageDiv.setAttribute("data-message-id", msg.id);
+
+    const authorName = isSentByMe ? 'Вы' : (msg.author && msg.author.username ? msg.author.username : 'Unknown');
+
+    messageDiv.innerHTML = `
+        <div class="message-wrapper">
+            <div class="message-author">${authorName}</div>
+            <div class="message-content">${msg.content}</div>
+            <div class="message-info">
+                ${new Date(msg.timestamp).toLocaleTimeString()}
+                ${msg.edited ? '(изменено)' : ''}
+                ${isSentByMe ? '<span class="message-receipt"></span>' : ''}
+            </div>
+        </div>
+    `;
+
+    if (isSentByMe) {
+        messageDiv.addEventListener('contextmenu', (e) => {
+            e.preventDefault();
+            showContextMenu(e, msg);
+        });
+    }
+    return messageDiv;
 }
 
 function updateMessage(msg) {
@@ -159,7 +423,9 @@ function updateMessage(msg) {
     msgDiv.querySelector(".message-content").textContent = msg.content;
     msgDiv.querySelector(".message-info").innerHTML = `
         ${new Date(msg.timestamp).toLocaleTimeString()} ${msg.edited ? '(изменено)' : ''}
+        ${msg.author_id === currentUserId ? '<span class="message-receipt"></span>' : ''}
     `;
+    renderReceipts();
 }
 
 
@@ -195,7 +461,11 @@ async function loadChats() {
         });
         if (response.ok) {
             chats = await response.json();
+            chats.forEach(chat => {
+                if (!(chat.id in groupSeq)) groupSeq[chat.id] = chat.last_seq;
+            });
             renderChatsList();
+            subscribeToChats();
             if (chats.length > 0 && !currentGroupId) {
                 switchToChat(chats[0].id);
             }
@@ -231,8 +501,13 @@ function renderChatsList() {
                 <div class="chat-name">${chat.name}</div>
                 <div class="chat-preview">...</div>
             </div>
+            ${chat.unread_count ? `<div class="chat-unread">${chat.unread_count}</div>` : ""}
             <button class="delete-chat" onclick="deleteChat(${chat.id})">×</button>
         `;
+        if (chat.last_message) {
+            const author = chat.last_message.author ? `${chat.last_message.author}: ` : "";
+            chatItem.querySelector(".chat-preview").textContent = author + chat.last_message.preview;
+        }
         
         chatItem.onclick = (e) => {
             if (!e.target.classList.contains("delete-chat")) {
@@ -243,15 +518,59 @@ function renderChatsList() {
     });
 }
 
+// Новое сообщение поднимает чат наверх и обновляет превью и счётчик непрочитанного
+function touchChat(msg) {
+    const chat = chats.find(c => c.id === msg.group_id);
+    if (!chat) return;
+    chat.last_message = { id: msg.id, preview: msg.content, author: msg.author ? msg.author.username : null };
+    chat.last_activity = msg.timestamp;
+    if (msg.group_id === currentGroupId) {
+        markChatRead(chat);
+    } else if (msg.author_id !== currentUserId) {
+        chat.unread_count = (chat.unread_count || 0) + 1;
+    }
+    chats = [chat, ...chats.filter(c => c !== chat)];
+    renderChatsList();
+}
+
+// Сдвигаем знак прочтения на сервере не чаще раза в полсекунды на чат: кадром read по
+// сокету, а если он закрыт — через REST. Сервер сам копит отметки и пишет их пакетом
+function markChatRead(chat) {
+    chat.unread_count = 0;
+    if (readTimers[chat.id]) return;
+    readTimers[chat.id] = setTimeout(() => {
+        delete readTimers[chat.id];
+        const messageId = chat.last_message ? chat.last_message.id : null;
+        if (messageId === null || messageId <= (chat.last_read_id || 0)) return;
+        if (socket && socket.readyState === WebSocket.OPEN && subscribedGroups.has(chat.id)) {
+            socket.send(JSON.stringify({ type: "read", group_id: chat.id, message_id: messageId }));
+            return;
+        }
+        fetch(`${API_URL}/chats/${chat.id}/read?message_id=${messageId}`, {
+            method: "POST",
+            headers: { Authorization: `Bearer ${token}` }
+        }).catch(err => console.error("Error marking chat as read", err));
+    }, 500);
+}
+
 function switchToChat(chatId) {
     if (currentGroupId === chatId) return;
     currentGroupId = chatId;
     const chat = chats.find(c => c.id === chatId);
 
     if (chat) {
+        if (chat.unread_count) {
+            markChatRead(chat);
+            renderChatsList();
+        }
         chatTitle.textContent = chat.name;
+        lastTypingAt = 0;
+        groupReads = {};
+        sendView();
+        renderChatStatus();
         messagesContainer.innerHTML = "";
-        connectMessageWebSocket(chatId);
+        historyCursor = null;
+        fetchMessages();
         document.querySelectorAll(".chat-item").forEach(i => i.classList.remove("active"));
         const activeItem = Array.from(document.querySelectorAll(".chat-item")).find(i => i.textContent.includes(chat.name));
         if (activeItem) activeItem.classList.add("active");
@@ -406,7 +725,6 @@ async function deleteChat(chatId) {
                 currentGroupId = null;
                 messagesContainer.innerHTML = "";
                 chatTitle.textContent = "Выберите чат";
-                if (ws) ws.close();
             }
             await loadChats();
         } else {
@@ -578,7 +896,6 @@ function handleGroupUpdate(data) {
             currentGroupId = null;
             messagesContainer.innerHTML = "";
             chatTitle.textContent = "Выберите чат";
-            if (ws) ws.close();
         }
         // Refresh the chats list
         loadChats();
@@ -608,15 +925,22 @@ document.getElementById('themeToggle').addEventListener('change', e => {
   localStorage.setItem('darkTheme', on);
 });
 
-document.getElementById('bgInput').addEventListener('change', e => {
+document.getElementById('bgInput').addEventListener('change', async e => {
   const file = e.target.files[0];
   if (!file) return;
-  const reader = new FileReader();
-  reader.onload = () => {
-    localStorage.setItem('chatBg', reader.result);
-    document.querySelector('.chat-container').style.backgroundImage = `url(${reader.result})`;
-  };
-  reader.readAsDataURL(file);
+  // Файл уходит на сервер (POST /media), в настройках остаётся только ссылка: её кэширует браузер
+  const response = await fetch(`${API_URL}/media`, {
+    method: 'POST',
+    headers: { Authorization: `Bearer ${token}` },
+    body: file
+  });
+  if (!response.ok) {
+    alert("Ошибка при загрузке фона");
+    return;
+  }
+  const media = await response.json();
+  localStorage.setItem('chatBg', media.url);
+  document.querySelector('.chat-container').style.backgroundImage = `url(${media.url})`;
 });
 
 function resetSettings() {
@@ -1,49 +1,322 @@
+import asyncio
+import itertools
+import time
 from fastapi import WebSocket
-from typing import Dict, List, Any
+from typing import Callable, Dict, Any, Iterable, List, Optional, Set
+from broker import Broker, InProcessBroker
+from metrics import observe_broadcast
+from serialization import dumps_str
+from wire_format import compact_from_json
+
+# Сколько сообщений может ждать отправки у одного клиента
+MAX_BACKLOG = 256
+# Что делать с отстающим клиентом: "evict" — отключить, "drop" — выбрасывать старые сообщения
+OVERFLOW_POLICY = "evict"
+# Код закрытия для отключённых медленных клиентов (try again later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# Код закрытия сокетов удалённой группы
+GROUP_DELETED_CLOSE_CODE = 4404
+# Код закрытия при перезапуске сервера (service restart)
+SERVICE_RESTART_CLOSE_CODE = 1012
+# Сколько групп может слушать один мультиплексированный сокет
+MAX_SUBSCRIPTIONS = 1000
+
+
+# Номера сокетов воркера: в отличие от id(), не достаются новому сокету после закрытия старого
+_connection_keys = itertools.count(1)
+
+
+def encode_message(message: Any) -> str:
+    # Тот же JSON, что и у WebSocket.send_json, но сериализуем один раз на рассылку
+    return dumps_str(message)
+
+
+class Connection:
+    """Outbound side of one socket: a bounded queue drained by its own writer task."""
+
+    def __init__(self, websocket: WebSocket, manager: "ConnectionManager",
+                 user_id: Optional[int] = None, multiplexed: bool = False, encoding: str = "json"):
+        self.websocket = websocket
+        self.manager = manager
+        self.user_id = user_id
+        # Ключ состояния сокета в других модулях (корзина лимита кадров в ratelimit)
+        self.key = next(_connection_keys)
+        # Кодировка кадров, согласованная при подключении (см. wire_format)
+        self.encoding = encoding
+        # Группы, на которые подписан сокет (у старых /ws/{group_id} — ровно одна)
+        self.groups: Set[int] = set()
+        self.multiplexed = multiplexed
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=manager.max_backlog)
+        self.dropped = 0
+        self.writer: Optional[asyncio.Task] = None
+        # Для присутствия (presence.py): последний входящий кадр, последнее действие
+        # пользователя и присылает ли клиент ping (тогда молчание значит полуоткрытый сокет)
+        self.last_seen = self.last_active = time.monotonic()
+        self.heartbeat = False
+        # Группа, открытая сейчас в клиенте (кадр view): ей идут отметки о прочтении
+        self.viewing: Optional[int] = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, payload: str) -> bool:
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            pass
+        if self.manager.overflow_policy != "drop":
+            return False
+        # Выбрасываем самое старое сообщение, чтобы освободить место под новое
+        self.queue.get_nowait()
+        self.queue.task_done()
+        self.queue.put_nowait(payload)
+        self.dropped += 1
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                payload = await self.queue.get()
+                await self.websocket.send_text(payload)
+                # queue.join() в drain ждёт, пока отправлено всё поставленное
+                self.queue.task_done()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error sending message to client: {e}")
+            # Сокет мёртв — убираем его сразу, не дожидаясь следующего receive
+            self.manager.remove(self)
+
+    def stop(self):
+        if self.writer is not None and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
 
 class ConnectionManager:
-    def __init__(self):
-        # Map group_id -> list of connected websockets
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+    """Routes broadcasts through a broker; each worker delivers only to its own sockets."""
+
+    def __init__(self, broker: Optional[Broker] = None,
+                 max_backlog: int = MAX_BACKLOG, overflow_policy: str = OVERFLOW_POLICY):
+        self.max_backlog = max_backlog
+        self.overflow_policy = overflow_policy
+        # Единый индекс маршрутизации: group_id -> подписанные сокеты, user_id -> сокеты пользователя
+        self.group_connections: Dict[int, Dict[WebSocket, Connection]] = {}
+        self.user_connections: Dict[int, Dict[WebSocket, Connection]] = {}
         # Map all active connections (for broadcasting to everyone)
-        self.all_connections: List[WebSocket] = []
+        self.all_connections: Dict[WebSocket, Connection] = {}
+        # Слушатели всех событий групп этого воркера (например, кэш истории)
+        self.group_listeners: List[Callable[[int, str], None]] = []
+        # Обработчики прочих каналов брокера: kind -> handler(target, payload)
+        self.channel_handlers: Dict[str, Callable[[str, str], None]] = {}
+        # Вызываются при подключении, отключении и смене подписок сокета (например, presence)
+        self.connection_listeners: List[Callable[[Connection], None]] = []
+        self.broker = broker or InProcessBroker()
+        self.broker.set_handler(self._deliver)
+        # Сервер останавливается: новые сокеты не принимаются (см. drain)
+        self.draining = False
+
+    async def start(self):
+        self.draining = False
+        await self.broker.start()
 
-    async def connect(self, websocket: WebSocket, group_id: int):
+    async def close(self):
+        await self.broker.close()
+
+    async def connect(self, websocket: WebSocket, group_id: Optional[int] = None, user_id: Optional[int] = None,
+                      multiplexed: bool = False, encoding: str = "json") -> Connection:
         await websocket.accept()
-        
-        # Add to group-specific connections
-        if group_id not in self.active_connections:
-            self.active_connections[group_id] = []
-        self.active_connections[group_id].append(websocket)
-        
+        connection = Connection(websocket, self, user_id=user_id, multiplexed=multiplexed, encoding=encoding)
+        self._register(connection)
+        if group_id is not None:
+            self.subscribe(connection, group_id)
+        return connection
+
+    async def connect_user(self, websocket: WebSocket, user_id: int) -> Connection:
+        return await self.connect(websocket, user_id=user_id)
+
+    def _register(self, connection: Connection):
+        connection.start()
+        if connection.user_id is not None:
+            self.user_connections.setdefault(connection.user_id, {})[connection.websocket] = connection
         # Add to all connections
-        self.all_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket, group_id: int):
-        if group_id in self.active_connections:
-            if websocket in self.active_connections[group_id]:
-                self.active_connections[group_id].remove(websocket)
-            
-            # Clean up empty groups
-            if not self.active_connections[group_id]:
-                del self.active_connections[group_id]
-        
-        if websocket in self.all_connections:
-            self.all_connections.remove(websocket)
+        self.all_connections[connection.websocket] = connection
+        self._connection_changed(connection)
+
+    def _connection_changed(self, connection: Connection):
+        for listener in self.connection_listeners:
+            listener(connection)
+
+    def subscribe(self, connection: Connection, group_id: int) -> bool:
+        if group_id in connection.groups:
+            return True
+        if len(connection.groups) >= MAX_SUBSCRIPTIONS:
+            return False
+        connection.groups.add(group_id)
+        self.group_connections.setdefault(group_id, {})[connection.websocket] = connection
+        self._connection_changed(connection)
+        return True
+
+    def unsubscribe(self, connection: Connection, group_id: int):
+        connection.groups.discard(group_id)
+        if connection.viewing == group_id:
+            connection.viewing = None
+        _discard(self.group_connections, group_id, connection.websocket)
+        self._connection_changed(connection)
+
+    def disconnect(self, websocket: WebSocket, group_id: Optional[int] = None):
+        connection = self.all_connections.get(websocket)
+        if connection is not None:
+            self.remove(connection)
+
+    def remove(self, connection: Connection):
+        for group_id in connection.groups:
+            _discard(self.group_connections, group_id, connection.websocket)
+        connection.groups.clear()
+        _discard(self.user_connections, connection.user_id, connection.websocket)
+        if self.all_connections.pop(connection.websocket, None) is not None:
+            self._connection_changed(connection)
+        connection.stop()
+
+    def evict(self, connection: Connection):
+        print(f"Evicting slow client (groups {sorted(connection.groups)}, user {connection.user_id}): backlog over {self.max_backlog}")
+        self.close_connection(connection, SLOW_CONSUMER_CLOSE_CODE)
+
+    def close_connection(self, connection: Connection, code: int):
+        self.remove(connection)
+        asyncio.create_task(self._close(connection.websocket, code))
+
+    async def _close(self, websocket: WebSocket, code: int = SLOW_CONSUMER_CLOSE_CODE):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def drain(self, farewell: Callable[[Connection], Any], timeout: float) -> int:
+        """Queue every socket its own farewell frame, wait up to `timeout` for queues to flush, close with 1012."""
+        self.draining = True
+        connections = list(self.all_connections.values())
+        for connection in connections:
+            self._fan_out(encode_message(farewell(connection)), [connection])
+        # Вместе с прощальным кадром досылаются и уже стоящие в очереди рассылки
+        flushing = [asyncio.create_task(connection.queue.join()) for connection in connections]
+        if flushing:
+            _, pending = await asyncio.wait(flushing, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        connections = list(self.all_connections.values())
+        for connection in connections:
+            self.remove(connection)
+        await asyncio.gather(*(self._close(connection.websocket, SERVICE_RESTART_CLOSE_CODE)
+                               for connection in connections))
+        return len(connections)
+
+    def _close_group(self, group_id: int):
+        # Участие в группе закреплено за сокетом при подписке: мультиплексированный сокет
+        # просто теряет подписку, сокет одной группы закрывается
+        unsubscribed = encode_message({"type": "unsubscribed", "data": {"group_ids": [group_id], "reason": "deleted"}})
+        for connection in list(self.group_connections.get(group_id, {}).values()):
+            if connection.multiplexed:
+                self.unsubscribe(connection, group_id)
+                self._fan_out(unsubscribed, [connection])
+            else:
+                self.remove(connection)
+                asyncio.create_task(self._close(connection.websocket, GROUP_DELETED_CLOSE_CODE))
+
+    def _fan_out(self, payload: str, connections: Iterable[Connection]):
+        compact = None
+        for connection in list(connections):
+            if connection.encoding == "compact":
+                if compact is None:
+                    compact = compact_from_json(payload)
+                queued = connection.enqueue(compact)
+            else:
+                queued = connection.enqueue(payload)
+            if not queued:
+                self.evict(connection)
+
+    def _deliver(self, channel: str, payload: str):
+        # Вызывается брокером в каждом воркере: рассылаем только своим сокетам
+        kind, _, target = channel.partition(":")
+        started = time.perf_counter()
+        if kind == "group":
+            group_id = int(target)
+            for listener in self.group_listeners:
+                listener(group_id, payload)
+            connections = self.group_connections.get(group_id)
+            recipients = len(connections) if connections else 0
+            if connections:
+                self._fan_out(payload, connections.values())
+            observe_broadcast(kind, recipients, time.perf_counter() - started)
+        elif kind == "users":
+            recipients = 0
+            for user_id in target.split(","):
+                connections = self.user_connections.get(int(user_id))
+                if connections:
+                    recipients += len(connections)
+                    self._fan_out(payload, connections.values())
+            observe_broadcast(kind, recipients, time.perf_counter() - started)
+        elif kind == "viewers":
+            group_id = int(target)
+            connections = [
+                connection for connection in self.group_connections.get(group_id, {}).values()
+                if connection.viewing == group_id
+            ]
+            if connections:
+                self._fan_out(payload, connections)
+            observe_broadcast(kind, len(connections), time.perf_counter() - started)
+        elif kind == "all":
+            recipients = len(self.all_connections)
+            self._fan_out(payload, self.all_connections.values())
+            observe_broadcast(kind, recipients, time.perf_counter() - started)
+        elif kind == "close_group":
+            self._close_group(int(target))
+        elif kind in self.channel_handlers:
+            self.channel_handlers[kind](target, payload)
+
+    def send_to_local_group(self, message: Any, group_id: int, channel: str = "group") -> int:
+        # Только сокетам этого воркера, без брокера и слушателей групп: для состояния,
+        # которое каждый воркер уже свёл у себя (presence)
+        connections = self.group_connections.get(group_id)
+        if not connections:
+            return 0
+        started = time.perf_counter()
+        self._fan_out(encode_message(message), connections.values())
+        observe_broadcast(channel, len(connections), time.perf_counter() - started)
+        return len(connections)
+
+    async def publish(self, channel: str, payload: str = ""):
+        # Служебные сообщения между воркерами (например, инвалидация кэшей)
+        await self.broker.publish(channel, payload)
+
+    async def send_personal(self, message: Any, websocket: WebSocket):
+        connection = self.all_connections.get(websocket)
+        if connection is not None:
+            self._fan_out(encode_message(message), [connection])
 
     async def broadcast_to_group(self, message: Any, group_id: int):
-        if group_id in self.active_connections:
-            for connection in self.active_connections[group_id]:
-                try:
-                    await connection.send_json(message)
-                except Exception as e:
-                    print(f"Error sending message to client: {e}")
-                    # Connection is likely bad, will be cleaned up on next interaction
+        await self.broker.publish(f"group:{group_id}", encode_message(message))
+
+    async def send_to_viewers(self, message: Any, group_id: int):
+        # Подписчикам группы, у которых она сейчас открыта
+        await self.broker.publish(f"viewers:{group_id}", encode_message(message))
+
+    async def send_to_users(self, message: Any, user_ids: Iterable[int]):
+        user_ids = ",".join(str(user_id) for user_id in user_ids)
+        if user_ids:
+            await self.broker.publish(f"users:{user_ids}", encode_message(message))
+
+    async def close_group(self, group_id: int):
+        await self.broker.publish(f"close_group:{group_id}", "")
 
     async def broadcast_to_all(self, message: Any):
-        for connection in self.all_connections:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                print(f"Error broadcasting to client: {e}")
-                # Connection is likely bad, will be cleaned up on next interaction
\ No newline at end of file
+        await self.broker.publish("all", encode_message(message))
+
+
+def _discard(index: Dict[int, Dict[WebSocket, Connection]], key: Optional[int], websocket: WebSocket):
+    if key is None or key not in index:
+        return
+    index[key].pop(websocket, None)
+    # Clean up empty groups
+    if not index[key]:
+        del index[key]
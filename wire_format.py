@@ -0,0 +1,60 @@
+# wire_format.py
+# Компактный формат кадров WebSocket для клиентов /ws, запросивших его при подключении:
+# позиционные массивы вместо объектов с повторяющимися ключами, время — целые миллисекунды.
+#
+#   new_message / updated_message: [code, id, group_id, author_id, username, avatar,
+#                                   content, timestamp_ms, edited, recipient_id, seq]
+#   deleted_message:               [3, id, group_id, seq]
+#   group_update:                  [4, group_id, action_code, name]
+#
+# seq — номер события в группе (message_log), null у сообщений вне групп.
+# Прочие (редкие) кадры передаются обычным JSON-объектом: клиент различает их по типу.
+import datetime
+from typing import Optional
+from serialization import dumps_str, loads
+
+ENCODINGS = ("json", "compact")
+
+NEW_MESSAGE = 1
+UPDATED_MESSAGE = 2
+DELETED_MESSAGE = 3
+GROUP_UPDATE = 4
+
+MESSAGE_TYPES = {"new_message": NEW_MESSAGE, "updated_message": UPDATED_MESSAGE}
+GROUP_ACTIONS = {"created": 1, "updated": 2, "deleted": 3}
+
+
+def negotiate(encoding: Optional[str]) -> str:
+    # Неизвестная кодировка — не ошибка: клиент получит JSON, который умеет разбирать всегда
+    return encoding if encoding in ENCODINGS else "json"
+
+
+def timestamp_ms(value: str) -> int:
+    # Наивное время сервера, как и в ISO-строке для JSON-клиентов
+    return int(datetime.datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def compact_frame(message: dict) -> Optional[list]:
+    kind = message.get("type")
+    data = message.get("data")
+    if kind in MESSAGE_TYPES:
+        author = data["author"]
+        return [
+            MESSAGE_TYPES[kind], data["id"], data["group_id"], data["author_id"],
+            author["username"], author["avatar"], data["content"],
+            timestamp_ms(data["timestamp"]), data["edited"], data["recipient_id"], message.get("seq"),
+        ]
+    if kind == "deleted_message":
+        return [DELETED_MESSAGE, data["id"], data["group_id"], message.get("seq")]
+    if kind == "group_update" and data["action"] in GROUP_ACTIONS:
+        return [GROUP_UPDATE, data["group_id"], GROUP_ACTIONS[data["action"]], data["name"]]
+    return None
+
+
+def compact_from_json(payload: str) -> str:
+    # Рассылки идут через брокер в JSON; перекодируем один раз на рассылку, а не на сокет
+    message = loads(payload)
+    frame = compact_frame(message) if isinstance(message, dict) else None
+    if frame is None:
+        return payload
+    return dumps_str(frame)
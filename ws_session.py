@@ -0,0 +1,69 @@
+# ws_session.py
+# Личность, закреплённая за WebSocket после проверки токена при подключении.
+# Кадры несут только содержимое; токен продлевается сообщением внутри сокета.
+import asyncio
+import time
+from typing import Optional
+from fastapi import WebSocket
+from auth import create_access_token, decode_token
+from membership_cache import CachedUser
+
+# За сколько секунд до истечения токена присылаем клиенту token_expiring
+TOKEN_REFRESH_WINDOW = 60
+# Коды закрытия: неверный/истёкший токен и отказ в доступе
+WS_CLOSE_UNAUTHORIZED = 4401
+WS_CLOSE_FORBIDDEN = 4403
+
+
+class SocketSession:
+    """Identity pinned to one socket plus the timers that track its token expiry."""
+
+    def __init__(self, websocket: WebSocket, manager, user: CachedUser, expires_at: float):
+        self.websocket = websocket
+        self.manager = manager
+        self.user = user
+        self.expires_at = expires_at
+        self._handles = []
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        for handle in self._handles:
+            handle.cancel()
+        remaining = self.expires_at - time.time()
+        self._handles = [
+            loop.call_later(max(0.0, remaining - TOKEN_REFRESH_WINDOW), self._warn),
+            loop.call_later(max(0.0, remaining), self._expire),
+        ]
+
+    def refresh(self) -> dict:
+        # Токен ещё действителен (иначе сокет уже закрыт) — выдаём новый без переподключения
+        token = create_access_token(data={"sub": str(self.user.id)})
+        _, self.expires_at = decode_token(token)
+        self.start()
+        return {"type": "token", "data": {"access_token": token, "expires_at": self.expires_at}}
+
+    def stop(self):
+        for handle in self._handles:
+            handle.cancel()
+        self._handles = []
+
+    def _warn(self):
+        asyncio.create_task(self.manager.send_personal(
+            {"type": "token_expiring", "data": {"expires_at": self.expires_at}}, self.websocket
+        ))
+
+    def _expire(self):
+        asyncio.create_task(_close(self.websocket, WS_CLOSE_UNAUTHORIZED))
+
+
+async def _close(websocket: WebSocket, code: int):
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
+
+
+async def reject(websocket: WebSocket, code: int, reason: Optional[str] = None):
+    # Принимаем и сразу закрываем, чтобы клиент увидел код закрытия
+    await websocket.accept()
+    await websocket.close(code=code, reason=reason)